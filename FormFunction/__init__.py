@@ -0,0 +1,65 @@
+"""
+===============================
+Form Function (__init__.py)
+===============================
+
+
+LICENCE:
+===============================
+
+Creative Commons Attribution-ShareAlike 4.0 International License
+https://creativecommons.org/licenses/by-sa/4.0/
+
+
+ABOUT:
+===============================
+
+Form functional analysis from harmonic analyses.
+
+Importing the package imports nothing else:
+each module is loaded on first use (e.g. FormFunction.bassToFormFunction),
+and music21 only when parsing or writing in a score,
+so the core matching (featureTable, formFunctionTables, schemaMatcher, bassToFormFunction.Analysis
+from features, pipeline, segmentation, ...) runs without it.
+
+Run the tests and scripts as modules from the directory above, e.g.:
+python -m unittest FormFunction.bassToFormFunction
+python -m FormFunction.corpusRunner path/to/Corpus -o out/
+The command-line tools (analysisServer, benchmark, corpusRunner and tableCompiler) and bassToFormFunction
+also run as scripts (e.g. python corpusRunner.py), as do featureTable and formFunctionTables (no sibling imports).
+The tests of the other modules import their siblings relatively, so run them with python -m only.
+
+"""
+
+# ------------------------------------------------------------------------------
+
+import importlib
+
+
+# ------------------------------------------------------------------------------
+
+__all__ = [
+    'analysisServer',
+    'annotationExport',
+    'bassToFormFunction',
+    'batchMatcher',
+    'benchmark',
+    'corpusRunner',
+    'featureCache',
+    'featureTable',
+    'formFunctionTables',
+    'higherOrder',
+    'incremental',
+    'pipeline',
+    'profiling',
+    'schemaMatcher',
+    'segmentation',
+    'sequenceMatcher',
+    'tableCompiler',
+]
+
+
+def __getattr__(name: str):
+    if name in __all__:
+        return importlib.import_module(f'.{name}', __name__)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
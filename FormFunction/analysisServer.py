@@ -0,0 +1,433 @@
+"""
+===============================
+Analysis Server (analysisServer.py)
+===============================
+
+
+LICENCE:
+===============================
+
+Creative Commons Attribution-ShareAlike 4.0 International License
+https://creativecommons.org/licenses/by-sa/4.0/
+
+
+ABOUT:
+===============================
+
+A long-running form function analysis service,
+so that tools calling it once per file do not pay for importing music21
+and building the tables every time.
+
+The protocol is JSON lines: one request per line in, one response per line out,
+either on stdin / stdout or over a local socket (one or more requests per connection).
+Requests are handled concurrently by a pool of worker processes
+which import everything once (warmUp) and stay warm,
+so responses may come back out of order: match them up by 'id'.
+
+Requests (any 'id' is returned with the response):
+- {"id": 1, "path": "path/to/analysis.rntxt"}
+(only with a root directory set, and only for files under it: relative paths are taken from the root)
+- {"id": 2, "romanText": "Time Signature: 4/4\\nm1 C: I b3 V7 ..."}
+- {"id": 3, "chords": ["I", "IV64", "I", "V43", "I6"], "key": "C"}
+(chords can also be [figure, key] pairs, for changes of key)
+plus, optionally, "higherOrder": true for phrase and theme labels,
+and "segment": true for the one best segmentation (see segmentation.py) in place of every match.
+- {"op": "ping"} and {"op": "stats"}.
+
+Responses:
+- {"id": 1, "status": "ok", "chords": 8, "formFunctions": [...]}
+with one row per form function as in annotationExport.annotationRow;
+- {"id": 1, "status": "error", "error": "..."}.
+
+Usage, e.g.:
+python -m FormFunction.analysisServer  # JSON lines on stdin / stdout
+python -m FormFunction.analysisServer --port 8765 -w 4  # on a local socket
+python -m FormFunction.analysisServer -r path/to/corpus  # allowing "path" requests for files in the corpus
+python -m FormFunction.analysisServer -t tables.json.gz  # with compiled tables (see tableCompiler.py)
+
+"""
+
+# ------------------------------------------------------------------------------
+
+import argparse
+import ipaddress
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+
+if __package__ in (None, ''):  # Run as a script: import the rest of the package from the directory above
+    import os
+    import sys
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    __package__ = 'FormFunction'
+
+
+# ------------------------------------------------------------------------------
+
+def warmUp(tablesPath: str = None):
+    """
+    Imports everything and builds the tables (in each worker, once).
+
+    :param tablesPath: a compiled table set to use in place of the built-in tables (see tableCompiler.py)
+    """
+    from music21 import converter, roman  # noqa: F401
+    from . import annotationExport  # noqa: F401
+    from . import bassToFormFunction  # noqa: F401
+    from . import formFunctionTables
+    from . import schemaMatcher
+    from . import tableCompiler
+    tableCompiler.loadTables(tablesPath)
+    return len(formFunctionTables.lookupIndex) + len(schemaMatcher.currentAutomaton().outputs)
+
+
+def romanNumeralsFromChords(chords: list, key: str = 'C') -> list:
+    """
+    Roman Numerals from a list of figures or [figure, key] pairs, one beat each.
+    """
+    from music21 import roman
+    rns = []
+    offset = 0.0
+    for chord in chords:
+        figure, thisKey = (chord, key) if isinstance(chord, str) else chord
+        rn = roman.RomanNumeral(figure, thisKey)
+        rn.offset = offset
+        offset += rn.quarterLength
+        rns.append(rn)
+    return rns
+
+
+def resolvePath(path: str, root: str = None) -> str:
+    """
+    The file that a "path" request may read: path (relative to root, if not absolute)
+    after resolving any symbolic links, which must lie within root.
+
+    :raises PermissionError: if no root is set, or the file is outside it.
+    """
+    if root is None:
+        raise PermissionError('"path" requests are not allowed: start the server with a root directory.')
+    root = os.path.realpath(root)
+    fullPath = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, fullPath]) != root:
+        raise PermissionError(f'{path} is outside the root directory.')
+    return fullPath
+
+
+def isLoopback(host: str) -> bool:
+    """
+    True iff every address that host resolves to is a loopback address (i.e. the socket is local only).
+    """
+    if not host:  # All interfaces
+        return False
+    try:
+        addresses = {x[4][0] for x in socket.getaddrinfo(host, None)}
+    except socket.gaierror:
+        return False
+    return all(ipaddress.ip_address(x.split('%')[0]).is_loopback for x in addresses)
+
+
+def handleRequest(request: dict, root: str = None) -> dict:
+    """
+    Analyses one request (see the module documentation) and returns the response.
+
+    Never raises: any error is returned in the response.
+
+    :param root: the directory that "path" requests may read from (default: None, no path requests)
+    """
+    from . import annotationExport
+    from . import bassToFormFunction
+    response = {'id': request.get('id'), 'status': 'ok'}
+    try:
+        if 'path' in request:
+            from . import corpusRunner
+            analysis = bassToFormFunction.Analysis.fromPart(
+                corpusRunner.parseAnalysis(resolvePath(request['path'], root)))
+        elif 'romanText' in request:
+            from music21 import converter
+            analysis = bassToFormFunction.Analysis.fromPart(
+                converter.parse(request['romanText'], format='romantext'))
+        elif 'chords' in request:
+            analysis = bassToFormFunction.Analysis(
+                romanNumeralsFromChords(request['chords'], request.get('key', 'C')))
+        else:
+            raise ValueError('A request needs a "path", "romanText" or "chords".')
+
+        if request.get('segment'):
+            from . import segmentation
+            found = segmentation.formFunctionsFromSegments(
+                segmentation.segment(analysis.features), analysis.features)
+        else:
+            found = analysis.findFormFunctions()
+        if request.get('higherOrder'):
+            bassToFormFunction.generateHigherOrder(found)
+        response['chords'] = len(analysis.chords)
+        response['formFunctions'] = annotationExport.annotationRows(found, request.get('path', ''))
+    except Exception as e:  # Report, and carry on serving
+        response['status'] = 'error'
+        response['error'] = f'{type(e).__name__}: {e}'
+    return response
+
+
+class AnalysisServer:
+    """
+    A pool of warm workers handling requests concurrently.
+
+    :param workers: number of worker processes (default: one per core); 0 to handle requests in this process
+    :param tablesPath: a compiled table set to use in place of the built-in tables (see tableCompiler.py)
+    :param root: the directory that "path" requests may read from (default: None, no path requests)
+    """
+
+    def __init__(self, workers: int = None, tablesPath: str = None, root: str = None):
+        self.workers = workers
+        self.root = root
+        self.executor = None
+        if workers != 0:
+            self.executor = ProcessPoolExecutor(max_workers=workers, initializer=warmUp, initargs=(tablesPath,))
+        else:
+            warmUp(tablesPath)
+        self.startTime = time.time()
+        self.handled = 0
+        self.lock = threading.Lock()
+
+    def submit(self, request: dict, respond):
+        """
+        Handles a request (in the pool) and calls respond(response) when done.
+        """
+        op = request.get('op', 'analyse')
+        if op == 'ping':
+            respond({'id': request.get('id'), 'status': 'ok', 'op': 'ping'})
+            return
+        if op == 'stats':
+            respond({'id': request.get('id'), 'status': 'ok', 'op': 'stats', 'handled': self.handled,
+                     'workers': self.workers, 'uptime': round(time.time() - self.startTime, 3)})
+            return
+
+        def done(response):
+            with self.lock:
+                self.handled += 1
+            respond(response)
+
+        if self.executor is None:
+            done(handleRequest(request, self.root))
+        else:
+            future = self.executor.submit(handleRequest, request, self.root)
+            future.add_done_callback(lambda x: done(x.result() if not x.exception() else
+                                                    {'id': request.get('id'), 'status': 'error',
+                                                     'error': f'{type(x.exception()).__name__}: {x.exception()}'}))
+
+    def serveLines(self, inStream, outStream):
+        """
+        Serves JSON lines from inStream (e.g. stdin), writing responses to outStream, until inStream ends.
+        All responses are written before this returns.
+        """
+        writeLock = threading.Lock()
+        pending = []
+        allDone = threading.Condition()
+
+        def respond(response):
+            with writeLock:
+                outStream.write(json.dumps(response) + '\n')
+                outStream.flush()
+            with allDone:
+                pending.pop()
+                allDone.notify_all()
+
+        for line in inStream:
+            line = line.strip()
+            if not line:
+                continue
+            with allDone:
+                pending.append(None)
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError('A request must be a JSON object.')
+            except ValueError as e:
+                respond({'id': None, 'status': 'error', 'error': f'Bad request: {e}'})
+                continue
+            self.submit(request, respond)
+
+        with allDone:
+            allDone.wait_for(lambda: not pending)
+
+    def serveSocket(self, host: str = '127.0.0.1', port: int = 8765, allowRemote: bool = False):
+        """
+        Serves JSON lines over a local socket (each connection as in serveLines) until interrupted.
+        """
+        server = self.makeSocketServer(host, port, allowRemote)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+
+    def makeSocketServer(self, host: str = '127.0.0.1', port: int = 8765, allowRemote: bool = False):
+        """
+        The socket server for serveSocket.
+
+        :raises ValueError: if host is not a loopback address, unless allowRemote:
+            there is no authentication, so anyone who can connect can use the server.
+        """
+        if not allowRemote and not isLoopback(host):
+            raise ValueError(f'Refusing to serve on {host!r}, which is not local only (see allowRemote).')
+        analysisServer = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                reader = (x.decode('utf-8') for x in self.rfile)
+                writer = SocketWriter(self.wfile)
+                analysisServer.serveLines(reader, writer)
+
+        class _Server(socketserver.ThreadingTCPServer):  # Not the standard class itself, used elsewhere too
+            allow_reuse_address = True
+            daemon_threads = True
+
+        return _Server((host, port), Handler)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+class SocketWriter:
+    """
+    The text interface that serveLines writes to, for a socket's binary file.
+    """
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def write(self, text: str):
+        self.wfile.write(text.encode('utf-8'))
+
+    def flush(self):
+        self.wfile.flush()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Form function analysis server (JSON lines).')
+    parser.add_argument('-p', '--port', type=int, default=None,
+                        help='serve on this local port (default: stdin / stdout)')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='the host for --port (default: 127.0.0.1, i.e. local only)')
+    parser.add_argument('--allowRemote', action='store_true',
+                        help='allow a --host that is not local only (there is no authentication)')
+    parser.add_argument('-r', '--root', default=None,
+                        help='allow "path" requests for files in this directory (default: no path requests)')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='number of worker processes (default: one per core); 0 for none')
+    parser.add_argument('-t', '--tables', default=None,
+                        help='a compiled table set to use in place of the built-in tables (see tableCompiler.py)')
+    parsed = parser.parse_args(args)
+    if parsed.port is not None and not parsed.allowRemote and not isLoopback(parsed.host):
+        parser.error(f'--host {parsed.host} is not local only: add --allowRemote to serve on it anyway.')
+
+    server = AnalysisServer(parsed.workers, parsed.tables, parsed.root)
+    try:
+        if parsed.port is None:
+            server.serveLines(sys.stdin, sys.stdout)
+        else:
+            server.serveSocket(parsed.host, parsed.port, parsed.allowRemote)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+# ------------------------------------------------------------------------------
+
+class Test(unittest.TestCase):
+
+    requests = [{'id': 1, 'chords': ['I', 'IV64', 'I', 'V43', 'I6', 'IV', 'V7', 'I']},
+                {'id': 2, 'romanText': 'Time Signature: 4/4\n\nm1 C: I b2 V43 b3 I6 b4 ii6\nm2 V7 b3 I\n',
+                 'higherOrder': True},
+                {'id': 3, 'chords': [['i', 'a'], ['V43', 'a'], ['i6', 'a']], 'segment': True},
+                {'id': 4, 'chords': ['not a chord']},
+                {'id': 5, 'op': 'ping'}]
+
+    def check(self, responses):
+        responses = {x['id']: x for x in responses}
+        self.assertEqual(len(responses[1]['formFunctions']), 4)
+        self.assertEqual(responses[2]['formFunctions'][0]['phraseFunctionLabel'], 'Initial')
+        self.assertEqual([x['functionalLabel'] for x in responses[3]['formFunctions']],
+                         ['Tonic Prolongation with Passing'])
+        self.assertEqual(responses[4]['status'], 'error')
+        self.assertEqual(responses[5]['op'], 'ping')
+
+    def testLines(self):
+        import io
+        for workers in [0, 2]:
+            server = AnalysisServer(workers)
+            out = io.StringIO()
+            lines = [json.dumps(x) for x in self.requests] + ['', '[1, 2]']
+            server.serveLines(io.StringIO('\n'.join(lines) + '\n'), out)
+            server.close()
+            responses = [json.loads(x) for x in out.getvalue().splitlines()]
+            self.assertEqual(len(responses), 6)
+            self.check([x for x in responses if x['id']])
+            self.assertEqual(server.handled, 4)
+
+    def testSocket(self):
+        import socket
+        server = AnalysisServer(0)
+        socketServer = server.makeSocketServer('127.0.0.1', 0)
+        thread = threading.Thread(target=socketServer.serve_forever, daemon=True)
+        thread.start()
+        try:
+            with socket.create_connection(socketServer.server_address) as connection:
+                connection.sendall(''.join(json.dumps(x) + '\n' for x in self.requests).encode())
+                connection.shutdown(socket.SHUT_WR)
+                with connection.makefile('r') as f:
+                    self.check([json.loads(x) for x in f])
+        finally:
+            socketServer.shutdown()
+            socketServer.server_close()
+            server.close()
+        self.assertFalse(socketserver.ThreadingTCPServer.allow_reuse_address)
+
+    def testPaths(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as root:
+            os.mkdir(os.path.join(root, 'corpus'))
+            corpus = os.path.join(root, 'corpus')
+            with open(os.path.join(corpus, 'a.rntxt'), 'w') as f:
+                f.write(self.requests[1]['romanText'])
+            with open(os.path.join(root, 'secret.rntxt'), 'w') as f:
+                f.write(self.requests[1]['romanText'])
+
+            self.assertEqual(handleRequest({'path': 'a.rntxt'}, corpus)['status'], 'ok')
+            self.assertEqual(handleRequest({'path': os.path.join(corpus, 'a.rntxt')}, corpus)['status'], 'ok')
+            for path in ['../secret.rntxt', os.path.join(root, 'secret.rntxt')]:
+                response = handleRequest({'path': path}, corpus)
+                self.assertEqual(response['status'], 'error')
+                self.assertIn('PermissionError', response['error'])
+            self.assertIn('PermissionError', handleRequest({'path': 'a.rntxt'})['error'])
+            if hasattr(os, 'symlink'):
+                os.symlink(os.path.join(root, 'secret.rntxt'), os.path.join(corpus, 'link.rntxt'))
+                self.assertIn('PermissionError', handleRequest({'path': 'link.rntxt'}, corpus)['error'])
+
+    def testHosts(self):
+        for host in ['127.0.0.1', 'localhost', '::1']:
+            self.assertTrue(isLoopback(host))
+        for host in ['', '0.0.0.0', '::', '8.8.8.8']:
+            self.assertFalse(isLoopback(host))
+        server = AnalysisServer(0)
+        try:
+            with self.assertRaises(ValueError):
+                server.makeSocketServer('0.0.0.0', 0)
+        finally:
+            server.close()
+        import contextlib
+        import io
+        with self.assertRaises(SystemExit), contextlib.redirect_stderr(io.StringIO()):
+            main(['--port', '0', '--host', '0.0.0.0'])
+
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    main()
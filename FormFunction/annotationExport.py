@@ -0,0 +1,261 @@
+"""
+===============================
+Annotation Export (annotationExport.py)
+===============================
+
+
+LICENCE:
+===============================
+
+Creative Commons Attribution-ShareAlike 4.0 International License
+https://creativecommons.org/licenses/by-sa/4.0/
+
+
+ABOUT:
+===============================
+
+Exports the form functions found by an analysis as a table (one row per form function):
+start and end (chord indices and offsets), duration, labels, stream, type, pedal flag and bass pattern,
+and the higher order labels where there are any (see higherOrder.py).
+
+This comes straight from the analysis results (FormFunctionInPractice objects and their ChordRecords)
+so there is no need to write to a music21 score and read the results back out of its lyrics and slurs.
+
+Formats (by file extension):
+- .json: a list of rows (dicts);
+- .jsonl: one row (dict) per line;
+- .csv: a flat table;
+- .npz: columnar, one NumPy array per field, with the strings dictionary-encoded
+(an array of integer codes plus the categories), for quick corpus-wide aggregation;
+- .parquet: columnar too, if pyarrow is installed.
+
+"""
+
+# ------------------------------------------------------------------------------
+
+import csv
+import json
+import unittest
+
+import numpy as np
+
+from . import bassToFormFunction
+
+
+# ------------------------------------------------------------------------------
+
+exportFields = ['piece', 'start', 'end', 'startOffset', 'endOffset', 'duration',
+                'functionalLabel', 'shortLabel', 'prolMedCadStream', 'prolMedCadType',
+                'isPedal', 'bassScaleDegrees', 'phraseFunctionLabel', 'themeTypeLabel']
+
+stringFields = ['piece', 'functionalLabel', 'shortLabel', 'prolMedCadStream', 'prolMedCadType',
+                'bassScaleDegrees', 'phraseFunctionLabel', 'themeTypeLabel']
+
+columnTypes = {'start': np.int64,
+               'end': np.int64,
+               'startOffset': np.float64,
+               'endOffset': np.float64,
+               'duration': np.float64,
+               'isPedal': np.bool_}
+
+
+def annotationRow(f,
+                  piece: str = '',
+                  endPosition: int = None) -> dict:
+    """
+    One row of the table for one FormFunctionInPractice object.
+
+    Start and end are the indices of the first and last (uncondensed) chords;
+    the end offset is where that last chord ends, and the duration is the total of all the chords.
+
+    For a pedal point (which has no formFunctionInTheory of its own),
+    the stream and type come from the table entry for that pedal where there is one.
+
+    :param f: a bassToFormFunction.FormFunctionInPractice object
+    :param piece: the name of the piece (e.g. the path) for corpus-wide tables
+    :param endPosition: where the form function ends, as a position in its (uncondensed) chords,
+        if not at the last (e.g. before a trailing pedal point, as for the slurs: see annotationRows)
+    :return: dict with the exportFields
+    """
+    chords = f.uncondensedChords or f.chords
+    if endPosition is not None:
+        chords = chords[:endPosition + 1]
+    first, last = chords[0], chords[-1]
+    isPedal = 'Pedal' in f.functionalLabel
+    entry = f.formFunctionInTheory
+    if entry is None and isPedal:
+        entry = bassToFormFunction.pedalEntry(first.bassScaleDegree)
+    return {'piece': piece,
+            'start': first.index,
+            'end': last.index,
+            'startOffset': float(first.offset),
+            'endOffset': float(last.offset + last.quarterLength),
+            'duration': float(sum(x.quarterLength for x in chords)),
+            'functionalLabel': f.functionalLabel,
+            'shortLabel': entry.shortLabel if entry else '',
+            'prolMedCadStream': entry.prolMedCadStream if entry else '',
+            'prolMedCadType': entry.prolMedCadType if entry else '',
+            'isPedal': isPedal,
+            'bassScaleDegrees': '-'.join(str(x) for x in f.bassScaleDegrees),
+            'phraseFunctionLabel': f.phraseFunctionLabel or '',
+            'themeTypeLabel': f.themeTypeLabel or ''}
+
+
+def annotationRows(allFFInPractice: list,
+                   piece: str = '') -> list:
+    """
+    The table for a list of FormFunctionInPractice objects (e.g. Analysis.allFFInPractice),
+    in order of their start.
+
+    Each ends where its slur in the score does (see bassToFormFunction.ScoreAnnotations),
+    i.e. before any trailing pedal point.
+    """
+    rows = []
+    for index, f in enumerate(allFFInPractice):
+        trailingPedal = bassToFormFunction.trailingPedalPoint(allFFInPractice, index)
+        rows.append(annotationRow(f, piece, trailingPedal if trailingPedal != -1 else None))
+    return sorted(rows, key=lambda x: (x['start'], x['end']))
+
+
+# ------------------------------------------------------------------------------
+
+def toColumns(rows: list) -> dict:
+    """
+    Turns a list of rows into columns: a NumPy array for each of the exportFields
+    (strings as object arrays).
+    """
+    columns = {}
+    for field in exportFields:
+        values = [row[field] for row in rows]
+        columns[field] = np.array(values, dtype=columnTypes.get(field, object))
+    return columns
+
+
+def encodeStrings(values: np.ndarray) -> tuple:
+    """
+    Dictionary-encodes an array of strings as (codes, categories)
+    such that categories[codes] gives back the values
+    (with any None as '', as in CSV, not the string 'None').
+    """
+    values = np.array(['' if x is None else str(x) for x in values], dtype=str)
+    categories, codes = np.unique(values, return_inverse=True)
+    return codes.astype(np.int32), categories
+
+
+def writeAnnotations(rows: list,
+                     path: str):
+    """
+    Writes rows (from annotationRows) to a file, in the format given by its extension
+    (.json, .jsonl, .csv, .npz or .parquet).
+    """
+    lowerPath = path.lower()
+    if lowerPath.endswith('.jsonl'):
+        with open(path, 'w') as f:
+            for row in rows:
+                f.write(json.dumps(row) + '\n')
+    elif lowerPath.endswith('.json'):
+        with open(path, 'w') as f:
+            json.dump(rows, f, indent=1)
+    elif lowerPath.endswith('.csv'):
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=exportFields)
+            writer.writeheader()
+            writer.writerows(rows)
+    elif lowerPath.endswith('.npz'):
+        arrays = {}
+        for field, values in toColumns(rows).items():
+            if field in stringFields:
+                arrays[field], arrays[field + '.categories'] = encodeStrings(values)
+            else:
+                arrays[field] = values
+        np.savez_compressed(path, **arrays)
+    elif lowerPath.endswith('.parquet'):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError('Writing .parquet needs pyarrow: use .npz for a columnar file without it.')
+        table = pyarrow.table({field: [row[field] for row in rows] for field in exportFields})
+        pyarrow.parquet.write_table(table, path)
+    else:
+        raise ValueError(f'Unknown format for {path}: use .json, .jsonl, .csv, .npz or .parquet.')
+
+
+def readColumns(path: str) -> dict:
+    """
+    Reads a columnar file (.npz or .parquet) back as a dict of NumPy arrays,
+    with any dictionary-encoded strings decoded.
+    """
+    if path.lower().endswith('.parquet'):
+        import pyarrow.parquet
+        table = pyarrow.parquet.read_table(path)
+        return {field: table.column(field).to_numpy(zero_copy_only=False) for field in table.column_names}
+    with np.load(path) as data:
+        columns = {}
+        for field in exportFields:
+            if field in stringFields:
+                columns[field] = data[field + '.categories'][data[field]]
+            else:
+                columns[field] = data[field]
+    return columns
+
+
+# ------------------------------------------------------------------------------
+
+class Test(unittest.TestCase):
+
+    def testExport(self):
+        import os
+        import tempfile
+        from music21 import roman
+
+        rns = [roman.RomanNumeral(x) for x in ['I', 'IV64', 'I', 'V43', 'I6', 'IV', 'V7', 'I']]
+        for offset, rn in enumerate(rns):
+            rn.offset = offset
+        analysis = bassToFormFunction.Analysis(rns)
+        rows = annotationRows(analysis.findFormFunctions(), 'test')
+        self.assertEqual([(x['start'], x['end'], x['shortLabel'], x['isPedal']) for x in rows],
+                         [(0, 2, 'T-P', True), (0, 4, 'T-P', False), (4, 7, 'Cad-Cade', False),
+                          (5, 7, 'Cad-Cade', False)])
+        self.assertEqual((rows[1]['startOffset'], rows[1]['endOffset'], rows[1]['duration']), (0, 5, 5))
+        self.assertEqual(rows[0]['prolMedCadType'], 'Pedal')
+        self.assertEqual(rows[1]['bassScaleDegrees'], '1-2-3')
+
+        with tempfile.TemporaryDirectory() as tempDir:
+            for extension in ['json', 'jsonl', 'csv', 'npz']:
+                writeAnnotations(rows, os.path.join(tempDir, 'test.' + extension))
+            with open(os.path.join(tempDir, 'test.json')) as f:
+                self.assertEqual(json.load(f), rows)
+            with open(os.path.join(tempDir, 'test.csv')) as f:
+                self.assertEqual(len(list(csv.DictReader(f))), 4)
+
+            columns = readColumns(os.path.join(tempDir, 'test.npz'))
+            self.assertEqual(columns['functionalLabel'].tolist(), [x['functionalLabel'] for x in rows])
+            self.assertEqual(columns['isPedal'].tolist(), [True, False, False, False])
+            self.assertEqual(columns['duration'].sum(), 5 + 3 + 4 + 3)
+
+            self.assertEqual(rows[3]['prolMedCadType'], None)  # The 'None Cadential Progression'
+            self.assertEqual(columns['prolMedCadType'].tolist()[3], '')  # As in CSV, not 'None'
+
+            self.assertRaises(ValueError, writeAnnotations, rows, os.path.join(tempDir, 'test.txt'))
+
+    def testTrailingPedal(self):
+        """
+        Each row ends where its slur does: before a trailing pedal point.
+        """
+        from music21 import roman
+        from . import benchmark
+        figures = benchmark.syntheticFigures(300, patternDensity=0.6, repeatProbability=0.4, seed=8)
+        found = bassToFormFunction.Analysis([roman.RomanNumeral(x) for x in figures]).findFormFunctions()
+        slurs = bassToFormFunction.ScoreAnnotations.fromFormFunctions(found, len(figures)).slurs
+        rows = annotationRows(found)
+        self.assertEqual(sorted((x['start'], x['end'], x['functionalLabel']) for x in rows if not x['isPedal']),
+                         sorted((x.start, x.end, x.functionalLabel) for x in slurs))
+        untruncated = sorted((x['start'], x['end']) for x in (annotationRow(f) for f in found))
+        self.assertNotEqual(sorted((x['start'], x['end']) for x in rows), untruncated)
+
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    unittest.main()
@@ -19,15 +19,39 @@ ABOUT:
 Produces a plausible form functional analysis (first order only)
 given only a harmonic analysis alone (not even the score).
 
+music21 is only imported for reading a Part (Analysis.fromPart) and writing in the score,
+so the analysis itself runs without it given the features (e.g. from a cache or FeatureTable.fromArrays).
+
+Run the tests with either
+python -m unittest FormFunction.bassToFormFunction  # from the directory above this one
+python bassToFormFunction.py  # as a script (not supported by most modules: see __init__.py)
+
 """
 
 # ------------------------------------------------------------------------------
 
-from music21 import roman, spanner, stream
+from __future__ import annotations
+
+from collections import namedtuple, OrderedDict
+import typing as t
 import unittest
-from itertools import groupby
+import warnings
+
+import numpy as np
+
+if __package__ in (None, ''):  # Run as a script: import the rest of the package from the directory above
+    import os
+    import sys
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    __package__ = 'FormFunction'
+
+from . import featureTable
+from . import formFunctionTables
+from . import higherOrder
+from . import profiling
 
-import formFunctionTables
+if t.TYPE_CHECKING:
+    from music21 import roman, spanner, stream
 
 
 # ------------------------------------------------------------------------------
@@ -38,22 +62,43 @@ class FormFunctionInPractice(formFunctionTables.FormFunctionInTheory):
 
     This FormFunctionInPractice class works with an actual manifestation
     in the practice of a specific harmonic analysis.
+
+    The chords are featureTable.ChordRecord objects (not music21 RomanNumerals)
+    so these objects are light and quick to send between processes.
+    RomanNumerals are accepted too, and converted to records
+    (with no position in a piece, so not for writing back to the score: see chordIndex).
+
+    Optionally, a WindowCache looks up the classification (and figures) of windows seen before.
     """
 
-    def __init__(self, rns: list):
-        self.rns = rns
-        self.bassScaleDegrees = [x.bassScaleDegreeFromNotation() for x in rns]
-        self.figures = [x.figuresNotationObj.numbers for x in rns]
+    def __init__(self,
+                 chords: list,
+                 windowCache: WindowCache = None):
+        self.chords = [x if isinstance(x, featureTable.ChordRecord)
+                       else featureTable.ChordRecord.fromRomanNumeral(x)
+                       for x in chords]
+        self.bassScaleDegrees = [x.bassScaleDegree for x in self.chords]
         # NB: self.functionalLabel from self.formFunctionInTheory.functionalLabel
-        self.index = -1
-        self.uncondensedRns = []
+        self.index = None  # The position of the first chord in the piece, once placed there (see Analysis)
+        self.uncondensedChords = []
         self.formFunctionInTheory = None
-        self.getFormalFunction()
+        if windowCache is None:
+            self.figures = [x.figures for x in self.chords]
+            self.getFormalFunction()
+        else:
+            self.formFunctionInTheory, figures = windowCache.lookup(self.bassScaleDegrees,
+                                                                    [x.figureMask for x in self.chords])
+            self.figures = list(figures)
         self.functionalLabel = None
         if self.formFunctionInTheory:
             self.functionalLabel = self.formFunctionInTheory.functionalLabel
         self.pedalPoint = None
 
+        # 2nd and 3rd order (see higherOrder.py)
+        self.phraseFunctionLabel = None  # ['Initial', 'Medial', 'Cadential', None]
+        self.themeFunctionLabel = None  # ['Theme', None]
+        self.themeTypeLabel = None  # ['Sentence', 'Period', 'Hybrid', None]
+
         self.duration = None
         if self.formFunctionInTheory:
             self.getDuration()
@@ -62,31 +107,384 @@ class FormFunctionInPractice(formFunctionTables.FormFunctionInTheory):
         """
         Assesses a group of 3 or 4 harmonies and
         compares it with the function.
+
+        Candidates come from formFunctionTables.lookupIndex (keyed by the bass scale degrees),
+        so only the entries that share this bass pattern have their requiredFigures checked.
+        Where more than one entry fits, the later one in the tables wins.
+        """
+        # NB: any other number of RNs simply has no candidates.
+        self.formFunctionInTheory = formFunctionTables.selectFormFunctionByMasks(
+            formFunctionTables.lookupIndex.get(tuple(self.bassScaleDegrees), []),
+            [x.figureMask for x in self.chords])
+
+    def getDuration(self):
+        self.duration = sum([x.quarterLength for x in self.chords])
+
+    @property
+    def rns(self) -> list:
+        """
+        Deprecated: the (condensed) chords, now ChordRecords, as self.chords.
+        """
+        warnings.warn('FormFunctionInPractice.rns is deprecated: use .chords (ChordRecords)',
+                      DeprecationWarning, stacklevel=2)
+        return self.chords
+
+    @property
+    def uncondensedRns(self) -> list:
+        """
+        Deprecated: all the chords covered, now ChordRecords, as self.uncondensedChords.
+        """
+        warnings.warn('FormFunctionInPractice.uncondensedRns is deprecated: use .uncondensedChords (ChordRecords)',
+                      DeprecationWarning, stacklevel=2)
+        return self.uncondensedChords
+
+    @uncondensedRns.setter
+    def uncondensedRns(self, chords: list):
+        warnings.warn('FormFunctionInPractice.uncondensedRns is deprecated: use .uncondensedChords (ChordRecords)',
+                      DeprecationWarning, stacklevel=2)
+        self.uncondensedChords = chords
+
+
+class Analysis:
+    """
+    One form function analysis of one harmonic analysis.
+
+    Owns everything found along the way
+    (the FormFunctionInPractice objects, and the check for duplicates among them)
+    and writes it back to the score at the end,
+    so any number of pieces can be analysed independently (e.g. in separate threads or processes).
+
+    The analysis itself runs on featureTable.ChordRecord objects (self.chords),
+    so the music21 objects (rns and part) are only needed for writing in the score,
+    and can be left out entirely given the features (e.g. from a featureCache.FeatureCache).
+
+    Pass a profiling.Profile to time each stage and count windows, matches, etc.
+
+    Typical use:
+    >>> analysis = Analysis.fromPart(part)  # doctest: +SKIP
+    >>> analysis.findFormFunctions()  # doctest: +SKIP
+    >>> analysis.writeInScore()  # doctest: +SKIP
+    """
+
+    def __init__(self,
+                 rns: list = None,
+                 part: stream.Part = None,
+                 features: featureTable.FeatureTable = None,
+                 profile: profiling.Profile = None,
+                 windowCache: WindowCache = None):
+        """
+        :param rns: list of Roman Numerals (only needed for writing in the score, or in place of features)
+        :param part: the stream.Part that those Roman Numerals are in (only needed for writing slurs)
+        :param features: the FeatureTable of those Roman Numerals if already made (e.g. from a cache)
+        :param profile: optional, a profiling.Profile to record in
+        :param windowCache: optional, a WindowCache to share with other analyses (e.g. over a corpus run)
         """
+        if rns is None and features is None:
+            raise ValueError('An Analysis needs either the rns or their features.')
+        self.rns = rns
+        self.part = part
+        self.profile = profile if profile is not None else profiling.nullProfile
+        self.windowCache = windowCache
+        if features is None:
+            with self.profile.stage('features'):
+                features = featureTable.FeatureTable(rns)
+        self.features = features
+        self.chords = self.features.records()
+        with self.profile.stage('pedal'):
+            self.pedalPoints = findAllPedalPoints(self.features)
+        self.allFFInPractice = []
+        # Indexes of allFFInPractice for existsInFormFunctionList (kept up to date by addFormFunction)
+        self.foundLabels = set()  # (index, functionalLabel)
+        self.pedalSpans = SpanIndex(len(self.chords))
+
+    @classmethod
+    def fromPart(cls,
+                 part: stream.Part,
+                 features: featureTable.FeatureTable = None,
+                 profile: profiling.Profile = None,
+                 windowCache: WindowCache = None):
+        """
+        Makes an Analysis from all the Roman Numerals in a stream.Part (or Score).
+        """
+        from music21 import roman, stream
+        rns = list(part.flatten().getElementsByClass(roman.RomanNumeral))
+        if isinstance(part, stream.Score):
+            part = part.parts[0]
+        return cls(rns, part, features, profile, windowCache)
+
+    def findFormFunctions(self) -> list:
+        """
+        Runs the form function analysis:
+        tries a window of 3 and then 4 bass notes from each change of bass,
+        and keeps every match to the tables along with any pedal points in those windows.
 
-        if len(self.rns) == 3:
-            data = formFunctionTables.global3
-        elif len(self.rns) == 4:
-            data = formFunctionTables.global4
+        :return: the list of FormFunctionInPractice objects found (also self.allFFInPractice)
+        """
+        if self.windowCache is not None:
+            hits, misses = self.windowCache.hits, self.windowCache.misses
+        for startIndex in self.features.runStarts.tolist():
+            for f in self.formFunctionsFrom(startIndex):
+                self.addFormFunction(f)
+        if self.windowCache is not None:
+            self.profile.count('windowCacheHits', self.windowCache.hits - hits)
+            self.profile.count('windowCacheMisses', self.windowCache.misses - misses)
+        return self.allFFInPractice
+
+    def formFunctionsFrom(self, startIndex: int) -> list:
+        """
+        The candidate form functions from the windows (of 3 and 4 bass notes) starting at startIndex:
+        the labelled window matches and any pedal points, in order, before removing any repeats.
+
+        :param startIndex: the index of the first chord of a bass run
+        :return: list of FormFunctionInPractice objects
+        """
+        out = []
+        for listLength in (3, 4):
+            with self.profile.stage('reduce'):  # NB: the pedal points are looked up, not found again
+                condensedChords, nextIndex, pedalPointsList = reduceRnsToLengthX(
+                    self.chords, listLength, startIndex, self.features, self.pedalPoints)
+            if len(condensedChords) == listLength:
+                self.profile.count('windows')
+                out.append(self.makeFormFunction(startIndex, nextIndex - 1, None, condensedChords))
+            else:
+                self.profile.count('windowsShort')  # At the end of the piece
+            self.profile.count('pedalPoints', len(pedalPointsList))
+            for pedalStart, pedalEnd in pedalPointsList:
+                out.append(self.makeFormFunction(pedalStart, pedalEnd,
+                                                 pedalLabel(self.chords[pedalStart].bassScaleDegree),
+                                                 [self.chords[pedalStart]]))
+        return [f for f in out if f is not None]
+
+    def appendFormFunction(self,
+                           start: int,
+                           end: int,
+                           label: str,
+                           condensedChords: list):
+        """
+        Appends a FormFunctionInPractice Object,
+        built from the condensedChords,
+        to self.allFFInPractice
+        unless it has no label, or is already there.
+
+        :param start: startIndex in List of to build FFIP
+        :param end: endIndex in List of to build FFIP
+        :param label: label that will be assigned to FFIP
+        :param condensedChords: collapsed chords (ChordRecords from self.chords)
+        :return: the new FormFunctionInPractice object, or None if it was not appended
+        """
+        f = self.makeFormFunction(start, end, label, condensedChords)
+        if f is None:
+            return None
+        return self.addFormFunction(f)
+
+    def makeFormFunction(self,
+                         start: int,
+                         end: int,
+                         label: str,
+                         condensedChords: list):
+        """
+        Builds a FormFunctionInPractice Object from the condensedChords (see appendFormFunction).
+
+        :return: the new FormFunctionInPractice object, or None if it has no label
+        """
+        with self.profile.stage('match'):
+            f = FormFunctionInPractice(condensedChords, self.windowCache)
+        if len(condensedChords) != end - start + 1:
+            f.uncondensedChords = self.chords[start:(end + 1)]
+        else:
+            f.uncondensedChords = f.chords
+        f.index = start
+        if label:
+            f.functionalLabel = label
         else:
-            data = []  # TODO shouldn't happen: raise ValueError('Invalid number of RNs.')
-
-        for thisFormFunctionInTheory in data:
-            if thisFormFunctionInTheory.bassScaleDegrees == self.bassScaleDegrees:
-                counter = 0
-                found = True
-                for fig in thisFormFunctionInTheory.requiredFigures:
-                    if fig and fig not in self.figures[counter]:
-                        found = False
-                    counter += 1
-                if found:
-                    self.formFunctionInTheory = thisFormFunctionInTheory
+            self.profile.recordCandidates(
+                formFunctionTables.lookupIndex.get(tuple(f.bassScaleDegrees), []),
+                f.formFunctionInTheory,
+                [x.figureMask for x in f.chords])
+        if not f.functionalLabel:
+            self.profile.count('unmatched')
+            return None
+        return f
+
+    def addFormFunction(self, f: FormFunctionInPractice):
+        """
+        Appends a FormFunctionInPractice Object to self.allFFInPractice unless it is already there.
 
-    def getDuration(self):
-        self.duration = sum([x.quarterLength for x in self.rns])
+        :return: f, or None if it was not appended
+        """
+        with self.profile.stage('dedup'):
+            exists = self.existsInFormFunctionList(f)
+        if exists:
+            self.profile.count('dedupRejections')
+            return None
+        self.profile.count('formFunctions')
+        self.allFFInPractice.append(f)
+        self.foundLabels.add((f.index, f.functionalLabel))
+        if 'Pedal' in f.functionalLabel:
+            self.pedalSpans.add(f.index, f.index + len(f.uncondensedChords))
+        return f
+
+    def existsInFormFunctionList(self, f: FormFunctionInPractice) -> bool:
+        """
+        Returns True iff
+        a given FormFunctionInPractice Object is contained
+        in self.allFFInPractice,
+        i.e. there is one with the same index and label,
+        or it is a pedal point lying within another pedal point already found (see SpanIndex).
+
+        Both checks are made on indexes (a set and a SpanIndex), not by scanning the list,
+        so the cost per check does not grow with the number of form functions found.
+
+        :param f: a FormFunctionInPractice object
+        :return: bool
+        """
+        if (f.index, f.functionalLabel) in self.foundLabels:
+            return True
+        if 'Pedal' in f.functionalLabel:
+            return self.pedalSpans.contains(f.index, f.index + len(f.uncondensedChords))
+        return False
+
+    def writeInScore(self, mutate: bool = True):
+        """
+        Writes everything found (slurs, Labels) to the score,
+        with `*Medial?*` on anything unassigned.
+
+        All the slurs and lyrics are collected first (see ScoreAnnotations)
+        and then written in one go (see applyAnnotations).
+
+        :param mutate: if False, leave the score alone and just return the annotations
+            (which needs neither the rns nor the part)
+        :return: the ScoreAnnotations
+        """
+        if mutate and (self.rns is None or self.part is None):
+            raise ValueError('Writing in the score needs the rns and part.')
+        with self.profile.stage('write'):
+            annotations = ScoreAnnotations.fromFormFunctions(self.allFFInPractice, len(self.chords))
+            if mutate:
+                applyAnnotations(annotations, self.part, self.rns)
+        self.profile.count('slurs', len(annotations.slurs))
+        return annotations
+
+
+def pedalLabel(bassScaleDegree: int) -> str:
+    """
+    The label for a pedal point on a given bass scale degree:
+    that of the corresponding pedal prolongation in the tables if there is one, otherwise 'Pedal'.
+
+    :param bassScaleDegree: the bass scale degree of the pedal
+    :return: str
+    """
+    entry = pedalEntry(bassScaleDegree)
+    return entry.functionalLabel if entry else 'Pedal'
+
+
+def pedalEntry(bassScaleDegree: int):
+    """
+    The table entry for a pedal prolongation on a given bass scale degree, or None if there is none.
+    """
+    for entry in formFunctionTables.lookupIndex.get((bassScaleDegree,) * 3, []):
+        if entry.prolMedCadType == 'Pedal':
+            return entry
+    return None
+
+
+def chordIndex(chord: featureTable.ChordRecord) -> int:
+    """
+    The position of a chord in its piece, for writing back to the score.
+
+    Raises a ValueError for a record with no position
+    (e.g. from a FormFunctionInPractice made from RomanNumerals directly),
+    rather than silently writing to the wrong chord.
+    """
+    if chord.index is None:
+        raise ValueError(f'{chord} has no position in a piece to write back to: '
+                         'use the ChordRecords of the piece (e.g. Analysis.chords).')
+    return chord.index
+
+
+SlurAnnotation = namedtuple('SlurAnnotation', ['start', 'end', 'prolongationOrCadence', 'functionalLabel'])
+
+
+class ScoreAnnotations:
+    """
+    Everything to be written in the score for a list of form functions, as plain data:
+    the slurs (as SlurAnnotations, with start and end chord indices)
+    and, for each chord, whether it is assigned to any form function and the labels that start on it.
+
+    This is the same as what writeAllInformationInAnalysis writes one form function at a time
+    (after fillScoreWithMedial), but collected first, so it can be written to the score in one go
+    (applyAnnotations), or not written at all.
+    """
+
+    def __init__(self, numberOfChords: int):
+        self.slurs = []
+        self.assigned = [False] * numberOfChords
+        self.labels = [[] for _ in range(numberOfChords)]
 
+    @classmethod
+    def fromFormFunctions(cls,
+                          allFFInPractice: list,
+                          numberOfChords: int):
+        """
+        Collects the annotations for a list of FormFunctionInPractice objects
+        (as in writeInformationInScore, including the trailing pedal point case).
+        Any labelled 'Medial' are explicit gaps, labelled as such, not with the `*Medial?*` proxy.
+
+        :param allFFInPractice: a list of FormFunctionInPractice objects
+        :param numberOfChords: the number of chords in the analysis
+        """
+        annotations = cls(numberOfChords)
+        for index, f in enumerate(allFFInPractice):
+            trailingPedal = trailingPedalPoint(allFFInPractice, index)
+            end = trailingPedal if trailingPedal != -1 else len(f.uncondensedChords) - 1
+            if f.formFunctionInTheory:
+                start = chordIndex(f.uncondensedChords[0])
+                label = f.formFunctionInTheory.functionalLabel
+                annotations.slurs.append(SlurAnnotation(start,
+                                                        chordIndex(f.uncondensedChords[end]),
+                                                        f.formFunctionInTheory.prolMedCadStream,
+                                                        label))
+                annotations.labels[start].append(label)
+            elif f.functionalLabel == 'Medial':  # An explicit gap (see segmentation.py)
+                annotations.labels[chordIndex(f.uncondensedChords[0])].append('Medial')
+            for chord in f.uncondensedChords:
+                annotations.assigned[chordIndex(chord)] = True
+        return annotations
+
+    def lyrics(self, index: int) -> list:
+        """
+        The lyrics for one chord:
+        `*Medial?*` (or nothing, if assigned) on the first line, then any labels.
+        """
+        return ['' if self.assigned[index] else '*Medial?*'] + self.labels[index]
+
+
+def applyAnnotations(annotations: ScoreAnnotations,
+                     thisPart: stream.Part,
+                     rns: list):
+    """
+    Writes ScoreAnnotations to the score:
+    the lyrics on each Roman Numeral (in addition to any already there),
+    and all the slurs in the part with a single update of the stream
+    (rather than a Part.insert, and so a re-sort, for each).
+
+    :param annotations: the ScoreAnnotations
+    :param thisPart: analysis (stream.Part object)
+    :param rns: the Roman Numerals of the analysis (in the order of the ChordRecord indices)
+    :return:
+    """
+    slurs = [makeSlur(rns[x.start], rns[x.end], x.prolongationOrCadence) for x in annotations.slurs]
+
+    for index, rn in enumerate(rns):
+        for lyric in annotations.lyrics(index):
+            rn.addLyric(lyric)
 
-allFFInPractice = []
+    if slurs:
+        for sl in slurs:
+            thisPart.coreGuardBeforeAddElement(sl)
+            thisPart.coreInsert(0.0, sl, ignoreSort=True)
+        thisPart.coreElementsChanged()
+        thisPart.isSorted = False
 
 
 def fillScoreWithMedial(rns: list):
@@ -102,7 +500,8 @@ def fillScoreWithMedial(rns: list):
 
 
 def writeAllInformationInAnalysis(allFFInPractice: list,
-                                  analysis: stream.Part):
+                                  analysis: stream.Part,
+                                  rns: list):
     """
     Writes all information (slurs, Labels) 
     of a given List of FormFunctionsInPractice 
@@ -110,54 +509,60 @@ def writeAllInformationInAnalysis(allFFInPractice: list,
 
     :param allFFInPractice: a list of to write FormFunctionInPractice objects
     :param analysis: analysis (stream.Part object)
+    :param rns: the Roman Numerals of the analysis (in the order of the ChordRecord indices)
     :return:
     """
     for index in range(len(allFFInPractice)):
-        writeInformationInScore(allFFInPractice, index, analysis)
+        writeInformationInScore(allFFInPractice, index, analysis, rns)
 
 
 def writeInformationInScore(allFFInPractice: list,
                             index: int,
-                            analysis: stream.Part):
+                            analysis: stream.Part,
+                            rns: list):
     """
     Writes slur and Label for one given (index) FormFunctionInPractice in a given analysis
 
     :param allFFInPractice: a list of FormFunctionInPractice objects to write
     :param index: index of a FormFunctionObject in the List
     :param analysis: analysis (stream.Part object)
+    :param rns: the Roman Numerals of the analysis (in the order of the ChordRecord indices)
     :return:
     """
     trailingPedal = trailingPedalPoint(allFFInPractice, index)
 
     if trailingPedal != -1:
         # if there is a Trailing Pedal Point it will be the next FormFunction in the List
-        rnStart = allFFInPractice[index].uncondensedRns[0]
-        rnEnd = allFFInPractice[index].uncondensedRns[trailingPedal]
+        rnStart = rns[chordIndex(allFFInPractice[index].uncondensedChords[0])]
+        rnEnd = rns[chordIndex(allFFInPractice[index].uncondensedChords[trailingPedal])]
         if allFFInPractice[index].formFunctionInTheory:
             prolOrCad = allFFInPractice[index].formFunctionInTheory.prolMedCadStream
             insertSlur(analysis, rnStart, rnEnd, prolOrCad)
             lyricAdd(rnStart, allFFInPractice[index].formFunctionInTheory.functionalLabel)
     else:
-        rnStart = allFFInPractice[index].uncondensedRns[0]
-        rnEnd = allFFInPractice[index].uncondensedRns[
-            len(allFFInPractice[index].uncondensedRns) - 1]
+        rnStart = rns[chordIndex(allFFInPractice[index].uncondensedChords[0])]
+        rnEnd = rns[chordIndex(allFFInPractice[index].uncondensedChords[
+            len(allFFInPractice[index].uncondensedChords) - 1])]
 
         if allFFInPractice[index].formFunctionInTheory:
             prolOrCad = allFFInPractice[index].formFunctionInTheory.prolMedCadStream
             insertSlur(analysis, rnStart, rnEnd, prolOrCad)
             lyricAdd(rnStart, allFFInPractice[index].formFunctionInTheory.functionalLabel)
 
-    removeTrailingMedialLyric(allFFInPractice[index])
+    removeTrailingMedialLyric(allFFInPractice[index], rns)
 
 
-def removeTrailingMedialLyric(formFunctionInPracticeObject: FormFunctionInPractice):
+def removeTrailingMedialLyric(formFunctionInPracticeObject: FormFunctionInPractice,
+                              rns: list):
     """
     Removes all '*Medial?*' Labels of a given FormFunctionInPractice from the analysis
 
     :param formFunctionInPracticeObject: FormFunctionInPractice Object
+    :param rns: the Roman Numerals of the analysis (in the order of the ChordRecord indices)
     :return:
     """
-    for rn in formFunctionInPracticeObject.uncondensedRns:
+    for chord in formFunctionInPracticeObject.uncondensedChords:
+        rn = rns[chordIndex(chord)]
         if '*Medial?*' in rn.lyric:
             rn.lyric = rn.lyric.replace('*Medial?*', '')
 
@@ -194,9 +599,9 @@ def trailingPedalPoint(allFFInPractice: list,
 
     currentRns = allFFInPractice[indexOfAll]
     potentialPedalPoint = allFFInPractice[indexOfAll + 1]
-    endIndexOfToBeTestedRns = len(currentRns.uncondensedRns) + currentRns.index
+    endIndexOfToBeTestedRns = len(currentRns.uncondensedChords) + currentRns.index
     endIndexOfPotentialPedalPoint = len(
-        potentialPedalPoint.uncondensedRns) + potentialPedalPoint.index
+        potentialPedalPoint.uncondensedChords) + potentialPedalPoint.index
 
     # Pedal Point is at the End of a larger FormFunctionInPractice -> trailing
     if (endIndexOfToBeTestedRns == endIndexOfPotentialPedalPoint) and \
@@ -205,70 +610,121 @@ def trailingPedalPoint(allFFInPractice: list,
     return -1
 
 
-def appendFormFunction(rns: list,
-                       start: int,
-                       end: int,
-                       label: str,
-                       condensedRns):
+class SpanIndex:
     """
-    Appends a FormFunctionInPractice Object, 
-    built from the condensedRns, 
-    to the global list allFFInPractice.
+    Records spans (start, end) over a sequence of a known length,
+    and answers whether a new span is contained within any of those recorded.
 
-    :param rns: list of Roman Numerals
-    :param start: startIndex in List of to build FFIP
-    :param end: endIndex in List of to build FFIP
-    :param label: label that will be assigned to FFIP
-    :param condensedRns: collapsed Roman Numerals
-    :return:
+    This is a Fenwick (binary indexed) tree over the start positions
+    which keeps the furthest end of any span starting at or before each position:
+    a span is contained iff that furthest end reaches its end.
+    Adding and checking are both O(log n).
     """
-    f = FormFunctionInPractice(condensedRns)
-    if len(condensedRns) != end - start + 1:
-        f.uncondensedRns = rns[start:(end + 1)]
-    else:
-        f.uncondensedRns = f.rns
-    f.index = start
-    if label:
-        f.functionalLabel = label
-    if not existsInFormFunctionList(f):
-        allFFInPractice.append(f)
 
+    def __init__(self, size: int):
+        self.size = size
+        self.tree = [-1] * (size + 1)
 
-def existsInFormFunctionList(f: FormFunctionInPractice) -> bool:
-    """
-    Returns True iff
-    a given FormFunctionInPractice Object is contained
-    in the global List allFFInPractice.
+    def add(self, start: int, end: int):
+        """
+        Records the span from start to end.
+        """
+        position = start + 1
+        while position <= self.size:
+            if end > self.tree[position]:
+                self.tree[position] = end
+            position += position & -position
 
-    :param f: a FormFunctionInPractice object
-    :return: bool
-    """
-    for formFunction in allFFInPractice:
-        if pedalPointInPedalPoint(f, formFunction):
-            return True
-        if formFunction.index == f.index:
-            if f.functionalLabel == formFunction.functionalLabel:
-                return True
-    return False
+    def furthestEnd(self, start: int) -> int:
+        """
+        The furthest end of any recorded span which starts at or before `start` (-1 if none).
+        """
+        position = min(start + 1, self.size)
+        furthest = -1
+        while position > 0:
+            if self.tree[position] > furthest:
+                furthest = self.tree[position]
+            position -= position & -position
+        return furthest
+
+    def contains(self, start: int, end: int) -> bool:
+        """
+        True iff the span from start to end is within any recorded span.
+        """
+        return self.furthestEnd(start) >= end
 
 
-def pedalPointInPedalPoint(fNew: FormFunctionInPractice, fOld: FormFunctionInPractice):
+class WindowCache:
     """
-    If a pedal Point is contained in another PedalPoint (probably never) return true
-    else false
+    A bounded least-recently-used cache of window classifications:
+    from the bass scale degrees and figure masks of a window
+    to the FormFunctionInTheory it matches (or None) and the figures of its chords.
 
-    :param fNew: a FormFunctionInPractice object
-    :param fOld: a FormFunctionInPractice object
-    :return:
+    The same windows come up again and again across the pieces of a corpus,
+    so one cache is best kept for a whole run (see corpusRunner.py: one per worker process).
+    It starts again by itself whenever the tables change
+    (a new formFunctionTables.lookupIndex or tablesVersion, e.g. from formFunctionTables.refreshTables).
+
+    :param maxSize: the most windows to keep (the least recently used go first)
     """
-    if 'Pedal' in fNew.functionalLabel and 'Pedal' in fOld.functionalLabel:
-        startOldFormFunction = fOld.index
-        endOLdFormFunction = fOld.index + len(fOld.uncondensedRns)
-        startNewFormFunction = fNew.index
-        endNewFormFunction = fNew.index + len(fNew.uncondensedRns)
-        if startOldFormFunction <= startNewFormFunction and endOLdFormFunction >= endNewFormFunction:
-            return True
-        return False
+
+    def __init__(self, maxSize: int = 65536):
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+        self.tables = formFunctionTables.lookupIndex
+        self.tablesVersion = formFunctionTables.tablesVersion
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def lookup(self,
+               bassScaleDegrees: list,
+               figureMasks: list) -> tuple:
+        """
+        The classification of a window, from the cache if there.
+
+        :param bassScaleDegrees: one per chord of the window
+        :param figureMasks: one per chord of the window (see featureTable.figuresToMask)
+        :return: tuple of the FormFunctionInTheory (or None) and a tuple of the figures of each chord
+        """
+        if self.tables is not formFunctionTables.lookupIndex or \
+                self.tablesVersion != formFunctionTables.tablesVersion:
+            self.clear()
+            self.invalidations += 1
+        key = (tuple(bassScaleDegrees), tuple(figureMasks))
+        found = self.entries.get(key)
+        if found is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return found
+        self.misses += 1
+        found = (formFunctionTables.selectFormFunctionByMasks(formFunctionTables.lookupIndex.get(key[0], []),
+                                                              figureMasks),
+                 tuple(featureTable.maskToFigures(x) for x in figureMasks))
+        self.entries[key] = found
+        if len(self.entries) > self.maxSize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        return found
+
+    def clear(self):
+        """
+        Forgets every window (and takes the current tables), but not the stats.
+        """
+        self.entries.clear()
+        self.tables = formFunctionTables.lookupIndex
+        self.tablesVersion = formFunctionTables.tablesVersion
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hitRate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'size': len(self.entries),
+                'maxSize': self.maxSize}
 
 
 def insertSlur(thisPart: stream.Part,
@@ -284,7 +740,16 @@ def insertSlur(thisPart: stream.Part,
     :param prolongationOrCadence:
     :return:
     """
-    # Slur
+    thisPart.insert(makeSlur(rn1, rn2, prolongationOrCadence))
+
+
+def makeSlur(rn1: roman.RomanNumeral,
+             rn2: roman.RomanNumeral,
+             prolongationOrCadence: str = 'Prolongation') -> spanner.Slur:
+    """
+    Makes the slur for insertSlur (without inserting it).
+    """
+    from music21 import spanner
     sl = spanner.Slur(rn1, rn2)
     # TODO: placement doesn't currently work
     if prolongationOrCadence == 'Prolongation':
@@ -295,23 +760,14 @@ def insertSlur(thisPart: stream.Part,
         raise ValueError('prolongationOrCadence must be "Prolongation" or "Cadential".')
     # TODO add case of 'Medial'
 
-    thisPart.insert(sl)
-
-
-def splitter(text):
-    """
-    Splits a given Text into segments of the same character and return that list.
-    Example: "112233334111" will be split into -> ['11','22','3333','4','111']
-
-    :param text: in our case, a sequence of bass notes
-    :return:
-    """
-    return ','.join(''.join(group) for key, group in groupby(text)).split(',')
+    return sl
 
 
 def reduceRnsToLengthX(rnsList: list,
                        listLength: int,
-                       startIndex: int) -> tuple:
+                       startIndex: int,
+                       features: featureTable.FeatureTable = None,
+                       pedalPoints: dict = None) -> tuple:
     """
     returns a Tuple containing:
     at 0th position: RNs List of given length "listLength" which might be a reduced RNs version
@@ -320,35 +776,60 @@ def reduceRnsToLengthX(rnsList: list,
     at 1st position: the new Index in the rnsList the program has to skip
     at 2nd position: a Pedal Point, if contained in the looked at RNs
 
-    :param rnsList: List of Roman Numerals
+    :param rnsList: List of Roman Numerals (or their ChordRecords, in which case features are required)
     :param listLength: length of the reduction
     :param startIndex: index of start Roman Numeral
+    :param features: FeatureTable of the rnsList.
+        Pass this in when calling repeatedly on the same piece so that it is only built once.
+        Without it, only the features of the chords in this window are extracted (see windowFeatures).
+    :param pedalPoints: the pedal points of the whole piece (from findAllPedalPoints), if already found.
+        Likewise, pass this in (with the features) when calling repeatedly
+        so that the bass runs are not scanned again each time.
     :return:
     """
-    counter = startIndex + 1
-    while counter < (len(rnsList)):
-        bassLineList = [str(x.bassScaleDegreeFromNotation()) for x in
-                        rnsList[startIndex:counter + 1]]
-        bassLineString = ''.join(bassLineList)
-        bassLineSplit = splitter(bassLineString)
-        if len(bassLineSplit) > listLength:  # go explicitly one step too far
-            break
-        else:
-            counter += 1
+    if features is None:
+        segmentLengths = windowFeatures(rnsList, startIndex, listLength).segmentLengths(0, listLength)
+    else:
+        segmentLengths = features.segmentLengths(startIndex, listLength)
+    counter = startIndex + sum(segmentLengths)
 
     rnsInterval = rnsList[startIndex:counter]
-    bassLineList = [str(x.bassScaleDegreeFromNotation()) for x in rnsList[startIndex:counter]]
-    bassLineString = ''.join(bassLineList)
-    bassLineSplit = splitter(bassLineString)
 
-    pedalPointsList = getPotentialPedalPoints(rnsInterval, bassLineSplit, startIndex)
+    if pedalPoints is not None and features is not None and segmentLengths and \
+            features.runStarts[features.runIndex[startIndex]] == startIndex:  # Whole runs only
+        pedalPointsList = []
+        segmentStart = startIndex
+        for segmentLength in segmentLengths:
+            if segmentStart in pedalPoints:
+                pedalPointsList.append((segmentStart, pedalPoints[segmentStart].end))
+            segmentStart += segmentLength
+    else:
+        pedalPointsList = getPotentialPedalPoints(rnsInterval, segmentLengths, startIndex, features)
     # pedalPointObjects = createFormFunctionObjectsFromIndicesTuple(pedalPointsList, rnsList)
     
-    finalRns = getRnsOutOfbassLine(rnsInterval, bassLineSplit)
-    indexRnTuple = (finalRns, startIndex + len(bassLineList), pedalPointsList)
+    finalRns = getRnsOutOfbassLine(rnsInterval, segmentLengths)
+    indexRnTuple = (finalRns, counter, pedalPointsList)
     return indexRnTuple
 
 
+def windowFeatures(rnsList: list,
+                   startIndex: int,
+                   listLength: int) -> featureTable.FeatureTable:
+    """
+    The FeatureTable of just enough of rnsList, from startIndex, for listLength bass notes
+    (more than listLength runs, or to the end, so that the first listLength are complete).
+    For calls to reduceRnsToLengthX without the features of the whole piece,
+    so that each call costs the length of its window, not of the piece.
+    """
+    size = 2 * listLength
+    while True:
+        stop = startIndex + size
+        features = featureTable.FeatureTable(rnsList[startIndex:stop])
+        if len(features.runStarts) > listLength or stop >= len(rnsList):
+            return features
+        size *= 2
+
+
 # TODO: implement:
 # def createFormFunctionObjectsFromIndicesTuple(pedalPointsList: list, rns: list):
 #     """
@@ -360,82 +841,103 @@ def reduceRnsToLengthX(rnsList: list,
 #     """
 
 
-def getRnsOutOfbassLine(allRnsList: list, bassLineList: list):
+def getRnsOutOfbassLine(allRnsList: list, segmentLengths: list):
     """
     takes the first Roman Numeral of each bassLine segement and appends it to a list
-    Example: given bassLineList: ['11','22','3333','4','111']
+    Example: given segmentLengths: [2, 2, 4, 1, 3] (i.e., for the bass line 112233334111)
     return the RomanNumerals at postions 0,2,4,8,10 in a list
 
     :param allRnsList:
-    :param bassLineList: a list of bassnotes such as ['11','22','3333','4','111']
+    :param segmentLengths: the number of RNs on each successive bass note
+        (e.g. from featureTable.runLengthEncode or FeatureTable.segmentLengths)
     :return:
     """
     finalRnList = []
     index = 0
-    for bassLine in bassLineList:
+    for segmentLength in segmentLengths:
         finalRnList.append(allRnsList[index])
-        index += len(bassLine)
+        index += segmentLength
     return finalRnList
 
 
-def getPotentialPedalPoints(rnsInterval: list, bassLineSplit: list, pieceIndex: int):
+def getPotentialPedalPoints(rnsInterval: list,
+                            segmentLengths: list,
+                            pieceIndex: int,
+                            features: featureTable.FeatureTable = None):
     """
-    Returns all pedalpoints of a given bassLineSplit as Tuples (startIndex, endIndex) in a list
+    Returns all pedalpoints of a given bass line as Tuples (startIndex, endIndex) in a list
 
     :param rnsInterval: the Roman Numerals that map to the bassLine
-    :param bassLineSplit: list of bassLines such as ['11','22','3333','4','111']
+    :param segmentLengths: the number of RNs on each successive bass note,
+        such as [2, 2, 4, 1, 3] for the bass line 112233334111
     :param pieceIndex: current index of the progress of the whole piece
+    :param features: optional, precomputed FeatureTable of the whole piece
     :return:
     """
     indexStart = 0
     indexEnd = 0
     pedalPointsList = []
-    for bassNoteCluster in bassLineSplit:
-        indexEnd = indexEnd + len(bassNoteCluster)
+    for segmentLength in segmentLengths:
+        indexEnd = indexEnd + segmentLength
         rnsSubList = rnsInterval[indexStart: indexEnd]
         indexOfSubListInActualPiece = indexStart + pieceIndex
-        potentialPedalPoint = getPotentialPedalPoint(rnsSubList, indexOfSubListInActualPiece)
+        potentialPedalPoint = getPotentialPedalPoint(rnsSubList, indexOfSubListInActualPiece,
+                                                     features)
         if potentialPedalPoint:
             pedalPointsList.append(potentialPedalPoint)
         indexStart = indexEnd
     return pedalPointsList
 
 
-def getPotentialPedalPoint(rnsSubList: list, index: int):
+def getPotentialPedalPoint(rnsSubList: list,
+                           index: int,
+                           features: featureTable.FeatureTable = None):
     """
     Returns a pedalpoint as a Tuple in the form (startIndex, endIndex)
 
     :param rnsSubList: Roman Numerals that must be checked for pedalpoint
     :param index: current index of the progress of the whole piece
+    :param features: optional, precomputed FeatureTable of the whole piece
     :return:
     """
-    indexEssentialMiddlePart = getEssentialPedalPart(rnsSubList)
-    indexPedalPointEnd = findEndPedalPoint(rnsSubList)
+    figureMasks = None
+    if features is not None:
+        figureMasks = features.figureMasks[index:index + len(rnsSubList)]
+    indexEssentialMiddlePart = getEssentialPedalPart(rnsSubList, figureMasks=figureMasks)
+    indexPedalPointEnd = findEndPedalPoint(rnsSubList, figureMasks=figureMasks)
     if indexEssentialMiddlePart != -1 and indexPedalPointEnd != -1:  # end exists so find the middle
         return index, index + indexPedalPointEnd  # relative Index of start and end of pedal point
     else:
         return None
 
 
-def findEndPedalPoint(rnsSubList: list, mustIncludeFig: int = 5):
+def findEndPedalPoint(rnsSubList: list,
+                      mustIncludeFig: int = 5,
+                      figureMasks=None):
     """
     Find the end of a pedal passage.
     endMustInclude defined the figures that must be in the final chord (usually 5).
 
     :param rnsSubList: a list of Roman numerals.
     :param mustIncludeFig: a number that must be included in the figured bass.
+    :param figureMasks: optional, the figure bitmasks of rnsSubList (see featureTable)
     :return:
     """
 
     index = len(rnsSubList) - 1
     while index >= 0:  # search form back to front for speed
-        if mustIncludeFig in rnsSubList[index].figuresNotationObj.numbers:
+        if figureMasks is not None:
+            if figureMasks[index] >> mustIncludeFig & 1:
+                break
+        elif mustIncludeFig in rnsSubList[index].figuresNotationObj.numbers:
             break
         index -= 1
     return index  # if index -1 there is no PedalPoint because it doesnt end
 
 
-def getEssentialPedalPart(rnsSubList: list, mustIncludeFig: int = 4):
+def getEssentialPedalPart(rnsSubList: list,
+                          mustIncludeFig: int = 4,
+                          figureMasks=None):
     """
     Other point in a pedal passage (NB: not the end).
 
@@ -444,19 +946,75 @@ def getEssentialPedalPart(rnsSubList: list, mustIncludeFig: int = 4):
 
     :param rnsSubList: a list of Roman numerals.
     :param mustIncludeFig: a number that must be included in the figured bass.
+    :param figureMasks: optional, the figure bitmasks of rnsSubList (see featureTable)
     :return:
     """
 
     index = len(rnsSubList) - 1
     while index >= 0:  # search form back to front
         # print(rnsSubList[index].figuresNotationObj.numbers)
-        if mustIncludeFig in rnsSubList[index].figuresNotationObj.numbers:
+        if figureMasks is not None:
+            if figureMasks[index] >> mustIncludeFig & 1:
+                break
+        elif mustIncludeFig in rnsSubList[index].figuresNotationObj.numbers:
             break
         index -= 1
     return index  # if index -1 there is no PedalPoint because it doesnt end
 
-# # TODO
-# def generateHigherOrder(listofFormFunctionInPracticeObjects: list):
+
+PedalPoint = namedtuple('PedalPoint', ['start', 'end', 'sixFour', 'fiveThree'])
+PedalPoint.__doc__ = """
+A pedal point over one bass run: the first and last chord indices (inclusive)
+and the indices of its (last) 64 and 53 chords.
+NB: as in getPotentialPedalPoint, the end is the 53 chord and the 64 may come after it.
+"""
+
+
+def findAllPedalPoints(features: featureTable.FeatureTable,
+                       mustIncludeFig: int = 5,
+                       essentialFig: int = 4,
+                       firstRun: int = 0,
+                       lastRun: int = None) -> dict:
+    """
+    Finds every pedal point in a piece in one pass over the bass runs and figure masks,
+    with the same results as getPotentialPedalPoint for each whole run
+    (so these can be shared by every window, rather than each scanning its runs again).
+
+    :param features: the FeatureTable of the piece
+    :param mustIncludeFig: the figure for the end of the pedal (as in findEndPedalPoint)
+    :param essentialFig: the figure for within the pedal (as in getEssentialPedalPart)
+    :param firstRun: the first bass run to look in (e.g. around an edit: see incremental.py)
+    :param lastRun: the last bass run to look in (default: the last of the piece)
+    :return: dict of {index of the first chord of the run: PedalPoint}
+    """
+    runStarts = features.runStarts[firstRun:None if lastRun is None else lastRun + 1]
+    if not len(runStarts):
+        return {}
+    begin = int(runStarts[0])
+    end = begin + int(features.runLengths[firstRun:firstRun + len(runStarts)].sum())
+    masks = np.asarray(features.figureMasks[begin:end], dtype=np.int64)
+    positions = np.arange(begin, end)
+    # The last chord with each figure in each run (-1 if none)
+    lastEnd = np.maximum.reduceat(np.where(masks >> mustIncludeFig & 1, positions, -1), runStarts - begin)
+    lastEssential = np.maximum.reduceat(np.where(masks >> essentialFig & 1, positions, -1), runStarts - begin)
+    found = (lastEnd >= runStarts) & (lastEssential >= runStarts)
+    return {start: PedalPoint(start, end, sixFour, end)
+            for start, end, sixFour in zip(runStarts[found].tolist(),
+                                           lastEnd[found].tolist(),
+                                           lastEssential[found].tolist())}
+
+
+def generateHigherOrder(listofFormFunctionInPracticeObjects: list) -> list:
+    """
+    Infers the 2nd and 3rd order form functions (phrases and themes: see higherOrder.py)
+    from a list of FormFunctionInPractice objects (e.g. Analysis.allFFInPractice),
+    setting the phraseFunctionLabel, themeFunctionLabel and themeTypeLabel of each.
+
+    :param listofFormFunctionInPracticeObjects: list of FormFunctionInPractice objects
+    :return: list of higherOrder.Theme objects
+    """
+    units = sorted(listofFormFunctionInPracticeObjects, key=lambda x: (higherOrder.unitEnd(x), x.index))
+    return list(higherOrder.themes(higherOrder.phrases(units)))
 
 
 # ------------------------------------------------------------------------------
@@ -466,6 +1024,7 @@ class Test(unittest.TestCase):
         """
         One test case for a hypothetical set of RNs.
         """
+        from music21 import roman
 
         rn1 = roman.RomanNumeral('I')
         rn2 = roman.RomanNumeral('V43')
@@ -482,6 +1041,291 @@ class Test(unittest.TestCase):
         test5 = FormFunctionInPractice([rn1, rn2, rn3, rn4, rn5])
         self.assertEqual(test5.functionalLabel, None)  # TODO should prob. be self.assertRaises
 
+        # Made from Roman Numerals alone: no position in a piece, so nothing to write back to
+        self.assertIsNone(test3.index)
+        self.assertIsNone(test3.chords[0].index)
+        test3.index = 0
+        test3.uncondensedChords = test3.chords
+        self.assertRaises(ValueError, ScoreAnnotations.fromFormFunctions, [test3], 3)
+
+        # The old names, deprecated
+        with self.assertWarns(DeprecationWarning):
+            self.assertIs(test3.rns, test3.chords)
+        with self.assertWarns(DeprecationWarning):
+            self.assertIs(test3.uncondensedRns, test3.uncondensedChords)
+
+    def testTablePrecedence(self):
+        """
+        Where two table entries share a bass pattern and both fit, the later one wins.
+        """
+        from music21 import roman
+        iv = roman.RomanNumeral('IV')
+        i = roman.RomanNumeral('I')
+
+        cad = FormFunctionInPractice([iv, roman.RomanNumeral('V7'), i])
+        self.assertIs(cad.formFunctionInTheory, formFunctionTables.lookupIndex[(4, 5, 1)][-1])
+
+        cad = FormFunctionInPractice([iv, roman.RomanNumeral('V'), i])
+        self.assertIs(cad.formFunctionInTheory, formFunctionTables.lookupIndex[(4, 5, 1)][-1])
+
+        noCad = FormFunctionInPractice([iv, roman.RomanNumeral('I64'), i])
+        self.assertIsNone(noCad.formFunctionInTheory)
+
+    def testReduceRnsToLengthX(self):
+        """
+        Condensing sequential RNs with the same bass, with and without precomputed features.
+        """
+        from music21 import roman
+        rns = [roman.RomanNumeral(x) for x in ['I', 'IV64', 'I', 'V43', 'I6', 'IV', 'V7', 'I']]
+        features = featureTable.FeatureTable(rns)
+        for thisFeatures in [None, features]:
+            condensed, nextIndex, pedals = reduceRnsToLengthX(rns, 3, 0, thisFeatures)
+            self.assertEqual([rns.index(x) for x in condensed], [0, 3, 4])
+            self.assertEqual(nextIndex, 5)
+            self.assertEqual(pedals, [(0, 2)])
+
+        records = features.records()
+        condensedRecords = reduceRnsToLengthX(records, 3, 0, features)[0]
+        self.assertEqual([x.index for x in condensedRecords], [0, 3, 4])
+
+        f = FormFunctionInPractice(condensedRecords)
+        self.assertEqual(f.bassScaleDegrees, [1, 2, 3])
+        self.assertEqual(f.functionalLabel, FormFunctionInPractice(condensed).functionalLabel)
+        self.assertEqual(f.duration, 3)
+
+    def testFindAllPedalPoints(self):
+        """
+        The same pedal points as getPotentialPedalPoint on each whole run, and so the same windows.
+        """
+        from music21 import roman
+        from . import benchmark
+        figures = benchmark.syntheticFigures(300, patternDensity=0.5, repeatProbability=0.4, seed=2)
+        rns = [roman.RomanNumeral(x) for x in figures]
+        features = featureTable.FeatureTable(rns)
+        pedalPoints = findAllPedalPoints(features)
+        expected = {}
+        for start, length in zip(features.runStarts.tolist(), features.runLengths.tolist()):
+            pedal = getPotentialPedalPoint(rns[start:start + length], start)
+            if pedal:
+                expected[start] = pedal
+        self.assertGreater(len(expected), 5)
+        self.assertEqual({x: (y.start, y.end) for x, y in pedalPoints.items()}, expected)
+        for pedal in pedalPoints.values():
+            self.assertIn(4, rns[pedal.sixFour].figuresNotationObj.numbers)
+            self.assertIn(5, rns[pedal.fiveThree].figuresNotationObj.numbers)
+        runs = len(features.runStarts)
+        for firstRun, lastRun in [(0, 0), (3, 40), (runs - 5, None), (runs - 1, runs - 1)]:
+            starts = features.runStarts[firstRun:None if lastRun is None else lastRun + 1].tolist()
+            self.assertEqual(findAllPedalPoints(features, firstRun=firstRun, lastRun=lastRun),
+                             {x: y for x, y in pedalPoints.items() if x in starts})
+
+        for startIndex in features.runStarts.tolist():
+            for listLength in (3, 4):
+                self.assertEqual(reduceRnsToLengthX(rns, listLength, startIndex, features, pedalPoints)[2],
+                                 reduceRnsToLengthX(rns, listLength, startIndex, features)[2])
+        # Not from the start of a run: scanned as before
+        self.assertEqual(reduceRnsToLengthX(rns, 3, 1, features, pedalPoints),
+                         reduceRnsToLengthX(rns, 3, 1, features))
+        # Without the features of the whole piece: the same, from the features of each window alone
+        for startIndex in range(0, len(rns), 7):
+            for listLength in (3, 4):
+                self.assertEqual(reduceRnsToLengthX(rns, listLength, startIndex),
+                                 reduceRnsToLengthX(rns, listLength, startIndex, features))
+        self.assertLess(len(windowFeatures(rns, 0, 3)), 50)
+
+        self.assertEqual(findAllPedalPoints(featureTable.FeatureTable()), {})
+
+    def testWindowCache(self):
+        """
+        Cached classifications are the same as the tables', bounded, and remade when the tables change.
+        """
+        cache = WindowCache(maxSize=2)
+        five = featureTable.figuresToMask((5, 3))
+        seven = featureTable.figuresToMask((7, 5, 3))
+        cadence = formFunctionTables.lookupIndex[(4, 5, 1)][-1]
+        self.assertEqual(cache.lookup([4, 5, 1], [five, seven, five]), (cadence, ((5, 3), (7, 5, 3), (5, 3))))
+        self.assertIs(cache.lookup([4, 5, 1], [five, seven, five])[0], cadence)
+        self.assertIsNone(cache.lookup([4, 5], [five, five])[0])
+        self.assertEqual((cache.hits, cache.misses, cache.stats()['hitRate']), (1, 2, 1 / 3))
+
+        cache.lookup([1, 2, 3], [five, five, five])  # Evicts the least recently used (the cadence)
+        self.assertEqual((cache.evictions, len(cache.entries)), (1, 2))
+        self.assertNotIn(((4, 5, 1), (five, seven, five)), cache.entries)
+
+        version = formFunctionTables.tablesVersion
+        names = ['global3', 'global4', 'sequences', 'lookupIndex']
+        originals = {x: getattr(formFunctionTables, x) for x in names}
+        try:
+            formFunctionTables.cadences3.append([[4, 5, 1], [None, 7, None], 'Cadential', None, 'Test'])
+            formFunctionTables.refreshTables()
+            self.assertEqual(formFunctionTables.tablesVersion, version + 1)
+            self.assertEqual(cache.lookup([4, 5, 1], [five, seven, five])[0].prolMedCadType, 'Test')
+            self.assertEqual((cache.invalidations, len(cache.entries)), (1, 1))
+        finally:
+            formFunctionTables.cadences3.pop()
+            for name in names:  # The same objects as the other modules hold
+                setattr(formFunctionTables, name, originals[name])
+        self.assertIs(cache.lookup([4, 5, 1], [five, seven, five])[0], cadence)
+
+        # Shared by analyses: the same form functions as without, and the repeats are hits
+        from music21 import roman
+        rns = [roman.RomanNumeral(x) for x in ['I', 'V43', 'I6', 'IV', 'V7', 'I'] * 20]
+        cache = WindowCache()
+        profile = profiling.Profile()
+        expected = [(x.index, x.functionalLabel, x.figures) for x in Analysis(rns).findFormFunctions()]
+        for i in range(2):
+            found = Analysis(rns, profile=profile, windowCache=cache).findFormFunctions()
+            self.assertEqual([(x.index, x.functionalLabel, x.figures) for x in found], expected)
+        self.assertEqual(profile.counters['windowCacheHits'], cache.hits)
+        self.assertEqual(profile.counters['windowCacheMisses'], cache.misses)
+        self.assertEqual(cache.hits + cache.misses, profile.counters['windows'])
+        self.assertGreater(cache.hits, 20 * cache.misses)
+
+    def testSpanIndex(self):
+        spans = SpanIndex(20)
+        self.assertFalse(spans.contains(0, 1))
+        spans.add(3, 8)
+        spans.add(10, 12)
+        self.assertTrue(spans.contains(3, 8))
+        self.assertTrue(spans.contains(4, 6))
+        self.assertTrue(spans.contains(10, 11))
+        self.assertFalse(spans.contains(2, 5))
+        self.assertFalse(spans.contains(7, 9))
+        self.assertFalse(spans.contains(11, 13))
+
+    def testAnalysis(self):
+        """
+        Two independent analyses, each with their own results.
+        """
+        from music21 import roman, stream
+        part = stream.Part()
+        for x in ['I', 'IV64', 'I', 'V43', 'I6', 'IV', 'V7', 'I']:
+            part.append(roman.RomanNumeral(x))
+        analysis = Analysis.fromPart(part)
+        found = analysis.findFormFunctions()
+        self.assertEqual([(f.index, f.functionalLabel) for f in found],
+                         [(0, 'Tonic Prolongation with Passing'),
+                          (0, 'Tonic Prolongation with Pedal'),
+                          (4, 'Complete Cadential Progression'),
+                          (5, 'None Cadential Progression')])
+
+        other = Analysis([roman.RomanNumeral(x) for x in ['I', 'V43', 'I6']])
+        self.assertEqual(len(other.findFormFunctions()), 1)
+        self.assertEqual(len(analysis.allFFInPractice), 4)
+
+        self.assertTrue(analysis.existsInFormFunctionList(found[0]))
+        self.assertTrue(analysis.existsInFormFunctionList(found[1]))
+        pedal = FormFunctionInPractice([analysis.chords[1]])
+        pedal.functionalLabel = 'Pedal'
+        pedal.index, pedal.uncondensedChords = 1, analysis.chords[1:3]
+        self.assertTrue(analysis.existsInFormFunctionList(pedal))  # contained
+        pedal.uncondensedChords = analysis.chords[1:4]
+        self.assertFalse(analysis.existsInFormFunctionList(pedal))  # longer
+
+        analysis.writeInScore()
+        self.assertEqual(len(part.getElementsByClass('Slur')), 3)
+        self.assertEqual(analysis.rns[0].lyrics[-1].text, 'Tonic Prolongation with Passing')
+
+        # With a profile
+        profile = profiling.Profile()
+        Analysis(analysis.rns, profile=profile).findFormFunctions()
+        self.assertEqual(profile.counters['formFunctions'], len(found))
+        self.assertEqual(profile.counters['windows'], 7)
+        self.assertEqual(set(profile.stageSeconds), {'features', 'pedal', 'reduce', 'match', 'dedup'})
+        cadences = formFunctionTables.lookupIndex[(4, 5, 1)]
+        self.assertEqual(profile.entryHits[profiling.entryName(cadences[1])], 1)
+        self.assertEqual(profile.entryShadowed[profiling.entryName(cadences[0])], 1)  # The V7 fits it too
+        self.assertEqual(profile.entryMisses[profiling.entryName(cadences[0])], 0)
+
+        # The same again, from the features alone
+        fromFeatures = Analysis(features=analysis.features)
+        self.assertEqual([(f.index, f.functionalLabel) for f in fromFeatures.findFormFunctions()],
+                         [(f.index, f.functionalLabel) for f in found])
+        self.assertRaises(ValueError, fromFeatures.writeInScore)
+
+        # Higher order
+        themes = generateHigherOrder(found)
+        self.assertEqual(len(themes), 1)
+        self.assertEqual([f.phraseFunctionLabel for f in found], ['Initial', 'Initial', 'Cadential', 'Cadential'])
+        self.assertEqual(len(fromFeatures.writeInScore(mutate=False).slurs), 3)
+
+    def testWriteInScore(self):
+        """
+        The batched write (Analysis.writeInScore) and the one-at-a-time functions give the same score.
+        """
+        from music21 import roman, spanner, stream
+        figures = ['I', 'IV64', 'I', 'V43', 'I6', 'IV', 'V7', 'I', 'I', 'I6', 'V', 'I']
+        parts = []
+        for batched in [True, False]:
+            part = stream.Part()
+            for x in figures:
+                part.append(roman.RomanNumeral(x))
+            analysis = Analysis.fromPart(part)
+            analysis.findFormFunctions()
+            if batched:
+                annotations = analysis.writeInScore()
+            else:
+                fillScoreWithMedial(analysis.rns)
+                writeAllInformationInAnalysis(analysis.allFFInPractice, part, analysis.rns)
+            parts.append(part)
+
+        batchedPart, onePart = parts
+        for rnBatched, rnOne in zip(batchedPart.getElementsByClass(roman.RomanNumeral),
+                                    onePart.getElementsByClass(roman.RomanNumeral)):
+            self.assertEqual([(x.number, x.text) for x in rnBatched.lyrics],
+                             [(x.number, x.text) for x in rnOne.lyrics])
+
+        def slurs(part):
+            positions = {id(x): i for i, x in enumerate(part.getElementsByClass(roman.RomanNumeral))}
+            return sorted((positions[id(x.getFirst())], positions[id(x.getLast())], x.placement)
+                          for x in part.getElementsByClass(spanner.Slur))
+
+        self.assertEqual(slurs(batchedPart), slurs(onePart))
+        self.assertEqual([(x.start, x.end) for x in annotations.slurs], [(0, 4), (4, 8), (5, 8)])
+        self.assertEqual(annotations.lyrics(11), ['*Medial?*'])
+
+        # No mutation
+        part = stream.Part()
+        for x in figures:
+            part.append(roman.RomanNumeral(x))
+        analysis = Analysis.fromPart(part)
+        analysis.findFormFunctions()
+        self.assertEqual(analysis.writeInScore(mutate=False).slurs, annotations.slurs)
+        self.assertEqual(len(part.getElementsByClass(spanner.Slur)), 0)
+        self.assertEqual(part.getElementsByClass(roman.RomanNumeral).first().lyrics, [])
+
+    def testWithoutMusic21(self):
+        """
+        The analysis runs from features without importing music21 at all.
+        """
+        import os
+        import subprocess
+        import sys
+        code = '; '.join([
+            'import sys',
+            'sys.modules["music21"] = None',  # So that any import of it fails
+            'from FormFunction import bassToFormFunction, featureTable, pipeline, schemaMatcher',
+            'mask = featureTable.figuresToMask((5, 3))',
+            'features = featureTable.FeatureTable.fromArrays([1, 2, 3, 4, 5, 1], [mask] * 6, [1.0] * 6)',
+            'found = bassToFormFunction.Analysis(features=features).findFormFunctions()',
+            'print(len(found))',
+        ])
+        out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.assertEqual(out.returncode, 0, out.stderr)
+        self.assertGreater(int(out.stdout), 0)
+
+    def testAsScript(self):
+        """
+        The module still runs as a script, as well as with python -m.
+        """
+        import os
+        import subprocess
+        import sys
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), 'Test.testSpanIndex'],
+                             capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(out.returncode, 0, out.stderr)
+
 
 # -----------------------------------------------------------------------------
 
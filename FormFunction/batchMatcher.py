@@ -0,0 +1,247 @@
+"""
+===============================
+Batch Matcher (batchMatcher.py)
+===============================
+
+
+LICENCE:
+===============================
+
+Creative Commons Attribution-ShareAlike 4.0 International License
+https://creativecommons.org/licenses/by-sa/4.0/
+
+
+ABOUT:
+===============================
+
+Matches the tables against every window of every piece in a corpus at once, with NumPy.
+
+Once the features are extracted (featureTable.FeatureTable, e.g. from a featureCache.FeatureCache),
+matching is only integer comparison, so rather than one Python object per window:
+1. the condensed bass lines (one entry per bass run: its scale degree and the figure bitmask of its first chord)
+of all the pieces are concatenated into two arrays;
+2. the windows of 3 and 4 bass runs are strided views of those (no copies),
+less any that cross from one piece into the next;
+3. each window's bass pattern is looked up among the table patterns (one sorted search),
+and its figures are checked against all the candidates for that pattern in one step
+(as formFunctionTables.selectFormFunctionIndices, but for all the patterns together,
+with the candidates padded to the same number).
+
+The results are the same as the window matches of bassToFormFunction.Analysis
+(before any pedal points or the removal of repeats): see BatchMatches.
+
+"""
+
+# ------------------------------------------------------------------------------
+
+from collections import namedtuple
+import unittest
+
+import numpy as np
+
+from . import featureTable
+from . import formFunctionTables
+
+
+# ------------------------------------------------------------------------------
+
+keyBase = 8  # Bass scale degrees are 1-7 (0 for unknown)
+
+CompiledPatterns = namedtuple('CompiledPatterns', ['length', 'keys', 'required', 'entries'])
+CompiledPatterns.__doc__ = """
+The table patterns of one length as arrays, in order of their keys (see patternKeys):
+keys (patterns), required (patterns x candidates x length figure bitmasks, padded with -1 for no candidate)
+and entries (the FormFunctionInTheory objects, one list per pattern, in table order).
+"""
+
+BatchMatches = namedtuple('BatchMatches', ['pieces', 'starts', 'ends', 'entryIndices', 'entries'])
+BatchMatches.__doc__ = """
+Every match in a batch, as arrays with one entry per match:
+pieces (the index of the piece in the batch),
+starts and ends (the first and last chord indices in that piece, inclusive, as for Analysis windows),
+and entryIndices (into entries, the list of FormFunctionInTheory objects).
+Sorted by piece, start and then length (3 before 4).
+"""
+
+
+def patternKeys(windows) -> np.ndarray:
+    """
+    Encodes bass patterns (rows of scale degrees, all of one length) as single integers.
+    """
+    windows = np.asarray(windows, dtype=np.int64)
+    return windows @ (keyBase ** np.arange(windows.shape[-1], dtype=np.int64))
+
+
+def compileTables(lookupIndex: dict = None) -> dict:
+    """
+    Compiles the table entries into arrays for matching in batches.
+
+    :param lookupIndex: as formFunctionTables.lookupIndex (the default)
+    :return: dict of {pattern length: CompiledPatterns}
+    """
+    if lookupIndex is None:
+        lookupIndex = formFunctionTables.lookupIndex
+    out = {}
+    for length in sorted({len(x) for x in lookupIndex}):
+        patterns = sorted((x for x in lookupIndex if len(x) == length), key=lambda x: int(patternKeys(x)))
+        maxCandidates = max(len(lookupIndex[x]) for x in patterns)
+        required = np.full((len(patterns), maxCandidates, length), -1, dtype=np.int64)
+        for i, pattern in enumerate(patterns):
+            for j, entry in enumerate(lookupIndex[pattern]):
+                required[i, j] = entry.requiredMasks
+        out[length] = CompiledPatterns(length,
+                                       patternKeys(patterns),
+                                       required,
+                                       [list(lookupIndex[x]) for x in patterns])
+    return out
+
+
+def condensedArrays(tables: list) -> tuple:
+    """
+    The condensed bass lines of several pieces, concatenated.
+
+    :param tables: list of FeatureTables
+    :return: tuple of arrays (one entry per bass run):
+        scale degrees, figure bitmasks (of the first chord), piece indices, first chord indices,
+        and the chord index after each run (all indices within the piece)
+    """
+    degrees, masks, pieces, starts, stops = [], [], [], [], []
+    for piece, table in enumerate(tables):
+        degrees.append(np.asarray(table.runDegrees, dtype=np.int64))
+        masks.append(np.asarray(table.figureMasks, dtype=np.int64)[table.runStarts])
+        pieces.append(np.full(len(table.runStarts), piece, dtype=np.int64))
+        starts.append(np.asarray(table.runStarts, dtype=np.int64))
+        stops.append(np.asarray(table.runStarts + table.runLengths, dtype=np.int64))
+    if not degrees:
+        return tuple(np.zeros(0, dtype=np.int64) for _ in range(5))
+    return tuple(np.concatenate(x) for x in (degrees, masks, pieces, starts, stops))
+
+
+def matchWindows(degrees: np.ndarray,
+                 masks: np.ndarray,
+                 pieces: np.ndarray,
+                 compiled: CompiledPatterns) -> tuple:
+    """
+    Matches every window of one length (within a piece) against the compiled patterns of that length.
+
+    :return: the first bass run of each matching window and the index of its entry in compiled.entries
+        (flattened, i.e. pattern index x candidates + candidate index)
+    """
+    length = compiled.length
+    if len(degrees) < length:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    degreeWindows = np.lib.stride_tricks.sliding_window_view(degrees, length)  # Views, not copies
+    maskWindows = np.lib.stride_tricks.sliding_window_view(masks, length)
+
+    keys = patternKeys(degreeWindows)
+    inRange = ((degreeWindows >= 0) & (degreeWindows < keyBase)).all(axis=1)
+    samePiece = pieces[:len(keys)] == pieces[length - 1:]
+    patternIndex = np.minimum(np.searchsorted(compiled.keys, keys), len(compiled.keys) - 1)
+    found = np.flatnonzero(inRange & samePiece & (compiled.keys[patternIndex] == keys))
+
+    # The figures of all those windows against all the candidates for their patterns at once
+    required = compiled.required[patternIndex[found]]  # windows x candidates x length
+    windowMasks = maskWindows[found][:, None, :]
+    fits = ((windowMasks & required) == required).all(axis=2) & (required[:, :, 0] != -1)
+    numberOfCandidates = required.shape[1]
+    last = numberOfCandidates - 1 - np.argmax(fits[:, ::-1], axis=1)  # The later entry wins
+    matched = fits.any(axis=1)
+    return found[matched], patternIndex[found][matched] * numberOfCandidates + last[matched]
+
+
+def batchMatch(tables: list,
+               compiledTables: dict = None,
+               lengths: tuple = (3, 4)) -> BatchMatches:
+    """
+    Finds every table match in the windows of several pieces at once.
+
+    :param tables: list of FeatureTables (one per piece)
+    :param compiledTables: from compileTables (by default, for formFunctionTables.lookupIndex)
+    :param lengths: the window lengths (in bass runs)
+    :return: BatchMatches
+    """
+    if compiledTables is None:
+        compiledTables = compileTables()
+    degrees, masks, pieces, starts, stops = condensedArrays(tables)
+
+    allRuns, allLengths, allEntries = [], [], []
+    entries = []
+    for length in lengths:
+        if length not in compiledTables:
+            continue
+        compiled = compiledTables[length]
+        runs, flatIndices = matchWindows(degrees, masks, pieces, compiled)
+        numberOfCandidates = compiled.required.shape[1]
+        flatEntries = [x for thisList in compiled.entries
+                       for x in thisList + [None] * (numberOfCandidates - len(thisList))]
+        allRuns.append(runs)
+        allLengths.append(np.full(len(runs), length, dtype=np.int64))
+        allEntries.append(flatIndices + len(entries))
+        entries.extend(flatEntries)
+
+    if not allRuns:
+        return BatchMatches(*(np.zeros(0, dtype=np.int64) for _ in range(4)), entries)
+    runs, windowLengths, entryIndices = (np.concatenate(x) for x in (allRuns, allLengths, allEntries))
+    order = np.lexsort((windowLengths, runs))
+    runs, windowLengths, entryIndices = runs[order], windowLengths[order], entryIndices[order]
+    return BatchMatches(pieces[runs], starts[runs], stops[runs + windowLengths - 1] - 1, entryIndices, entries)
+
+
+def matchTriples(matches: BatchMatches) -> list:
+    """
+    The matches as a list of (piece, start, FormFunctionInTheory) triples.
+    """
+    return [(piece, start, matches.entries[entry])
+            for piece, start, entry in zip(matches.pieces.tolist(),
+                                           matches.starts.tolist(),
+                                           matches.entryIndices.tolist())]
+
+
+# ------------------------------------------------------------------------------
+
+class Test(unittest.TestCase):
+
+    def testAgreesWithAnalysis(self):
+        """
+        The same window matches as bassToFormFunction.Analysis, piece by piece, in one batch.
+        """
+        from music21 import roman
+        from . import bassToFormFunction
+        from . import benchmark
+
+        tables = []
+        expected = []
+        for piece, seed in enumerate(range(5)):
+            figures = benchmark.syntheticFigures(200 + 50 * seed, patternDensity=0.6, repeatProbability=0.3,
+                                                 seed=seed)
+            analysis = bassToFormFunction.Analysis([roman.RomanNumeral(x) for x in figures])
+            tables.append(analysis.features)
+            for startIndex in analysis.features.runStarts.tolist():
+                for f in analysis.formFunctionsFrom(startIndex):
+                    if f.formFunctionInTheory is not None:  # Not pedal points
+                        expected.append((piece, f.index, f.index + len(f.uncondensedChords) - 1,
+                                         f.formFunctionInTheory))
+        tables.insert(2, featureTable.FeatureTable())  # An empty piece changes nothing but the numbering
+        expected = [(x + (x >= 2), start, end, entry) for x, start, end, entry in expected]
+
+        matches = batchMatch(tables)
+        found = [(piece, start, end, matches.entries[entry])
+                 for piece, start, end, entry in zip(*(x.tolist() for x in matches[:4]))]
+        self.assertGreater(len(expected), 100)
+        self.assertEqual(found, expected)
+        self.assertEqual(matchTriples(matches)[0], found[0][:2] + found[0][3:])
+
+    def testNotAcrossPieces(self):
+        mask = featureTable.figuresToMask((5, 3))
+        seventh = featureTable.figuresToMask((7, 5, 3))
+        first = featureTable.FeatureTable.fromArrays([4, 5], [mask, seventh], [1.0, 1.0])
+        second = featureTable.FeatureTable.fromArrays([1, 4, 5, 1], [mask, mask, seventh, mask], [1.0] * 4)
+        matches = batchMatch([first, second])
+        self.assertEqual([(x, y) for x, y, z in matchTriples(matches)], [(1, 1)])
+        self.assertEqual(len(batchMatch([]).starts), 0)
+
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    unittest.main()
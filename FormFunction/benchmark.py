@@ -0,0 +1,361 @@
+"""
+===============================
+Benchmark (benchmark.py)
+===============================
+
+
+LICENCE:
+===============================
+
+Creative Commons Attribution-ShareAlike 4.0 International License
+https://creativecommons.org/licenses/by-sa/4.0/
+
+
+ABOUT:
+===============================
+
+Benchmarks for the bass-to-form-function pipeline (bassToFormFunction.py).
+
+Inputs are either synthetic harmonic analyses of any length
+(random chords with a given density of table schemas planted among them)
+or a local corpus of analysis files (see corpusRunner.findAnalyses).
+
+Each stage is timed separately, by the profile of the analysis itself (see profiling.py),
+so what is timed is just what runs in use:
+parsing (corpus only), feature extraction, pedal detection, window reduction (reduceRnsToLengthX),
+table matching (FormFunctionInPractice), deduplication, and writing in the score.
+The report gives the time and throughput (chords per second) of each stage,
+peak memory (measured in a second pass, as tracing memory slows everything down),
+and, over a range of input lengths, the scaling of each stage
+(the exponent k in time ~ length^k: 1 for linear, 2 for quadratic).
+
+Usage, e.g.:
+python -m FormFunction.benchmark --lengths 1000 2000 4000 8000
+python -m FormFunction.benchmark --corpus path/to/When-in-Rome/Corpus --json bench.json
+
+"""
+
+# ------------------------------------------------------------------------------
+
+from __future__ import annotations
+
+import argparse
+import json
+import math
+import random
+import time
+import tracemalloc
+import typing as t
+import unittest
+
+if __package__ in (None, ''):  # Run as a script: import the rest of the package from the directory above
+    import os
+    import sys
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    __package__ = 'FormFunction'
+
+from . import bassToFormFunction
+from . import formFunctionTables
+from . import profiling
+
+if t.TYPE_CHECKING:
+    from music21 import stream
+
+
+# ------------------------------------------------------------------------------
+
+stages = ['parse', 'features', 'reduce', 'match', 'pedal', 'dedup', 'write']
+
+# A vocabulary (in C major) from which to make synthetic analyses.
+vocabulary = ['I', 'I6', 'I64', 'ii', 'ii6', 'ii65', 'ii7', 'iii', 'IV', 'IV6', 'IV64',
+              'V', 'V6', 'V64', 'V7', 'V65', 'V43', 'V42', 'vi', 'vi6', 'viio6', 'viio7']
+
+
+def chordsByBassAndFigure() -> dict:
+    """
+    The vocabulary organised by bass scale degree, then by figure (0 for any).
+
+    :return: dict of {bassScaleDegree: {figure: [figure strings]}}
+    """
+    from music21 import roman
+    out = {}
+    for figure in vocabulary:
+        rn = roman.RomanNumeral(figure, 'C')
+        byFigure = out.setdefault(rn.bassScaleDegreeFromNotation(), {})
+        byFigure.setdefault(0, []).append(figure)
+        for number in rn.figuresNotationObj.numbers:
+            byFigure.setdefault(number, []).append(figure)
+    return out
+
+
+def realiseSchema(formFunctionInTheory: formFunctionTables.FormFunctionInTheory,
+                  lookup: dict,
+                  rng: random.Random):
+    """
+    Chooses chords (figure strings) for one table entry, or returns None if the vocabulary can't.
+    """
+    out = []
+    for degree, fig in zip(formFunctionInTheory.bassScaleDegrees, formFunctionInTheory.requiredFigures):
+        options = lookup.get(degree, {}).get(fig or 0)
+        if not options:
+            return None
+        out.append(rng.choice(options))
+    return out
+
+
+def syntheticFigures(length: int,
+                     patternDensity: float = 0.5,
+                     repeatProbability: float = 0.1,
+                     seed: int = 0) -> list:
+    """
+    A synthetic harmonic analysis as a list of RN figure strings (in C major).
+
+    :param length: number of chords
+    :param patternDensity: the proportion of chords (roughly) that are part of planted table schemas
+    :param repeatProbability: probability of a chord repeating the previous bass (for runs and pedals)
+    :param seed: for the random choices
+    :return: list
+    """
+    rng = random.Random(seed)
+    lookup = chordsByBassAndFigure()
+    schemas = [x for x in (realiseSchema(y, lookup, rng)
+                           for y in formFunctionTables.global3 + formFunctionTables.global4) if x]
+    out = []
+    while len(out) < length:
+        if rng.random() < patternDensity:
+            out.extend(rng.choice(schemas))
+        elif out and rng.random() < repeatProbability:
+            out.append(rng.choice(['I64', 'IV64']) if rng.random() < 0.5 else out[-1])
+        else:
+            out.append(rng.choice(vocabulary))
+    return out[:length]
+
+
+def makePart(figures: list) -> stream.Part:
+    from music21 import roman, stream
+    part = stream.Part()
+    for figure in figures:
+        part.append(roman.RomanNumeral(figure, 'C'))
+    return part
+
+
+# ------------------------------------------------------------------------------
+
+def timeStages(part: stream.Part,
+               parseSeconds: float = 0.0,
+               write: bool = True) -> dict:
+    """
+    Runs bassToFormFunction.Analysis on a part, just as in use,
+    and reads the time of each stage from its profile (see profiling.Profile).
+
+    :return: dict of stage name to seconds, plus 'chords' and 'formFunctions'
+    """
+    profile = profiling.Profile()
+    analysis = bassToFormFunction.Analysis.fromPart(part, profile=profile)
+    analysis.findFormFunctions()
+    if write:
+        analysis.writeInScore()
+
+    times = {stage: profile.stageSeconds.get(stage, 0.0) for stage in stages}
+    times['parse'] = parseSeconds
+    times['chords'] = len(analysis.chords)
+    times['formFunctions'] = len(analysis.allFFInPractice)
+    return times
+
+
+def peakMemory(parts: list,
+               write: bool = True) -> float:
+    """
+    The peak memory (in MB) of analysing each of a list of parts in turn, traced with tracemalloc.
+    A separate pass from the timing, since tracing slows every stage down.
+    """
+    tracemalloc.start()
+    try:
+        for part in parts:
+            analysis = bassToFormFunction.Analysis.fromPart(part)
+            analysis.findFormFunctions()
+            if write:
+                analysis.writeInScore(mutate=False)
+        return tracemalloc.get_traced_memory()[1] / 2 ** 20
+    finally:
+        tracemalloc.stop()
+
+
+def measure(parts: list,
+            parseSeconds: list = None,
+            write: bool = True,
+            memory: bool = True) -> dict:
+    """
+    Times the stages over a list of parts (summed),
+    then (if memory) measures the peak memory in a second, untimed pass.
+
+    :return: dict with 'seconds' (per stage), 'chordsPerSecond' (per stage and 'total'),
+        'chords', 'formFunctions', and 'peakMemoryMB' (None if not measured)
+    """
+    parseSeconds = parseSeconds or [0.0] * len(parts)
+    totals = dict.fromkeys(stages, 0.0)
+    chords = 0
+    formFunctions = 0
+    for part, seconds in zip(parts, parseSeconds):
+        times = timeStages(part, seconds, write)
+        for stage in stages:
+            totals[stage] += times[stage]
+        chords += times['chords']
+        formFunctions += times['formFunctions']
+
+    totalSeconds = sum(totals.values())
+    return {'chords': chords,
+            'formFunctions': formFunctions,
+            'seconds': totals,
+            'chordsPerSecond': {**{stage: chords / totals[stage] if totals[stage] else None
+                                   for stage in stages},
+                                'total': chords / totalSeconds if totalSeconds else None},
+            'peakMemoryMB': peakMemory(parts, write) if memory else None}
+
+
+def scalingExponents(results: list) -> dict:
+    """
+    The least-squares slope of log(seconds) against log(chords) for each stage.
+
+    :param results: list of measure() outputs at different lengths
+    :return: dict of stage to exponent (None where there is too little to go on)
+    """
+    out = {}
+    for stage in stages:
+        points = [(math.log(x['chords']), math.log(x['seconds'][stage]))
+                  for x in results if x['chords'] and x['seconds'][stage] > 0]
+        if len(points) < 2:
+            out[stage] = None
+            continue
+        meanX = sum(p[0] for p in points) / len(points)
+        meanY = sum(p[1] for p in points) / len(points)
+        covariance = sum((p[0] - meanX) * (p[1] - meanY) for p in points)
+        variance = sum((p[0] - meanX) ** 2 for p in points)
+        out[stage] = covariance / variance if variance else None
+    return out
+
+
+def runSynthetic(lengths: list,
+                 patternDensity: float = 0.5,
+                 repeats: int = 1,
+                 seed: int = 0,
+                 write: bool = True) -> dict:
+    """
+    Benchmarks synthetic analyses of each length in `lengths`.
+
+    :return: dict with 'results' (one per length) and 'scaling' (see scalingExponents)
+    """
+    results = []
+    for length in lengths:
+        parts = [makePart(syntheticFigures(length, patternDensity, seed=seed + i)) for i in range(repeats)]
+        result = measure(parts, write=write)
+        result['length'] = length
+        results.append(result)
+    return {'results': results, 'scaling': scalingExponents(results)}
+
+
+def benchmarkCorpus(paths: list,
+                    write: bool = True) -> dict:
+    """
+    Benchmarks a local corpus of analysis files (including the time to parse them).
+    """
+    from . import corpusRunner
+    parts = []
+    parseSeconds = []
+    for path in corpusRunner.findAnalyses(paths):
+        start = time.perf_counter()
+        try:
+            parts.append(corpusRunner.parseAnalysis(path))
+        except Exception:
+            continue
+        parseSeconds.append(time.perf_counter() - start)
+    result = measure(parts, parseSeconds, write)
+    result['pieces'] = len(parts)
+    return {'results': [result], 'scaling': {}}
+
+
+def formatReport(report: dict) -> str:
+    """
+    A plain text table of a runSynthetic or benchmarkCorpus report.
+    """
+    lines = []
+    header = f"{'chords':>8} {'stage':>9} {'seconds':>10} {'chords/s':>12}"
+    for result in report['results']:
+        lines.append(header)
+        for stage in stages + ['total']:
+            if stage == 'total':
+                seconds = sum(result['seconds'].values())
+            else:
+                seconds = result['seconds'][stage]
+            perSecond = result['chordsPerSecond'][stage]
+            perSecond = f'{perSecond:12.0f}' if perSecond else f"{'-':>12}"
+            lines.append(f"{result['chords']:>8} {stage:>9} {seconds:10.4f} {perSecond}")
+        memory = f", peak memory {result['peakMemoryMB']:.1f} MB" if result['peakMemoryMB'] is not None else ''
+        lines.append(f"{result['formFunctions']} form functions{memory}")
+        lines.append('')
+    if report['scaling']:
+        lines.append('Scaling exponents (time ~ length^k):')
+        for stage, exponent in report['scaling'].items():
+            if exponent is not None:
+                lines.append(f'{stage:>9} {exponent:.2f}')
+    return '\n'.join(lines)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark the bass-to-form-function pipeline.')
+    parser.add_argument('--lengths', type=int, nargs='+', default=[500, 1000, 2000, 4000],
+                        help='lengths (in chords) of the synthetic analyses')
+    parser.add_argument('--density', type=float, default=0.5,
+                        help='proportion of chords in planted schemas')
+    parser.add_argument('--repeats', type=int, default=1,
+                        help='number of synthetic analyses per length')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--corpus', nargs='+', default=None,
+                        help='benchmark these analysis files / directories instead')
+    parser.add_argument('--noWrite', action='store_true',
+                        help='skip writing in the score')
+    parser.add_argument('--json', default=None,
+                        help='also write the full report to this JSON file')
+    parsed = parser.parse_args(args)
+
+    if parsed.corpus:
+        report = benchmarkCorpus(parsed.corpus, not parsed.noWrite)
+    else:
+        report = runSynthetic(parsed.lengths, parsed.density, parsed.repeats, parsed.seed,
+                              not parsed.noWrite)
+    print(formatReport(report))
+    if parsed.json:
+        with open(parsed.json, 'w') as f:
+            json.dump(report, f, indent=1)
+    return report
+
+
+# ------------------------------------------------------------------------------
+
+class Test(unittest.TestCase):
+
+    def testSynthetic(self):
+        figures = syntheticFigures(200, patternDensity=0.8, seed=1)
+        self.assertEqual(len(figures), 200)
+        self.assertEqual(figures, syntheticFigures(200, patternDensity=0.8, seed=1))
+        analysis = bassToFormFunction.Analysis.fromPart(makePart(figures))
+        self.assertGreater(len(analysis.findFormFunctions()), 10)
+
+    def testReport(self):
+        report = runSynthetic([50, 100], repeats=1)
+        self.assertEqual([x['chords'] for x in report['results']], [50, 100])
+        for result in report['results']:
+            self.assertEqual(set(result['seconds']), set(stages))
+            self.assertGreater(result['seconds']['match'], 0)
+            self.assertGreater(result['peakMemoryMB'], 0)
+            # Same count as the Analysis itself
+            analysis = bassToFormFunction.Analysis.fromPart(makePart(syntheticFigures(result['chords'])))
+            self.assertEqual(result['formFunctions'], len(analysis.findFormFunctions()))
+        self.assertEqual(set(report['scaling']), set(stages))
+        self.assertIn('Scaling exponents', formatReport(report))
+
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,452 @@
+"""
+===============================
+Corpus Runner (corpusRunner.py)
+===============================
+
+
+LICENCE:
+===============================
+
+Creative Commons Attribution-ShareAlike 4.0 International License
+https://creativecommons.org/licenses/by-sa/4.0/
+
+
+ABOUT:
+===============================
+
+Runs the form function analysis (bassToFormFunction.py)
+on a whole corpus of harmonic analyses
+(e.g. RomanText files from the 'When in Rome' corpus),
+with the pieces spread over a pool of worker processes.
+
+Directories are searched for RomanText files only, leaving out the computer-generated analyses
+(e.g. analysis_automatic.rntxt), so that each piece of a 'When in Rome' style tree
+(score.mxl, analysis.rntxt, analysis_automatic.rntxt) is analysed once, from the human analysis.
+Scores with analyses in them (MusicXML) and the automatic analyses are opt-in (--scores, --automatic).
+
+Each piece gets its own output (the annotated score, as MusicXML)
+and the whole run gets a summary table (one row per piece).
+A file that fails (to parse, or otherwise) is recorded in the summary
+with its error, and does not stop the rest of the batch.
+
+Optionally, the chord features of each file can be cached (see featureCache.py):
+repeat runs that do not write scores then skip parsing the cached files altogether.
+
+Optionally too, the whole run can be profiled (see profiling.py),
+with the stage timers and counters of every piece summed into one JSON or CSV file.
+
+For corpus-wide statistics, every form function found can be exported to one table
+(see annotationExport.py: JSON, CSV or columnar .npz) without writing any scores.
+
+To run with other tables, pass a compiled table set (see tableCompiler.py):
+each worker loads it once, on start.
+
+Each worker (or the one process, for a single worker) keeps one bassToFormFunction.WindowCache for the run,
+so a window that comes up again, in any piece that worker analyses, is not classified again
+(e.g. 63% of windows over the RomanText analyses in the music21 corpus).
+The hits and misses are in the profile (windowCacheHits, windowCacheMisses).
+
+Usage, e.g.:
+python -m FormFunction.corpusRunner path/to/When-in-Rome/Corpus -o out/ -w 8
+
+"""
+
+# ------------------------------------------------------------------------------
+
+import argparse
+import contextlib
+import csv
+import fnmatch
+import glob
+import json
+import os
+import time
+import unittest
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+if __package__ in (None, ''):  # Run as a script: import the rest of the package from the directory above
+    import os
+    import sys
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    __package__ = 'FormFunction'
+
+from . import annotationExport
+from . import bassToFormFunction
+from . import featureCache
+from . import profiling
+from . import tableCompiler
+
+
+# ------------------------------------------------------------------------------
+
+romanTextExtensions = ('.txt', '.rntxt')
+scoreExtensions = ('.mxl', '.musicxml', '.xml')
+defaultExtensions = romanTextExtensions
+automaticNames = ('*_automatic.*',)  # Computer-generated analyses, e.g. analysis_automatic.rntxt
+
+summaryFields = ['path', 'status', 'chords', 'formFunctions', 'seconds', 'output', 'error']
+
+# One FeatureCache per cache directory in each (worker) process, kept for every piece it analyses
+openCaches = {}
+
+# The WindowCache of this worker process for the run (see startWorker)
+workerWindowCache = None
+
+
+def findAnalyses(paths: list,
+                 extensions: tuple = defaultExtensions,
+                 exclude: tuple = automaticNames) -> list:
+    """
+    Expands a list of files, directories (searched recursively) and/or glob patterns
+    into a sorted list of analysis files.
+
+    :param paths: list of paths or glob patterns
+    :param extensions: the file extensions to look for in directories
+        (by default RomanText only: add scoreExtensions for MusicXML too)
+    :param exclude: patterns of file names to leave out in directories (by default, automatic analyses)
+    :return: list
+    """
+    found = set()
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                for name in files:
+                    if name.lower().endswith(extensions) and \
+                            not any(fnmatch.fnmatch(name.lower(), x) for x in exclude):
+                        found.add(os.path.join(root, name))
+        elif os.path.isfile(path):
+            found.add(path)
+        else:
+            found.update(x for x in glob.glob(path, recursive=True) if os.path.isfile(x))
+    return sorted(found)
+
+
+def parseAnalysis(path: str):
+    """
+    Parses one harmonic analysis file with music21.
+    """
+    from music21 import converter
+    if path.lower().endswith(romanTextExtensions):
+        return converter.parse(path, format='romantext')
+    return converter.parse(path)
+
+
+def outputPath(path: str,
+               inRoot: str,
+               outDir: str) -> str:
+    """
+    Where to write the output for one piece:
+    the same relative path in outDir as the input in inRoot, with a .musicxml extension.
+    """
+    relative = os.path.relpath(path, inRoot)
+    return os.path.join(outDir, os.path.splitext(relative)[0] + '.musicxml')
+
+
+def cacheFor(cacheDir: str) -> featureCache.FeatureCache:
+    """
+    The FeatureCache for a directory in this process (made on first use).
+    """
+    if cacheDir not in openCaches:
+        openCaches[cacheDir] = featureCache.FeatureCache(cacheDir)
+    return openCaches[cacheDir]
+
+
+def startWorker(tablesPath: str = None):
+    """
+    Sets up a worker process for a run: loads the tables (see tableCompiler.loadTables)
+    and starts the WindowCache that every piece in this worker shares.
+    """
+    global workerWindowCache
+    tableCompiler.loadTables(tablesPath)
+    workerWindowCache = bassToFormFunction.WindowCache()
+
+
+def analysePiece(path: str,
+                 outPath: str = None,
+                 cacheDir: str = None,
+                 profile: bool = False,
+                 export: bool = False,
+                 windowCache: bassToFormFunction.WindowCache = None) -> dict:
+    """
+    Analyses one piece and (optionally) writes the annotated score to outPath.
+
+    Never raises: any error is caught and recorded in the returned summary row.
+
+    :param path: path to the analysis file
+    :param outPath: where to write the annotated score (MusicXML); None for no output
+    :param cacheDir: directory of a featureCache.FeatureCache to use; None for no cache
+    :param profile: if True, the row includes a 'profile' (the dict of a profiling.Profile)
+    :param export: if True, the row includes the 'annotations' (see annotationExport.annotationRows)
+    :param windowCache: the bassToFormFunction.WindowCache to use; None for this worker's (if any)
+    :return: dict with the summaryFields
+    """
+    if windowCache is None:
+        windowCache = workerWindowCache
+    startTime = time.perf_counter()
+    row = {'path': path, 'status': 'ok', 'chords': 0, 'formFunctions': 0, 'output': '', 'error': ''}
+    thisProfile = profiling.Profile() if profile else profiling.nullProfile
+    try:
+        cache = cacheFor(cacheDir) if cacheDir else None
+        with thisProfile.stage('cache'):
+            features = cache.get(path) if cache else None
+        if features is not None and not outPath:
+            # No need to parse at all
+            analysis = bassToFormFunction.Analysis(features=features, profile=thisProfile,
+                                                   windowCache=windowCache)
+        else:
+            with thisProfile.stage('parse'):
+                score = parseAnalysis(path)
+            analysis = bassToFormFunction.Analysis.fromPart(score, features, thisProfile, windowCache)
+            if cache and features is None:
+                with thisProfile.stage('cache'):
+                    cache.put(path, analysis.features)
+        row['chords'] = len(analysis.chords)
+        row['formFunctions'] = len(analysis.findFormFunctions())
+        if export:
+            bassToFormFunction.generateHigherOrder(analysis.allFFInPractice)
+            row['annotations'] = annotationExport.annotationRows(analysis.allFFInPractice, path)
+        if outPath:
+            analysis.writeInScore()
+            with thisProfile.stage('output'):
+                os.makedirs(os.path.dirname(outPath) or '.', exist_ok=True)
+                score.write('musicxml', fp=outPath)
+            row['output'] = outPath
+    except Exception as e:  # One bad file should not stop the batch
+        row['status'] = 'error'
+        row['error'] = f'{type(e).__name__}: {e}'
+    row['seconds'] = round(time.perf_counter() - startTime, 4)
+    if profile:
+        row['profile'] = thisProfile.toDict()
+    return row
+
+
+def runCorpus(paths: list,
+              outDir: str = None,
+              workers: int = None,
+              summaryPath: str = None,
+              cacheDir: str = None,
+              profilePath: str = None,
+              exportPath: str = None,
+              tablesPath: str = None,
+              extensions: tuple = defaultExtensions,
+              exclude: tuple = automaticNames) -> list:
+    """
+    Analyses every piece found in paths (see findAnalyses) in a process pool.
+
+    :param paths: list of files, directories and/or glob patterns
+    :param outDir: directory for the per-piece outputs (and, by default, the summary); None for neither
+    :param workers: number of worker processes (default: one per core); 1 to run in this process
+    :param summaryPath: where to write the summary table (CSV); defaults to outDir/summary.csv
+    :param cacheDir: directory for a cache of the chord features (see featureCache.py); None for no cache
+    :param profilePath: where to write the profile of the whole run (.json, or otherwise CSV); None for none
+    :param exportPath: where to write the table of all form functions (see annotationExport.py); None for none
+    :param tablesPath: a compiled table set to use in place of the built-in tables (see tableCompiler.py)
+    :param extensions: the file extensions to look for in directories (see findAnalyses)
+    :param exclude: patterns of file names to leave out in directories (see findAnalyses)
+    :return: the summary rows (dicts), in the order of the input files
+    """
+    analyses = findAnalyses(paths, extensions, exclude)
+    if not analyses:
+        return []
+    inRoot = os.path.commonpath([os.path.dirname(os.path.abspath(x)) for x in analyses])
+    outPaths = [outputPath(os.path.abspath(x), inRoot, outDir) if outDir else None for x in analyses]
+
+    options = (cacheDir, bool(profilePath), bool(exportPath))
+    if workers == 1:
+        with (tableCompiler.tablesInUse(tableCompiler.TableSet.read(tablesPath)) if tablesPath
+              else contextlib.nullcontext()):
+            windowCache = bassToFormFunction.WindowCache()
+            rows = [analysePiece(x, y, *options, windowCache) for x, y in zip(analyses, outPaths)]
+    else:
+        rows = [None] * len(analyses)
+        with ProcessPoolExecutor(max_workers=workers, initializer=startWorker,
+                                 initargs=(tablesPath,)) as executor:
+            futures = {executor.submit(analysePiece, x, y, *options): i
+                       for i, (x, y) in enumerate(zip(analyses, outPaths))}
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    rows[i] = future.result()
+                except Exception as e:  # e.g. the worker process died
+                    rows[i] = {'path': analyses[i], 'status': 'error', 'chords': 0, 'formFunctions': 0,
+                               'seconds': 0, 'output': '', 'error': f'{type(e).__name__}: {e}'}
+
+    if summaryPath is None and outDir:
+        summaryPath = os.path.join(outDir, 'summary.csv')
+    if summaryPath:
+        writeSummary(rows, summaryPath)
+    if profilePath:
+        profile = profiling.Profile()
+        for row in rows:
+            profile.merge(row.get('profile', {}))
+        os.makedirs(os.path.dirname(profilePath) or '.', exist_ok=True)
+        profile.write(profilePath)
+    if exportPath:
+        os.makedirs(os.path.dirname(exportPath) or '.', exist_ok=True)
+        annotationExport.writeAnnotations([x for row in rows for x in row.get('annotations', [])],
+                                          exportPath)
+    return rows
+
+
+def writeSummary(rows: list,
+                 summaryPath: str):
+    """
+    Writes the summary rows to a CSV file.
+    """
+    os.makedirs(os.path.dirname(summaryPath) or '.', exist_ok=True)
+    with open(summaryPath, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=summaryFields, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Form function analysis of a corpus of harmonic analyses.')
+    parser.add_argument('paths', nargs='+',
+                        help='analysis files, directories (searched recursively), or glob patterns')
+    parser.add_argument('-o', '--outDir', default=None,
+                        help='directory for the annotated scores and summary.csv')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='number of worker processes (default: one per core)')
+    parser.add_argument('-s', '--summary', default=None,
+                        help='path for the summary CSV (default: OUTDIR/summary.csv)')
+    parser.add_argument('-c', '--cacheDir', default=None,
+                        help='directory for a cache of the chord features, to skip parsing on repeat runs')
+    parser.add_argument('-p', '--profile', default=None,
+                        help='write a profile of the run (stage times, counters) to this .json or .csv file')
+    parser.add_argument('-e', '--export', default=None,
+                        help='write every form function found to this .json, .jsonl, .csv, .npz or .parquet file')
+    parser.add_argument('-t', '--tables', default=None,
+                        help='a compiled table set to use in place of the built-in tables (see tableCompiler.py)')
+    parser.add_argument('--scores', action='store_true',
+                        help='in directories, also analyse scores (.mxl, .musicxml, .xml), not just RomanText')
+    parser.add_argument('--automatic', action='store_true',
+                        help='in directories, also analyse the automatic analyses (e.g. analysis_automatic.rntxt)')
+    parsed = parser.parse_args(args)
+
+    rows = runCorpus(parsed.paths, parsed.outDir, parsed.workers, parsed.summary, parsed.cacheDir,
+                     parsed.profile, parsed.export, parsed.tables,
+                     defaultExtensions + (scoreExtensions if parsed.scores else ()),
+                     () if parsed.automatic else automaticNames)
+    errors = [x for x in rows if x['status'] != 'ok']
+    print(f'{len(rows)} pieces analysed, {len(errors)} errors.')
+    for row in errors:
+        print(f"{row['path']}: {row['error']}")
+    return rows
+
+
+# ------------------------------------------------------------------------------
+
+class Test(unittest.TestCase):
+
+    def testRunCorpus(self):
+        """
+        Two good files (one in a subdirectory) and one bad one.
+        """
+        import tempfile
+        with tempfile.TemporaryDirectory() as tempDir:
+            inDir = os.path.join(tempDir, 'in')
+            os.makedirs(os.path.join(inDir, 'sub'))
+            analysis = 'Time Signature: 4/4\n\nm1 C: I b2 IV64 b3 I b4 V43\nm2 I6 b2 IV b3 V7 b4 I\n'
+            for name in ['a.txt', os.path.join('sub', 'a.txt')]:
+                with open(os.path.join(inDir, name), 'w') as f:
+                    f.write(analysis)
+            with open(os.path.join(inDir, 'bad.mxl'), 'w') as f:
+                f.write('Not a compressed MusicXML file.')
+
+            outDir = os.path.join(tempDir, 'out')
+            extensions = defaultExtensions + scoreExtensions  # For bad.mxl
+            self.assertEqual(len(runCorpus([inDir], workers=1)), 2)
+            for workers in [1, 2]:
+                rows = runCorpus([inDir], outDir, workers=workers, extensions=extensions)
+                self.assertEqual([os.path.relpath(x['path'], inDir) for x in rows],
+                                 ['a.txt', 'bad.mxl', os.path.join('sub', 'a.txt')])
+                self.assertEqual([x['status'] for x in rows], ['ok', 'error', 'ok'])
+                self.assertEqual(rows[0]['formFunctions'], 4)
+                self.assertTrue(os.path.isfile(os.path.join(outDir, 'sub', 'a.musicxml')))
+                self.assertTrue(os.path.isfile(os.path.join(outDir, 'summary.csv')))
+
+            # With a cache: the second run (with no scores to write) needs no parsing.
+            cacheDir = os.path.join(tempDir, 'cache')
+            first = runCorpus([inDir], workers=1, cacheDir=cacheDir, extensions=extensions)
+            self.assertEqual(len(featureCache.FeatureCache(cacheDir).entries()), 1)  # Same content, same entry
+            second = runCorpus([inDir], workers=1, cacheDir=cacheDir, extensions=extensions)
+            self.assertEqual([x['formFunctions'] for x in first], [x['formFunctions'] for x in second])
+
+            # Profiled
+            profilePath = os.path.join(tempDir, 'profile.json')
+            runCorpus([inDir], workers=2, profilePath=profilePath, extensions=extensions)
+            with open(profilePath) as f:
+                profile = json.load(f)
+            self.assertEqual(profile['stageCalls']['parse'], 3)
+            self.assertEqual(profile['counters']['formFunctions'], 8)
+            runCorpus([inDir], workers=1, profilePath=profilePath)  # One WindowCache: the second piece is all hits
+            with open(profilePath) as f:
+                profile = json.load(f)
+            self.assertGreater(profile['counters']['windowCacheHits'], profile['counters']['windowCacheMisses'])
+
+            # Exported
+            exportPath = os.path.join(tempDir, 'formFunctions.npz')
+            runCorpus([inDir], workers=1, cacheDir=cacheDir, exportPath=exportPath)
+            columns = annotationExport.readColumns(exportPath)
+            self.assertEqual(len(columns['piece']), 8)
+            self.assertEqual(set(columns['phraseFunctionLabel']), {'Initial', 'Cadential'})
+            self.assertEqual(set(columns['piece']),
+                             {os.path.join(inDir, 'a.txt'), os.path.join(inDir, 'sub', 'a.txt')})
+
+            # With compiled tables, here lacking the cadences: only the prolongations remain.
+            tables = tableCompiler.TableSet.compile(
+                {name: [x for x in rows if x[2] != 'Cadential']
+                 for name, rows in tableCompiler.builtInSources().items() if name != 'sequences'})
+            tablesPath = os.path.join(tempDir, 'tables.json.gz')
+            tables.write(tablesPath)
+            for workers in [1, 2]:
+                rows = runCorpus([inDir], workers=workers, tablesPath=tablesPath, extensions=extensions)
+                self.assertEqual([x['formFunctions'] for x in rows], [2, 0, 2])
+            self.assertEqual(runCorpus([inDir], workers=1)[0]['formFunctions'], 4)  # Put back after
+
+    def testAsScript(self):
+        """
+        The command-line tools run as scripts, as well as with python -m.
+        """
+        import subprocess
+        import sys
+        import tempfile
+        here = os.path.dirname(os.path.abspath(__file__))
+        with tempfile.TemporaryDirectory() as tempDir:
+            tablesPath = os.path.join(tempDir, 'tables.json')
+            for args in [['corpusRunner.py', tempDir, '-w', '1'], ['tableCompiler.py', tablesPath],
+                         ['benchmark.py', '--help'], ['analysisServer.py', '-w', '0']]:
+                out = subprocess.run([sys.executable] + args, capture_output=True, text=True, cwd=here,
+                                     input='{"id": 1, "op": "ping"}\n')
+                self.assertEqual(out.returncode, 0, out.stderr)
+            self.assertTrue(os.path.isfile(tablesPath))
+
+    def testWhenInRomeLayout(self):
+        """
+        By default, each piece once, from its (human) analysis: not the score or the automatic analysis.
+        """
+        import tempfile
+        with tempfile.TemporaryDirectory() as tempDir:
+            names = ['analysis.rntxt', 'analysis_automatic.rntxt', 'score.mxl']
+            for piece in ['Op1_No1', 'Op1_No2']:
+                os.makedirs(os.path.join(tempDir, piece))
+                for name in names:
+                    with open(os.path.join(tempDir, piece, name), 'w') as f:
+                        f.write('')
+
+            def found(*args):
+                return [os.path.relpath(x, tempDir) for x in findAnalyses([tempDir], *args)]
+
+            self.assertEqual(found(), [os.path.join('Op1_No1', 'analysis.rntxt'),
+                                       os.path.join('Op1_No2', 'analysis.rntxt')])
+            self.assertEqual(len(found(defaultExtensions + scoreExtensions)), 4)
+            self.assertEqual(len(found(defaultExtensions + scoreExtensions, ())), 6)
+            # Files named explicitly are always taken
+            self.assertEqual(len(findAnalyses([os.path.join(tempDir, 'Op1_No1', 'score.mxl')])), 1)
+
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,355 @@
+"""
+===============================
+Feature Cache (featureCache.py)
+===============================
+
+
+LICENCE:
+===============================
+
+Creative Commons Attribution-ShareAlike 4.0 International License
+https://creativecommons.org/licenses/by-sa/4.0/
+
+
+ABOUT:
+===============================
+
+Persistent, on-disk cache of the chord features (featureTable.FeatureTable)
+extracted from each analysis file,
+so that repeat runs over a corpus need not parse the files with music21 again.
+
+Entries are keyed by a hash of the file's content and the music21 version
+(so an edited file or a new music21 is a miss, not a stale hit).
+Each entry is a binary .npy file of one row per chord
+(bass scale degree, figure bitmask, quarterLength, offset, key index, bass step)
+which is memory-mapped on loading,
+plus a small .json file with the key names.
+
+The cache is kept within a maximum total size (and number of entries)
+by evicting the least recently used entries.
+Each FeatureCache keeps a running count of the size and number of entries,
+so the directory is only listed again when that count approaches the limits
+(and then, when over, evicts in a batch, down to lowWater of the limits).
+Other processes writing to the same directory are only seen at those checks,
+which come at least each time this process has written half of the room it saw at the last,
+so several writers can run over the limits a little (never by more than that room) before evicting.
+
+"""
+
+# ------------------------------------------------------------------------------
+
+import hashlib
+import json
+import os
+import unittest
+
+import numpy as np
+
+from . import featureTable
+
+
+# ------------------------------------------------------------------------------
+
+cacheFormatVersion = 2
+
+rowType = np.dtype([('bassScaleDegree', np.int8),
+                    ('figureMask', np.int64),
+                    ('quarterLength', np.float64),
+                    ('offset', np.float64),
+                    ('keyIndex', np.int16),
+                    ('bassStep', np.int8)])
+
+
+def music21Version() -> str:
+    try:
+        import music21
+        return music21.__version__
+    except ImportError:
+        return ''
+
+
+class FeatureCache:
+    """
+    A directory of cached FeatureTables.
+
+    Typical use:
+    >>> cache = FeatureCache('~/.cache/formFunction')  # doctest: +SKIP
+    >>> features = cache.get(path)  # doctest: +SKIP
+    >>> if features is None:  # doctest: +SKIP
+    ...     features = cache.put(path, featureTable.FeatureTable(rns))
+    """
+
+    def __init__(self,
+                 cacheDir: str,
+                 maxBytes: int = 2 ** 30,
+                 maxEntries: int = None,
+                 lowWater: float = 0.9):
+        """
+        :param cacheDir: the directory for the cache (created if need be)
+        :param maxBytes: maximum total size of the cache files
+        :param maxEntries: maximum number of entries (None for no limit)
+        :param lowWater: when evicting, the fraction of the limits to evict down to
+        """
+        self.cacheDir = os.path.expanduser(cacheDir)
+        self.maxBytes = maxBytes
+        self.maxEntries = maxEntries
+        self.lowWater = lowWater
+        self.version = music21Version()
+        self.hits = 0
+        self.misses = 0
+        self.scans = 0
+        # The running count (from the last listing plus writes since), and when to list the directory again
+        self.totalBytes = None
+        self.totalEntries = None
+        self.checkBytes = None
+        self.checkEntries = None
+        os.makedirs(self.cacheDir, exist_ok=True)
+
+    def key(self, path: str) -> str:
+        """
+        The cache key for a file: a hash of its content, the music21 version and the cache format.
+        """
+        h = hashlib.sha256()
+        h.update(f'{cacheFormatVersion}|{self.version}|'.encode())
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(2 ** 20), b''):
+                h.update(block)
+        return h.hexdigest()
+
+    def entryPaths(self, key: str) -> tuple:
+        return (os.path.join(self.cacheDir, key + '.npy'),
+                os.path.join(self.cacheDir, key + '.json'))
+
+    def get(self, path: str):
+        """
+        Returns the cached FeatureTable for the file at `path` (memory-mapped) or None if not cached.
+        """
+        arrayPath, metadataPath = self.entryPaths(self.key(path))
+        try:
+            rows = np.load(arrayPath, mmap_mode='r')
+            with open(metadataPath) as f:
+                metadata = json.load(f)
+        except (OSError, ValueError):  # missing, or evicted / written part way through
+            self.misses += 1
+            return None
+        try:
+            os.utime(arrayPath)  # Mark as recently used
+        except OSError:  # Evicted by another process since: the rows already loaded are still good
+            pass
+        self.hits += 1
+        return featureTable.FeatureTable.fromArrays(rows['bassScaleDegree'],
+                                                    rows['figureMask'],
+                                                    rows['quarterLength'],
+                                                    rows['offset'],
+                                                    rows['keyIndex'],
+                                                    metadata['keys'],
+                                                    bassSteps=rows['bassStep'])
+
+    def put(self, path: str, features: featureTable.FeatureTable):
+        """
+        Stores the FeatureTable for the file at `path`, evicting old entries if need be.
+
+        :return: the features (unchanged)
+        """
+        arrayPath, metadataPath = self.entryPaths(self.key(path))
+        rows = np.zeros(len(features), dtype=rowType)
+        rows['bassScaleDegree'] = features.bassScaleDegrees
+        rows['figureMask'] = features.figureMasks
+        rows['quarterLength'] = features.quarterLengths
+        rows['offset'] = features.offsets
+        rows['keyIndex'] = features.keyIndices
+        rows['bassStep'] = features.bassSteps
+
+        if self.totalBytes is None:
+            self.recount()
+        replaced = self.entrySize(arrayPath, metadataPath)
+
+        # Write to temporary files and rename so no reader ever sees part of an entry.
+        temporary = f'.{os.getpid()}.tmp'
+        with open(metadataPath + temporary, 'w') as f:
+            json.dump({'keys': features.keys, 'path': os.path.abspath(path)}, f)
+        with open(arrayPath + temporary, 'wb') as f:
+            np.save(f, rows)
+        os.replace(metadataPath + temporary, metadataPath)
+        os.replace(arrayPath + temporary, arrayPath)
+
+        self.totalBytes += self.entrySize(arrayPath, metadataPath) - (replaced or 0)
+        self.totalEntries += replaced is None
+        if self.totalBytes > self.checkBytes or self.totalEntries > self.checkEntries:
+            self.evict()
+        return features
+
+    def getOrMake(self, path: str, makeFeatures):
+        """
+        Returns the cached FeatureTable for the file at `path`,
+        or makes it with makeFeatures(path), caches it, and returns that.
+        """
+        features = self.get(path)
+        if features is None:
+            features = self.put(path, makeFeatures(path))
+        return features
+
+    def entrySize(self, *entryPaths) -> int:
+        """
+        The total size of the files of one entry (None if there are none).
+        """
+        size = None
+        for entryPath in entryPaths:
+            try:
+                size = (size or 0) + os.stat(entryPath).st_size
+            except OSError:
+                pass
+        return size
+
+    def entries(self) -> list:
+        """
+        All entries as (last used time, total size in bytes, key), least recently used first.
+        """
+        self.scans += 1
+        out = []
+        for name in os.listdir(self.cacheDir):
+            if not name.endswith('.npy'):
+                continue
+            key = name[:-4]
+            size = 0
+            lastUsed = 0
+            for entryPath in self.entryPaths(key):
+                try:
+                    stat = os.stat(entryPath)
+                except OSError:
+                    continue
+                size += stat.st_size
+                lastUsed = max(lastUsed, stat.st_mtime)
+            out.append((lastUsed, size, key))
+        return sorted(out)
+
+    def recount(self, entries: list = None):
+        """
+        Sets the running count from a listing of the directory (made now if not given)
+        and when to check it again: halfway to each limit, or at the limit when that is close.
+        """
+        if entries is None:
+            entries = self.entries()
+        self.totalBytes = sum(x[1] for x in entries)
+        self.totalEntries = len(entries)
+        maxEntries = self.maxEntries if self.maxEntries is not None else float('inf')
+        self.checkBytes = min(self.maxBytes, self.totalBytes + max((self.maxBytes - self.totalBytes) / 2,
+                                                                   self.maxBytes * (1 - self.lowWater) / 2))
+        self.checkEntries = min(maxEntries, self.totalEntries + max((maxEntries - self.totalEntries) / 2,
+                                                                    maxEntries * (1 - self.lowWater) / 2))
+
+    def evict(self):
+        """
+        If the cache is over maxBytes or maxEntries,
+        removes the least recently used entries until it is within lowWater of both.
+        """
+        entries = self.entries()
+        totalBytes = sum(x[1] for x in entries)
+        maxEntries = self.maxEntries if self.maxEntries is not None else float('inf')
+        if totalBytes > self.maxBytes or len(entries) > maxEntries:
+            while entries and (totalBytes > self.maxBytes * self.lowWater or
+                               len(entries) > maxEntries * self.lowWater):
+                lastUsed, size, key = entries.pop(0)
+                for entryPath in self.entryPaths(key):
+                    try:
+                        os.remove(entryPath)
+                    except OSError:
+                        pass
+                totalBytes -= size
+        self.recount(entries)
+
+    def clear(self):
+        """
+        Removes every entry.
+        """
+        for lastUsed, size, key in self.entries():
+            for entryPath in self.entryPaths(key):
+                try:
+                    os.remove(entryPath)
+                except OSError:
+                    pass
+        self.recount([])
+
+
+# ------------------------------------------------------------------------------
+
+class Test(unittest.TestCase):
+
+    def testCache(self):
+        import tempfile
+        import time
+        from music21 import roman
+
+        rns = [roman.RomanNumeral(x, 'a') for x in ['i', 'V43', 'i6', 'iv', 'V7', 'i']]
+        features = featureTable.FeatureTable(rns)
+
+        with tempfile.TemporaryDirectory() as tempDir:
+            cache = FeatureCache(os.path.join(tempDir, 'cache'), maxEntries=2, lowWater=1.0)
+            paths = []
+            for i in range(3):
+                paths.append(os.path.join(tempDir, f'{i}.txt'))
+                with open(paths[-1], 'w') as f:
+                    f.write(f'Piece {i}')
+
+            self.assertIsNone(cache.get(paths[0]))
+            cache.put(paths[0], features)
+            cached = cache.get(paths[0])
+            self.assertFalse(cached.bassScaleDegrees.flags.owndata)  # a view of the memory-mapped file
+            for attribute in ['bassScaleDegrees', 'bassSteps', 'figureMasks', 'quarterLengths', 'runStarts']:
+                self.assertEqual(getattr(cached, attribute).tolist(), getattr(features, attribute).tolist())
+            self.assertEqual(cached.key(0), 'a')
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+            # Changed content -> miss
+            with open(paths[0], 'a') as f:
+                f.write(' (revised)')
+            self.assertIsNone(cache.get(paths[0]))
+
+            # Eviction of the least recently used
+            cache.getOrMake(paths[1], lambda x: features)
+            time.sleep(0.01)
+            cache.getOrMake(paths[2], lambda x: features)
+            time.sleep(0.01)
+            cache.getOrMake(paths[0], lambda x: features)
+            self.assertEqual(len(cache.entries()), 2)
+            self.assertIsNone(cache.get(paths[1]))
+            self.assertIsNotNone(cache.get(paths[2]))
+
+            cache.clear()
+            self.assertEqual(cache.entries(), [])
+
+    def testEvictInBatches(self):
+        """
+        Filling a cache lists the directory a few times, not once per entry,
+        and evicts down to the low water mark when over the limit.
+        """
+        import tempfile
+        features = featureTable.FeatureTable.fromArrays([1, 5, 1], [featureTable.figuresToMask((5, 3))] * 3,
+                                                        [1.0] * 3)
+        with tempfile.TemporaryDirectory() as tempDir:
+            cache = FeatureCache(os.path.join(tempDir, 'cache'), maxEntries=100, lowWater=0.8)
+            for i in range(300):
+                path = os.path.join(tempDir, f'{i}.txt')
+                with open(path, 'w') as f:
+                    f.write(f'Piece {i}')
+                cache.put(path, features)
+                self.assertLessEqual(cache.totalEntries, 100)
+                self.assertEqual(cache.totalEntries, len(os.listdir(cache.cacheDir)) // 2)
+            self.assertLess(cache.scans, 30)
+            self.assertEqual(len(cache.entries()), cache.totalEntries)
+            self.assertGreaterEqual(cache.totalEntries, 80)
+
+            # Another process's writes are counted at the next check
+            other = FeatureCache(cache.cacheDir, maxEntries=100, lowWater=0.8)
+            for i in range(300, 330):
+                path = os.path.join(tempDir, f'{i}.txt')
+                with open(path, 'w') as f:
+                    f.write(f'Piece {i}')
+                (cache if i % 2 else other).put(path, features)
+            self.assertLessEqual(len(cache.entries()), 100 + 10)
+
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,407 @@
+"""
+===============================
+Feature Table (featureTable.py)
+===============================
+
+
+LICENCE:
+===============================
+
+Creative Commons Attribution-ShareAlike 4.0 International License
+https://creativecommons.org/licenses/by-sa/4.0/
+
+
+ABOUT:
+===============================
+
+Compact, per-piece table of the chord features used in the form function analysis:
+bass scale degree, figures (as bitmasks), quarterLength, offset and key.
+
+These are extracted from the music21 RomanNumeral objects once, in a single pass,
+so that nothing downstream needs to call bassScaleDegreeFromNotation()
+or figuresNotationObj.numbers again.
+
+"""
+
+# ------------------------------------------------------------------------------
+
+import unittest
+
+import numpy as np
+
+
+# ------------------------------------------------------------------------------
+
+def figuresToMask(figures) -> int:
+    """
+    Encodes a collection of figure numbers as an integer bitmask:
+    bit n is set iff figure n is present.
+    Example: (6, 4, 3) -> 0b1011000 (= 88)
+
+    :param figures: figure numbers, such as figuresNotationObj.numbers
+    :return: int
+    """
+    mask = 0
+    for fig in figures:
+        mask |= 1 << fig
+    return mask
+
+
+def maskToFigures(mask: int) -> tuple:
+    """
+    Decodes an integer bitmask (see figuresToMask) into figure numbers, from highest to lowest,
+    as in figuresNotationObj.numbers.
+    Example: 88 -> (6, 4, 3)
+
+    :param mask: int
+    :return: tuple
+    """
+    mask = int(mask)
+    return tuple(fig for fig in range(mask.bit_length() - 1, -1, -1) if mask >> fig & 1)
+
+
+def runLengthEncode(values) -> tuple:
+    """
+    Run-length encodes a sequence (e.g. the bass scale degrees of a whole piece) in one vectorised step.
+    Returns three integer arrays: the start index, length, and value of each run.
+    Example: [1, 1, 2, 2, 3, 3, 3, 3, 4, 1, 1, 1] ->
+    starts [0, 2, 4, 8, 9], lengths [2, 2, 4, 1, 3], values [1, 2, 3, 4, 1]
+
+    :param values: a 1-D array (or list) of integers
+    :return: tuple of (starts, lengths, values)
+    """
+    values = np.asarray(values)
+    if not len(values):
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty.copy(), values[:0]
+    starts = np.concatenate(([0], np.flatnonzero(values[1:] != values[:-1]) + 1))
+    lengths = np.diff(np.append(starts, len(values)))
+    return starts, lengths, values[starts]
+
+
+class ChordRecord:
+    """
+    The features of one chord: a lightweight stand-in for a music21 RomanNumeral
+    with just what the form function matching needs.
+
+    `index` is the position of the chord in its piece (and FeatureTable),
+    which is how to get back to the RomanNumeral itself when it comes to annotating the score.
+    It is None for a record made from a RomanNumeral alone (not from a piece), which cannot be written back.
+    """
+
+    __slots__ = ('index', 'bassScaleDegree', 'figureMask', 'quarterLength', 'offset')
+
+    def __init__(self,
+                 index: int = None,
+                 bassScaleDegree: int = 0,
+                 figureMask: int = 0,
+                 quarterLength: float = 0.0,
+                 offset: float = 0.0):
+        self.index = index
+        self.bassScaleDegree = bassScaleDegree
+        self.figureMask = figureMask
+        self.quarterLength = quarterLength
+        self.offset = offset
+
+    @classmethod
+    def fromRomanNumeral(cls, rn, index: int = None):
+        return cls(index,
+                   rn.bassScaleDegreeFromNotation() or 0,
+                   figuresToMask(rn.figuresNotationObj.numbers),
+                   float(rn.quarterLength),
+                   float(rn.offset))
+
+    @property
+    def figures(self) -> tuple:
+        """
+        The figure numbers (as in figuresNotationObj.numbers).
+        """
+        return maskToFigures(self.figureMask)
+
+    def hasFigure(self, fig: int) -> bool:
+        return bool(self.figureMask >> fig & 1)
+
+    def __repr__(self):
+        return f'<ChordRecord {self.index}: bass {self.bassScaleDegree}, figures {self.figures}>'
+
+
+class FeatureTable:
+    """
+    The chord features of a whole piece (or analysis) in parallel arrays,
+    one entry per RomanNumeral in the order given.
+    Keys are stored as an index (keyIndices) into a list of key names (keys), e.g. ['C', 'a'].
+    The bass is stored both as a scale degree (in the key of the chord)
+    and as a step (the letter name, C = 0 to B = 6, regardless of key) for intervals across modulations.
+
+    Also the run-length encoding of the bass line:
+    runStarts, runLengths and runDegrees (one entry per change of bass),
+    and runIndex (the run that each chord belongs to).
+    """
+
+    def __init__(self, rns: list = ()):
+        """
+        :param rns: list of Roman Numerals.
+            For their offsets to be those in the piece (rather than in the measure),
+            take them from a flat stream (e.g. part.flatten()).
+        """
+        self.rns = rns
+        self.bassScaleDegrees = np.zeros(len(rns), dtype=np.int8)
+        self.bassSteps = np.zeros(len(rns), dtype=np.int8)
+        self.figureMasks = np.zeros(len(rns), dtype=np.int64)
+        self.quarterLengths = np.zeros(len(rns), dtype=np.float64)
+        self.offsets = np.zeros(len(rns), dtype=np.float64)
+        self.keyIndices = np.zeros(len(rns), dtype=np.int16)
+        self.keys = []
+
+        keyLookup = {}
+        for index, rn in enumerate(rns):
+            self.bassScaleDegrees[index] = rn.bassScaleDegreeFromNotation() or 0
+            bass = rn.bass()
+            self.bassSteps[index] = (bass.diatonicNoteNum - 1) % 7 if bass is not None else 0
+            self.figureMasks[index] = figuresToMask(rn.figuresNotationObj.numbers)
+            self.quarterLengths[index] = rn.quarterLength
+            self.offsets[index] = rn.offset
+            keyName = rn.key.tonicPitchNameWithCase if rn.key else ''
+            if keyName not in keyLookup:
+                keyLookup[keyName] = len(self.keys)
+                self.keys.append(keyName)
+            self.keyIndices[index] = keyLookup[keyName]
+
+        self.makeRuns()
+
+    @classmethod
+    def fromArrays(cls,
+                   bassScaleDegrees,
+                   figureMasks,
+                   quarterLengths,
+                   offsets=None,
+                   keyIndices=None,
+                   keys: list = None,
+                   rns: list = None,
+                   bassSteps=None):
+        """
+        Makes a FeatureTable directly from its arrays
+        (e.g. as loaded from a cache), without any Roman Numerals.
+
+        Without bassSteps, they are taken from the bass scale degrees
+        (which is right as long as the key does not change).
+        """
+        table = cls()
+        table.rns = rns
+        table.bassScaleDegrees = np.asarray(bassScaleDegrees)
+        table.figureMasks = np.asarray(figureMasks)
+        table.quarterLengths = np.asarray(quarterLengths)
+        size = len(table.bassScaleDegrees)
+        table.offsets = np.zeros(size) if offsets is None else np.asarray(offsets)
+        table.keyIndices = np.zeros(size, dtype=np.int16) if keyIndices is None else np.asarray(keyIndices)
+        table.keys = list(keys) if keys else ['']
+        if bassSteps is None:
+            table.bassSteps = ((table.bassScaleDegrees.astype(np.int8) - 1) % 7).astype(np.int8)
+        else:
+            table.bassSteps = np.asarray(bassSteps)
+        table.makeRuns()
+        return table
+
+    def makeRuns(self):
+        """
+        (Re)computes the run-length encoding of the bass line.
+        """
+        self.runStarts, self.runLengths, self.runDegrees = runLengthEncode(self.bassScaleDegrees)
+        self.runIndex = np.repeat(np.arange(len(self.runStarts)), self.runLengths)
+
+    def splice(self,
+               start: int,
+               stop: int,
+               rns: list,
+               allRns: list = None):
+        """
+        A new FeatureTable with the chords from start up to (not including) stop
+        replaced by those of the Roman Numerals `rns`,
+        so that only those new chords need their features extracting (e.g. after an edit).
+
+        :param start: the first chord to replace
+        :param stop: the chord after the last one to replace
+        :param rns: the new Roman Numerals (any number)
+        :param allRns: the Roman Numerals of the whole new table, if any (for its rns attribute).
+            The offsets of the chords after the change all move by the same amount as the first of them,
+            so only that one's offset is read.
+        :return: FeatureTable
+        """
+        middle = FeatureTable(rns)
+        keys = list(self.keys)
+        keyLookup = {name: i for i, name in enumerate(keys)}
+        for name in middle.keys:
+            if name not in keyLookup:
+                keyLookup[name] = len(keys)
+                keys.append(name)
+        middleKeys = np.array([keyLookup[name] for name in middle.keys], dtype=np.int16)[middle.keyIndices]
+
+        def join(old, new):
+            return np.concatenate((old[:start], new.astype(old.dtype), old[stop:]))
+
+        table = FeatureTable.fromArrays(join(self.bassScaleDegrees, middle.bassScaleDegrees),
+                                        join(self.figureMasks, middle.figureMasks),
+                                        join(self.quarterLengths, middle.quarterLengths),
+                                        join(self.offsets, middle.offsets),
+                                        join(self.keyIndices, middleKeys),
+                                        keys,
+                                        allRns,
+                                        join(self.bassSteps, middle.bassSteps))
+        after = start + len(rns)
+        if allRns is not None and after < len(table):  # Later offsets move with any change in duration
+            table.offsets = table.offsets.astype(np.float64)
+            table.offsets[after:] += float(allRns[after].offset) - float(self.offsets[stop])
+        return table
+
+    def __len__(self):
+        return len(self.bassScaleDegrees)
+
+    def figures(self, index: int) -> tuple:
+        """
+        The figure numbers of the chord at `index` (as in figuresNotationObj.numbers).
+        """
+        return maskToFigures(self.figureMasks[index])
+
+    def key(self, index: int) -> str:
+        """
+        The name of the key of the chord at `index` (e.g. 'C' or 'a'; '' if unknown).
+        """
+        return self.keys[self.keyIndices[index]]
+
+    def hasFigure(self, index: int, fig: int) -> bool:
+        """
+        True iff the chord at `index` includes the figure number `fig`.
+        """
+        return bool(self.figureMasks[index] >> fig & 1)
+
+    def records(self, start: int = 0, stop: int = None) -> list:
+        """
+        The table (or the chords from start up to, not including, stop) as a list of ChordRecord objects.
+        """
+        stop = len(self) if stop is None else stop
+        return [ChordRecord(*x) for x in zip(range(start, stop),
+                                             self.bassScaleDegrees[start:stop].tolist(),
+                                             self.figureMasks[start:stop].tolist(),
+                                             self.quarterLengths[start:stop].tolist(),
+                                             self.offsets[start:stop].tolist())]
+
+    def condensedIndices(self, start: int, end: int) -> list:
+        """
+        The index of the first chord of each bass note between `start` and `end` (inclusive),
+        i.e. the chords that remain when sequential chords sharing a bass note are collapsed.
+        Example: bass line 15551 -> indices of the 1st, 2nd and 5th chords.
+
+        :param start: index of the first chord
+        :param end: index of the last chord
+        :return: list
+        """
+        firstRun = self.runIndex[start] + 1
+        lastRun = self.runIndex[end] + 1
+        return [start] + self.runStarts[firstRun:lastRun].tolist()
+
+    def segmentLengths(self, start: int, maxSegments: int) -> list:
+        """
+        The lengths of (up to) maxSegments successive bass notes from `start`
+        where the first may be the end part of a longer run.
+        Example: bass line 1155514, start 1, maxSegments 3 -> [1, 3, 1]
+
+        :param start: index of the first chord
+        :param maxSegments: the maximum number of bass notes
+        :return: list
+        """
+        if start >= len(self):
+            return []
+        run = self.runIndex[start]
+        firstLength = self.runStarts[run] + self.runLengths[run] - start
+        return [int(firstLength)] + self.runLengths[run + 1:run + maxSegments].tolist()
+
+
+# ------------------------------------------------------------------------------
+
+class Test(unittest.TestCase):
+
+    def testMasks(self):
+        for figures in [(5, 3), (6, 4, 3), (7, 5, 3), (6, 4, 2), ()]:
+            self.assertEqual(maskToFigures(figuresToMask(figures)), figures)
+        self.assertEqual(figuresToMask((6, 4, 3)), 88)
+
+    def testRunLengthEncode(self):
+        starts, lengths, values = runLengthEncode([1, 1, 2, 2, 3, 3, 3, 3, 4, 1, 1, 1])
+        self.assertEqual(starts.tolist(), [0, 2, 4, 8, 9])
+        self.assertEqual(lengths.tolist(), [2, 2, 4, 1, 3])
+        self.assertEqual(values.tolist(), [1, 2, 3, 4, 1])
+
+        # Not limited to single digits
+        starts, lengths, values = runLengthEncode([11, 11, 4, 14])
+        self.assertEqual(lengths.tolist(), [2, 1, 1])
+        self.assertEqual(values.tolist(), [11, 4, 14])
+
+        for x in runLengthEncode([]):
+            self.assertEqual(len(x), 0)
+
+    def testFeatureTable(self):
+        from music21 import roman
+        rns = [roman.RomanNumeral(x) for x in ['I', 'V43', 'I6', 'IV', 'V7', 'I']]
+        rns[-1].quarterLength = 2
+        table = FeatureTable(rns)
+        self.assertEqual(len(table), 6)
+        self.assertEqual(table.bassScaleDegrees.tolist(), [1, 2, 3, 4, 5, 1])
+        self.assertEqual(table.figures(1), (6, 4, 3))
+        self.assertTrue(table.hasFigure(4, 7))
+        self.assertFalse(table.hasFigure(3, 7))
+        self.assertEqual(table.quarterLengths.tolist(), [1, 1, 1, 1, 1, 2])
+        self.assertEqual(table.key(0), '')
+
+        records = table.records()
+        self.assertEqual([x.bassScaleDegree for x in records], [1, 2, 3, 4, 5, 1])
+        self.assertEqual(records[1].figures, (6, 4, 3))
+        self.assertEqual(records[5].quarterLength, 2)
+        self.assertEqual(ChordRecord.fromRomanNumeral(rns[4], 4).figureMask, records[4].figureMask)
+
+        import pickle
+        self.assertEqual(pickle.loads(pickle.dumps(records[1])).figures, (6, 4, 3))
+
+        copy = FeatureTable.fromArrays(table.bassScaleDegrees, table.figureMasks, table.quarterLengths)
+        self.assertEqual(copy.runStarts.tolist(), table.runStarts.tolist())
+        self.assertEqual(copy.figures(4), (7, 5, 3))
+        self.assertEqual(copy.bassSteps.tolist(), table.bassSteps.tolist())
+
+        # Bass steps are the same letters whatever the key; scale degrees are not
+        other = FeatureTable([roman.RomanNumeral('I', 'C'), roman.RomanNumeral('V', 'G')])
+        self.assertEqual(other.bassSteps.tolist(), [0, 1])  # C, D
+        self.assertEqual(other.bassScaleDegrees.tolist(), [1, 5])
+
+        # Splicing in new chords (here, replacing 2 with 3, and in a new key)
+        newRns = [roman.RomanNumeral(x, 'a') for x in ['i', 'iv6', 'V']]
+        spliced = table.splice(1, 3, newRns)
+        whole = FeatureTable(rns[:1] + newRns + rns[3:])
+        for attribute in ['bassScaleDegrees', 'bassSteps', 'figureMasks', 'quarterLengths', 'runStarts']:
+            self.assertEqual(getattr(spliced, attribute).tolist(), getattr(whole, attribute).tolist())
+        self.assertEqual([spliced.key(i) for i in range(len(spliced))],
+                         [whole.key(i) for i in range(len(whole))])
+        self.assertEqual([(x.index, x.figures) for x in spliced.records(1, 4)],
+                         [(x.index, x.figures) for x in whole.records()[1:4]])
+
+        # Offsets after the change move with it
+        offsets = [0.0, 1.0, 2.0, 3.0, 4.0, 5.0]
+        for rn, offset in zip(rns, offsets):
+            rn.offset = offset
+        table = FeatureTable(rns)
+        for rn, offset in zip(newRns, [1.0, 2.0, 3.0]):
+            rn.offset = offset
+        allRns = rns[:1] + newRns + rns[3:]
+        for rn, offset in zip(rns[3:], [4.0, 5.0, 6.0]):
+            rn.offset = offset
+        self.assertEqual(table.splice(1, 3, newRns, allRns).offsets.tolist(), [0, 1, 2, 3, 4, 5, 6])
+
+        rns = [roman.RomanNumeral(x) for x in ['I', 'V', 'V7', 'I64', 'I']]
+        self.assertEqual(FeatureTable(rns).condensedIndices(0, 4), [0, 1, 4])
+        self.assertEqual(FeatureTable(rns).condensedIndices(2, 3), [2])
+        self.assertEqual(FeatureTable(rns).segmentLengths(2, 2), [2, 1])
+        self.assertEqual(FeatureTable(rns).segmentLengths(1, 4), [3, 1])
+
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    unittest.main()
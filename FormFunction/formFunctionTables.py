@@ -34,12 +34,14 @@ Note, would need to handle multiple entries.
 (Perhaps) subclasses on FormFunctionInTheory:
 - classProlongation(FormFunctionInTheory):
 - class Cadential(FormFunctionInTheory):
-- class Sequence(FormFunctionInTheory):
+(Sequence done: see below.)
 """
 
 import unittest
 import typing as t
 
+import numpy as np
+
 
 # ------------------------------------------------------------------------------
 
@@ -54,6 +56,8 @@ class FormFunctionInTheory:
                  ):
         self.bassScaleDegrees = bassScaleDegrees
         self.requiredFigures = requiredFigures
+        # One bitmask per position (bit n for figure n, as in featureTable.figuresToMask; 0 for any)
+        self.requiredMasks = tuple(1 << fig if fig else 0 for fig in requiredFigures)
         self.whatFunctionProlonged = whatFunctionProlonged
         self.prolMedCadStream = prolMedCadStream
         self.prolMedCadType = prolMedCadType
@@ -63,10 +67,17 @@ class FormFunctionInTheory:
 
         self.makeFirstOrderLabel()
 
-        # TODO 2nd, 3rd, ... Order
-        # self.phraseFunctionLabel = None  # ['Initial', 'Medial', 'Cadential', None]
-        # self.themeFunctionLabel = None  # ['Theme', None]
-        # self.themeTypeLabel = None  # Sentence, Period, Hybrid
+        # NB: 2nd and 3rd order labels (phraseFunctionLabel, themeFunctionLabel, themeTypeLabel)
+        # depend on the context, so they are on the FormFunctionInPractice objects: see higherOrder.py
+
+    def fitsMasks(self, figureMasks) -> bool:
+        """
+        True iff chords with these figure bitmasks (one per position) have all the requiredFigures.
+        """
+        for required, mask in zip(self.requiredMasks, figureMasks):
+            if mask & required != required:
+                return False
+        return True
 
     def makeFirstOrderLabel(self):
         """
@@ -79,10 +90,66 @@ class FormFunctionInTheory:
         elif self.prolMedCadStream == 'Cadential':
             self.functionalLabel = f'{self.prolMedCadType} {self.prolMedCadStream} Progression'
             self.shortLabel = f'Cad-{self.prolMedCadStream[0:4]}'
+        elif self.prolMedCadStream == 'Sequence':
+            self.functionalLabel = f'{self.prolMedCadType} {self.prolMedCadStream}'
+            self.shortLabel = f'Seq-{self.prolMedCadType[0:3]}'
         else:
             raise ValueError
 
 
+class Sequence(FormFunctionInTheory):
+    """
+    A sequence is defined not by bass scale degrees
+    but by a cell of generic bass intervals (from each chord to the next)
+    and the figures required on each chord of that cell,
+    which repeats any number of times.
+    """
+
+    def __init__(self,
+                 bassIntervals: tuple = (),
+                 requiredFigures: tuple = (),
+                 prolMedCadType: str = '',
+                 ):
+        self.bassIntervals = bassIntervals
+        super().__init__(bassScaleDegrees=(),
+                         requiredFigures=requiredFigures,
+                         whatFunctionProlonged=None,
+                         prolMedCadStream='Sequence',
+                         prolMedCadType=prolMedCadType)
+
+
+# ------------------------------------------------------------------------------
+
+# The fixed and small collection of terms used in the tables
+prolMedCadStreams = ['Prolongation', 'Sequence', 'Cadential']
+
+functionsProlonged = ['Tonic', 'Pre-Dominant', 'Subdominant', 'Dominant', None]
+
+prolongationTypes = ['Neighbor',
+                     'Neighbor, Upper',
+                     'Neighbor, Lower',
+                     'Neighbor, Incomplete',
+                     'Neighbor, Double',
+                     'Pedal',
+                     'Passing',
+                     'Substitute',
+                     'Arpeggiating',
+                     'Harmonic',
+                     'Cambiata',
+                     None]
+
+cadentialTypes = ['Complete',
+                  'Incomplete',
+                  'Authentic',
+                  'Inauthentic',
+                  'Embellished',
+                  'Expanded',
+                  'Abandoned',
+                  'Evasion',
+                  'Deceptive Resolution',
+                  None]
+
+
 # ------------------------------------------------------------------------------
 
 prolongation3 = [
@@ -161,34 +228,93 @@ cadences4 = [
 ]
 
 
-# TODO: sequences
+# Sequences (see sequenceMatcher.py)
 # NB: generic intervals
 # NB: do not segment analysis by 'modulation' and do complete incomplete triads
 # NB: interval from chord to next (hence same number of intervals and figures)
 
-# sequencePatternList = [
-#     # See https://musescore.com/fourscoreandmore/scores/5350121
-#     # 6-6
-#     [(1, 2), (5, 6), '6-6- Ascending'],
-#     [(-2, -2), (5, 6), '6-6- Descending'],
-#     # 5-6
-#     [(1, 2), (5, 6), '5-6- Alternation Ascending'],
-#     [(-2, -2), (5, 6), '5-6- Alternation Descending'],
-#     # 7-6
-#     [(1, 2), (7, 6), '7-6- Alternation Ascending'],
-#     [(-2, -2), (7, 6), '7-6- Alternation Descending'],
-#     # Circle of fifths
-#     [(4, -5), (5, 5), 'Descending circle of fifths'],  # Bass: C, F, B
-#     [(-3, 2), (5, 6), 'Zigzag: descending circle of fifths'],  # Bass: C, A, B
-#     [(1, 5, 1, -4), (4, 3, 4, 3), '4-3- Ascending circle of fifths'],  # Bass: C, C, G, G
-#     # 2-3
-#     [(1, 2), (9, 8), '2-3- Alternation Ascending'],
-#     [(-2, 1), (2, 3), '7-6- Alternation Descending'],  # Sic (-2, 1): bass sus.
-# ]
+sequencePatternList = [
+    # See https://musescore.com/fourscoreandmore/scores/5350121
+    # 6-6: parallel first-inversion chords, bass by step
+    # (the commented-out source had the 5-6 cells here, which the 5-6 rows always shadowed)
+    [(2, 2), (6, 6), '6-6- Ascending'],
+    [(-2, -2), (6, 6), '6-6- Descending'],
+    # 5-6
+    [(1, 2), (5, 6), '5-6- Alternation Ascending'],
+    [(-2, -2), (5, 6), '5-6- Alternation Descending'],
+    # 7-6
+    [(1, 2), (7, 6), '7-6- Alternation Ascending'],
+    [(-2, -2), (7, 6), '7-6- Alternation Descending'],
+    # Circle of fifths
+    [(4, -5), (5, 5), 'Descending circle of fifths'],  # Bass: C, F, B
+    [(-3, 2), (5, 6), 'Zigzag: descending circle of fifths'],  # Bass: C, A, B
+    [(1, 5, 1, -4), (4, 3, 4, 3), '4-3- Ascending circle of fifths'],  # Bass: C, C, G, G
+    # 2-3
+    [(1, 2), (9, 8), '2-3- Alternation Ascending'],
+    [(-2, 1), (2, 3), '2-3- Alternation Descending'],  # Sic (-2, 1): bass sus.
+]
 
 
 # ------------------------------------------------------------------------------
 
+def selectFormFunction(candidates: list,
+                       figures: list):
+    """
+    Returns the FormFunctionInTheory (if any) that fits a specific set of figures.
+
+    Where more than one of the candidates fits, the later one in the tables wins.
+
+    :param candidates: list of FormFunctionInTheory objects sharing a bass pattern
+    :param figures: one list of figure numbers per chord (e.g. from figuresNotationObj.numbers)
+    :return: FormFunctionInTheory or None
+    """
+    for candidate in reversed(candidates):
+        found = True
+        for counter, fig in enumerate(candidate.requiredFigures):
+            if fig and fig not in figures[counter]:
+                found = False
+                break
+        if found:
+            return candidate
+    return None
+
+
+def selectFormFunctionByMasks(candidates: list,
+                              figureMasks: list):
+    """
+    As selectFormFunction, but for the figures as bitmasks (see featureTable.figuresToMask),
+    so each check is one AND per chord.
+
+    :param candidates: list of FormFunctionInTheory objects sharing a bass pattern
+    :param figureMasks: one figure bitmask per chord
+    :return: FormFunctionInTheory or None
+    """
+    for candidate in reversed(candidates):
+        if candidate.fitsMasks(figureMasks):
+            return candidate
+    return None
+
+
+def selectFormFunctionIndices(candidates: list,
+                              windowMasks) -> np.ndarray:
+    """
+    As selectFormFunctionByMasks, for any number of windows at once (vectorised with NumPy).
+
+    :param candidates: list of FormFunctionInTheory objects sharing a bass pattern (of length L)
+    :param windowMasks: array (windows x L) of figure bitmasks
+    :return: array with the index in candidates of the match for each window (-1 for none)
+    """
+    windowMasks = np.asarray(windowMasks, dtype=np.int64)
+    if not candidates:
+        return np.full(len(windowMasks) if windowMasks.ndim > 1 else 1, -1)
+    windowMasks = windowMasks.reshape(-1, len(candidates[0].requiredMasks))
+    required = np.array([x.requiredMasks for x in candidates], dtype=np.int64)  # candidates x L
+    fits = ((windowMasks[:, None, :] & required[None, :, :]) == required[None, :, :]).all(axis=2)
+    # The later candidate wins: the last True in each row
+    last = len(candidates) - 1 - np.argmax(fits[:, ::-1], axis=1)
+    return np.where(fits.any(axis=1), last, -1)
+
+
 def makeListOfFormFunctionObjects(data: list = prolongation3):
     """
     Converts a lists of lists into lists of FormFunctionInTheory objects.
@@ -205,10 +331,78 @@ def makeListOfFormFunctionObjects(data: list = prolongation3):
     return out_data
 
 
+def makeListOfSequenceObjects(data: list = sequencePatternList):
+    """
+    Converts a lists of lists into lists of Sequence objects.
+    """
+    return [Sequence(bassIntervals=entry[0],
+                     requiredFigures=entry[1],
+                     prolMedCadType=entry[2])
+            for entry in data]
+
+
 # ------------------------------------------------------------------------------
 
 global3 = makeListOfFormFunctionObjects(prolongation3 + pedalProlongation3 + cadences3)
 global4 = makeListOfFormFunctionObjects(prolongation4 + cadences4)
+sequences = makeListOfSequenceObjects(sequencePatternList)
+
+
+def makeLookupIndex(*tables) -> dict:
+    """
+    Indexes one or more lists of FormFunctionInTheory objects by their bass scale degrees.
+
+    The keys are tuples of bass scale degrees (so the window length is implicit in the key).
+    The values are lists of candidate FormFunctionInTheory objects in table order:
+    where more than one entry shares a bass pattern, the requiredFigures decide between them.
+
+    :param tables: any number of lists of FormFunctionInTheory objects (e.g. global3, global4)
+    :return: dict
+    """
+    index = {}
+    for table in tables:
+        for entry in table:
+            index.setdefault(tuple(entry.bassScaleDegrees), []).append(entry)
+    return index
+
+
+lookupIndex = makeLookupIndex(global3, global4)
+
+# Incremented whenever the tables are replaced (see setTables),
+# so that anything derived from them (e.g. schemaMatcher.currentAutomaton) knows to start again.
+tablesVersion = 0
+
+
+def setTables(newGlobal3: list,
+              newGlobal4: list,
+              newSequences: list = None,
+              newLookupIndex: dict = None):
+    """
+    Replaces the tables in use (global3, global4, sequences and lookupIndex), e.g. with an alternative set
+    (see tableCompiler.py).
+
+    :param newGlobal3: list of FormFunctionInTheory objects for windows of 3
+    :param newGlobal4: list of FormFunctionInTheory objects for windows of 4
+    :param newSequences: list of Sequence objects (by default, those in use now)
+    :param newLookupIndex: the lookup index of newGlobal3 and newGlobal4, if already made
+    """
+    global global3, global4, sequences, lookupIndex, tablesVersion
+    global3 = newGlobal3
+    global4 = newGlobal4
+    if newSequences is not None:
+        sequences = newSequences
+    lookupIndex = newLookupIndex if newLookupIndex is not None else makeLookupIndex(global3, global4)
+    tablesVersion += 1
+
+
+def refreshTables():
+    """
+    Rebuilds global3, global4, sequences and lookupIndex from the lists above,
+    e.g. after adding to or editing them.
+    """
+    setTables(makeListOfFormFunctionObjects(prolongation3 + pedalProlongation3 + cadences3),
+              makeListOfFormFunctionObjects(prolongation4 + cadences4),
+              makeListOfSequenceObjects(sequencePatternList))
 
 
 # ------------------------------------------------------------------------------
@@ -216,55 +410,89 @@ global4 = makeListOfFormFunctionObjects(prolongation4 + cadences4)
 class Test(unittest.TestCase):
     def testFirstOrderNaming(self):
         """
-        Test that we have only used a fixed and small collection of terms.        
+        Test that we have only used a fixed and small collection of terms.
         """
-        
+
         for item in global3:
-        
-            self.assertIn(item.prolMedCadStream,
-                          ['Prolongation',
-                           'Sequence',
-                           'Cadential']
-                          )
-            self.assertIn(item.whatFunctionProlonged,
-                          ['Tonic',
-                           'Pre-Dominant',
-                           'Subdominant',
-                           'Dominant',
-                           None]
-                          )
+
+            self.assertIn(item.prolMedCadStream, prolMedCadStreams)
+            self.assertIn(item.whatFunctionProlonged, functionsProlonged)
 
             if item.prolMedCadStream == 'Prolongation':
-                self.assertIn(item.prolMedCadType,
-                              ['Neighbor',
-                               'Neighbor, Upper',
-                               'Neighbor, Lower',
-                               'Neighbor, Incomplete',
-                               'Neighbor, Double',
-                               'Pedal',
-                               'Passing',
-                               'Substitute',
-                               'Arpeggiating',
-                               'Harmonic',
-                               'Cambiata',
-                               None]
-                              )
+                self.assertIn(item.prolMedCadType, prolongationTypes)
             elif item.prolMedCadStream == 'Cadential':
-                self.assertIn(item.prolMedCadType,
-                              ['Complete',
-                               'Incomplete',
-                               'Authentic',
-                               'Inauthentic',
-                               'Embellished',
-                               'Expanded',
-                               'Abandoned',
-                               'Evasion',
-                               'Deceptive Resolution',
-                               None]
-                              )
+                self.assertIn(item.prolMedCadType, cadentialTypes)
             else:
                 raise ValueError
 
+    def testLookupIndex(self):
+        """
+        Test that every table entry is reachable through the index and only there.
+        """
+        self.assertEqual(sum(len(x) for x in lookupIndex.values()), len(global3) + len(global4))
+        for item in global3 + global4:
+            self.assertIn(item, lookupIndex[tuple(item.bassScaleDegrees)])
+
+        cadences = lookupIndex[(4, 5, 1)]
+        self.assertEqual(len(cadences), 2)
+        self.assertEqual(cadences[0].prolMedCadType, 'Authentic')
+        self.assertNotIn((4, 5), lookupIndex)
+
+    def testMasks(self):
+        """
+        The mask checks (one and vectorised) agree with the figure checks.
+        """
+        import random
+        randomGenerator = random.Random(0)
+        options = [(5, 3), (6, 3), (6, 4), (6, 4, 3), (6, 5, 3), (7, 5, 3), (4, 2)]
+
+        def mask(figures):
+            return sum(1 << x for x in set(figures))
+
+        for pattern, candidates in lookupIndex.items():
+            windows = [[randomGenerator.choice(options) for _ in pattern] for _ in range(50)]
+            windowMasks = [[mask(x) for x in window] for window in windows]
+            expected = [selectFormFunction(candidates, window) for window in windows]
+            self.assertEqual([selectFormFunctionByMasks(candidates, x) for x in windowMasks], expected)
+            self.assertEqual([candidates[x] if x >= 0 else None
+                              for x in selectFormFunctionIndices(candidates, windowMasks).tolist()], expected)
+
+        self.assertEqual(selectFormFunctionIndices([], [[1, 2], [3, 4]]).tolist(), [-1, -1])
+        self.assertEqual(selectFormFunctionIndices([], [1, 2]).tolist(), [-1])
+
+        cadence = lookupIndex[(4, 5, 1)][0]
+        self.assertEqual(cadence.requiredMasks, (0, 1 << 7, 1 << 5))
+        self.assertTrue(cadence.fitsMasks([0, mask((7, 5, 3)), mask((5, 3))]))
+        self.assertFalse(cadence.fitsMasks([0, mask((5, 3)), mask((5, 3))]))
+
+    def testRefreshTables(self):
+        """
+        Edits to the lists above take effect (and count as new tables) on refreshTables.
+        """
+        version = tablesVersion
+        originals = global3, global4, sequences, lookupIndex
+        try:
+            cadences3.append([[4, 5, 1], [None, 7, None], 'Cadential', None, 'Test'])
+            refreshTables()
+            self.assertEqual(tablesVersion, version + 1)
+            self.assertEqual(lookupIndex[(4, 5, 1)][-1].prolMedCadType, 'Test')
+        finally:
+            cadences3.pop()
+            setTables(*originals)  # The same objects as the other modules hold
+
+    def testSequences(self):
+        """
+        Test that every sequence has one interval and one figure per chord of its cell,
+        and that no two sequences share both, or a label.
+        """
+        for item in sequences:
+            self.assertEqual(len(item.bassIntervals), len(item.requiredFigures))
+            self.assertEqual(item.prolMedCadStream, 'Sequence')
+            self.assertNotIn(0, item.bassIntervals)  # Generic: 1 is a unison
+        cells = {(tuple(x.bassIntervals), tuple(x.requiredFigures)) for x in sequences}
+        self.assertEqual(len(cells), len(sequences))
+        self.assertEqual(len({x.functionalLabel for x in sequences}), len(sequences))
+
 
 # -----------------------------------------------------------------------------
 
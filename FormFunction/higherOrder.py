@@ -0,0 +1,281 @@
+"""
+===============================
+Higher Order (higherOrder.py)
+===============================
+
+
+LICENCE:
+===============================
+
+Creative Commons Attribution-ShareAlike 4.0 International License
+https://creativecommons.org/licenses/by-sa/4.0/
+
+
+ABOUT:
+===============================
+
+Second and third order form functions, inferred from the first order ones
+(the FormFunctionInPractice objects of bassToFormFunction.py, segmentation.py, or pipeline.py):
+
+1. Phrase functions: each unit is Initial, Medial or Cadential within its phrase,
+and a phrase ends with (the first) cadential unit.
+2. Themes: phrases are grouped by their cadences into
+a sentence (initial, medial and cadential functions in one phrase with a strong cadence),
+a period (weak cadence, then a phrase beginning again with an initial function and a strong cadence), or
+a hybrid (weak cadence, then a phrase of continuation, i.e. without an initial function, to a strong cadence).
+See Caplin 1998.
+
+Both stages are streaming parsers (generators) with at most one phrase held back,
+so the cost is linear in the number of first order units,
+and nothing of the first order analysis is run again.
+The units must come in order of where they end (as from pipeline.formFunctionStream).
+
+The labels are set on the units themselves:
+phraseFunctionLabel, themeFunctionLabel ('Theme' or None) and themeTypeLabel.
+
+NB: there are no half cadences in the tables yet,
+so for now the 'weak' cadences are the cadential deviations (abandoned, evaded, deceptive).
+
+"""
+
+# ------------------------------------------------------------------------------
+
+import unittest
+
+
+# ------------------------------------------------------------------------------
+
+# NB: not None, the ambiguous cadence (e.g. IV V I without a 7th), which counts as weak
+strongCadenceTypes = ('Authentic', 'Complete', 'Incomplete')
+
+
+class Phrase:
+    """
+    A group of first order units ending with a cadence
+    (or without one, if the input ends first).
+    `functions` holds the phrase function of each unit.
+    """
+
+    def __init__(self):
+        self.units = []
+        self.functions = []
+        self.cadence = None
+
+    @property
+    def start(self) -> int:
+        return min(x.index for x in self.units)
+
+    @property
+    def end(self) -> int:
+        return max(unitEnd(x) for x in self.units)
+
+    @property
+    def hasInitial(self) -> bool:
+        return 'Initial' in self.functions
+
+    @property
+    def hasMedial(self) -> bool:
+        return 'Medial' in self.functions
+
+    @property
+    def startsWithInitial(self) -> bool:
+        first = min(range(len(self.units)), key=lambda i: (self.units[i].index, unitEnd(self.units[i])))
+        return self.functions[first] == 'Initial'
+
+    @property
+    def strongCadence(self) -> bool:
+        return self.cadence is not None and \
+            self.cadence.formFunctionInTheory.prolMedCadType in strongCadenceTypes
+
+    def add(self, unit, function: str):
+        unit.phraseFunctionLabel = function
+        self.units.append(unit)
+        self.functions.append(function)
+
+
+class Theme:
+    """
+    One or two phrases, and the type of theme they make (None if not one of the known types).
+    """
+
+    def __init__(self, phrases: list, themeTypeLabel: str = None):
+        self.phrases = phrases
+        self.themeTypeLabel = themeTypeLabel
+        for phrase in phrases:
+            for unit in phrase.units:
+                unit.themeFunctionLabel = 'Theme' if themeTypeLabel else None
+                unit.themeTypeLabel = themeTypeLabel
+
+    @property
+    def start(self) -> int:
+        return self.phrases[0].start
+
+    @property
+    def end(self) -> int:
+        return self.phrases[-1].end
+
+
+def unitEnd(unit) -> int:
+    """
+    The index of the last chord of a first order unit.
+    """
+    return unit.index + len(unit.uncondensedChords) - 1
+
+
+def isCadential(unit) -> bool:
+    return unit.formFunctionInTheory is not None and unit.formFunctionInTheory.prolMedCadStream == 'Cadential'
+
+
+def isTonicProlongation(unit) -> bool:
+    """
+    True for prolongations of the tonic, including tonic pedals (which have no formFunctionInTheory).
+    """
+    if unit.formFunctionInTheory is not None:
+        return unit.formFunctionInTheory.prolMedCadStream == 'Prolongation' and \
+            unit.formFunctionInTheory.whatFunctionProlonged == 'Tonic'
+    return unit.functionalLabel.startswith('Tonic Prolongation')
+
+
+def phraseFunction(unit, phrase: Phrase) -> str:
+    """
+    The phrase function of a unit, given the phrase so far:
+    Cadential for cadences, Initial for tonic prolongations before anything medial,
+    and Medial for everything else (sequences, other prolongations, gaps, ...).
+    """
+    if isCadential(unit):
+        return 'Cadential'
+    if isTonicProlongation(unit) and not phrase.hasMedial:
+        return 'Initial'
+    return 'Medial'
+
+
+def phrases(units):
+    """
+    Groups a stream of first order units (in order of their end) into Phrases.
+
+    A phrase closes with its first cadence, but is only yielded once a unit ends after that,
+    so alternative readings of the same cadence (ending in the same place) stay in the same phrase.
+    """
+    current = Phrase()
+    closed = None
+    for unit in units:
+        if closed is not None:
+            if unitEnd(unit) <= closed.end:
+                closed.add(unit, phraseFunction(unit, closed))
+                continue
+            yield closed
+            closed = None
+        current.add(unit, phraseFunction(unit, current))
+        if isCadential(unit):
+            current.cadence = unit
+            closed = current
+            current = Phrase()
+    if closed is not None:
+        yield closed
+    if current.units:
+        yield current
+
+
+def themes(phraseStream):
+    """
+    Groups a stream of Phrases into Themes (holding back at most one phrase, a possible antecedent).
+    """
+    pending = None
+    for phrase in phraseStream:
+        if pending is not None:
+            if phrase.strongCadence:
+                yield Theme([pending, phrase], 'Period' if phrase.startsWithInitial else 'Hybrid')
+                pending = None
+                continue
+            yield Theme([pending])
+            pending = None
+        if phrase.cadence is not None and not phrase.strongCadence:
+            pending = phrase  # A possible antecedent
+        elif phrase.strongCadence and phrase.hasInitial and phrase.hasMedial:
+            yield Theme([phrase], 'Sentence')
+        else:
+            yield Theme([phrase])
+    if pending is not None:
+        yield Theme([pending])
+
+
+# ------------------------------------------------------------------------------
+
+class Test(unittest.TestCase):
+
+    def units(self, figures):
+        from music21 import roman
+        from . import featureTable
+        from . import segmentation
+        features = featureTable.FeatureTable([roman.RomanNumeral(x) for x in figures])
+        return segmentation.formFunctionsFromSegments(segmentation.segment(features), features)
+
+    def testSentence(self):
+        # Tonic prolongation, then Medial, then a cadence
+        units = self.units(['I', 'V43', 'I6', 'vi', 'I6', 'IV', 'V7', 'I'])
+        found = list(themes(phrases(units)))
+        self.assertEqual([x.themeTypeLabel for x in found], ['Sentence'])
+        self.assertEqual([x.phraseFunctionLabel for x in units], ['Initial', 'Medial', 'Cadential'])
+        self.assertEqual({x.themeTypeLabel for x in units}, {'Sentence'})
+
+    def testPeriodAndHybrid(self):
+        antecedent = ['I', 'V43', 'I6', 'IV', 'V', 'vi']  # ... deceptive resolution (weak)
+        consequent = ['I', 'V43', 'I', 'I6', 'IV', 'V7', 'I']  # ... complete (strong)
+        continuation = ['vi', 'I6', 'IV', 'V7', 'I']
+        found = list(themes(phrases(self.units(antecedent + consequent))))
+        self.assertEqual([x.themeTypeLabel for x in found], ['Period'])
+        self.assertEqual(len(found[0].phrases), 2)
+        found = list(themes(phrases(self.units(antecedent + continuation))))
+        self.assertEqual([x.themeTypeLabel for x in found], ['Hybrid'])
+
+    def testAmbiguousCadence(self):
+        """
+        A 'None' cadence (IV V I, no 7th) is weak: it does not close a theme (e.g. as a sentence) by itself.
+        """
+        ambiguous = ['I', 'V43', 'I6', 'vi', 'IV', 'V', 'I']
+        units = self.units(ambiguous)
+        found = list(themes(phrases(units)))
+        self.assertEqual(units[-1].functionalLabel, 'None Cadential Progression')
+        self.assertFalse(any(x.themeTypeLabel for x in found))
+        self.assertEqual({x.themeTypeLabel for x in units}, {None})
+        # but can be the antecedent of a two-phrase theme
+        found = list(themes(phrases(self.units(ambiguous + ['I', 'V43', 'I', 'I6', 'IV', 'V7', 'I']))))
+        self.assertEqual(len(found), 1)
+        self.assertEqual(len(found[0].phrases), 2)
+
+    def testOverlapping(self):
+        """
+        The overlapping units of an Analysis, with alternative cadences at the end.
+        """
+        from music21 import roman
+        from . import bassToFormFunction
+        analysis = bassToFormFunction.Analysis(
+            [roman.RomanNumeral(x) for x in ['I', 'IV64', 'I', 'V43', 'I6', 'IV', 'V7', 'I']])
+        units = sorted(analysis.findFormFunctions(), key=lambda x: (unitEnd(x), x.index))
+        found = list(phrases(units))
+        self.assertEqual(len(found), 1)
+        self.assertEqual(found[0].functions, ['Initial', 'Initial', 'Cadential', 'Cadential'])
+        self.assertEqual(found[0].cadence.functionalLabel, 'Complete Cadential Progression')
+
+    def testStreaming(self):
+        """
+        Phrases come out as soon as they are complete, from an endless input.
+        """
+        import itertools
+        from . import featureTable
+        from . import pipeline
+
+        def endless():
+            for index in itertools.count():
+                bass, figures = [(1, (5, 3)), (2, (6, 4, 3)), (3, (6, 3)),
+                                 (4, (5, 3)), (5, (7, 5, 3)), (1, (5, 3))][index % 6]
+                yield featureTable.ChordRecord(index, bass, featureTable.figuresToMask(figures), 1.0)
+
+        first = list(itertools.islice(phrases(pipeline.formFunctionStream(endless())), 3))
+        self.assertEqual([x.cadence.index for x in first], [2, 8, 14])
+
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    unittest.main()
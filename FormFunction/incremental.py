@@ -0,0 +1,347 @@
+"""
+===============================
+Incremental Analysis (incremental.py)
+===============================
+
+
+LICENCE:
+===============================
+
+Creative Commons Attribution-ShareAlike 4.0 International License
+https://creativecommons.org/licenses/by-sa/4.0/
+
+
+ABOUT:
+===============================
+
+Re-analysis after an edit (e.g. of a RomanText file, one chord at a time)
+without re-running the whole analysis.
+
+An IncrementalAnalysis keeps the chord features and, for each bass run,
+the candidate form functions from the windows starting there (before removing repeats).
+On update, the new chords are compared with the old (by figure, key and duration)
+from each end in turn, stopping at the first difference, to find the changed stretch
+(or, with replace, the caller says which chords changed, and nothing else is compared). Then:
+- only the changed chords have their features extracted (FeatureTable.splice) and records made;
+- only the windows that can reach the changed chords
+(those starting up to 3 bass runs before it, to the run after it) are matched again,
+and only their runs searched for pedal points;
+- the candidates elsewhere are kept, along with their chord records;
+- and repeats and overlaps are resolved again (as in Analysis.addFormFunction)
+over all the candidates, which is cheap by comparison.
+
+Nothing returned before is changed by an update.
+So when the chords after the edit move (in position or offset), they and the candidates using them
+are copied to their new place (cheap, but in proportion to the rest of the piece):
+edits that keep the length and durations (e.g. changing one chord for another) touch nothing after.
+
+The results are the same, in the same order, as those of a new bassToFormFunction.Analysis.
+
+"""
+
+# ------------------------------------------------------------------------------
+
+import copy
+import unittest
+
+from . import bassToFormFunction
+
+
+# ------------------------------------------------------------------------------
+
+def chordKey(rn) -> tuple:
+    """
+    What the features of a Roman Numeral depend on (so equal keys mean equal features).
+    """
+    return rn.figure, (rn.key.tonicPitchNameWithCase if rn.key else ''), rn.quarterLength
+
+
+def changedStretch(oldKeys: list,
+                   newKeys: list,
+                   same=None) -> tuple:
+    """
+    The lengths of the common start (prefix) and end (suffix) of two sequences,
+    so that only old[prefix:len(old) - suffix] changed to new[prefix:len(new) - suffix].
+
+    Items are compared from each end only until the first difference.
+
+    >>> changedStretch([1, 2, 3, 4], [1, 2, 5, 3, 4])
+    (2, 2)
+
+    :param same: optionally, a function of (old index, new index) to use in place of comparing the items
+        (e.g. to work out only the keys compared)
+    """
+    if same is None:
+        def same(oldIndex, newIndex):
+            return oldKeys[oldIndex] == newKeys[newIndex]
+    oldSize, newSize = len(oldKeys), len(newKeys)
+    limit = min(oldSize, newSize)
+    prefix = 0
+    while prefix < limit and same(prefix, prefix):
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and same(oldSize - 1 - suffix, newSize - 1 - suffix):
+        suffix += 1
+    return prefix, suffix
+
+
+class IncrementalAnalysis(bassToFormFunction.Analysis):
+    """
+    An Analysis that can be updated with a new version of its Roman Numerals.
+
+    Typical use:
+    >>> analysis = IncrementalAnalysis(rns)  # doctest: +SKIP
+    >>> analysis.findFormFunctions()  # doctest: +SKIP
+    >>> analysis.update(editedRns)  # doctest: +SKIP
+    """
+
+    def __init__(self, rns: list, part=None, profile=None):
+        super().__init__(rns, part, profile=profile)
+        self.chordKeys = [chordKey(rn) for rn in rns]
+        self.candidates = None  # One list of candidate FormFunctionInPractice objects per bass run
+        self.lastUpdate = {}
+
+    def findFormFunctions(self) -> list:
+        self.candidates = [self.formFunctionsFrom(x) for x in self.features.runStarts.tolist()]
+        return self.resolve()
+
+    def resolve(self) -> list:
+        """
+        (Re)makes allFFInPractice from the candidates, removing repeats (in order).
+        """
+        self.allFFInPractice = []
+        self.foundLabels = set()
+        self.pedalSpans = bassToFormFunction.SpanIndex(len(self.chords))
+        for runCandidates in self.candidates:
+            for f in runCandidates:
+                self.addFormFunction(f)
+        return self.allFFInPractice
+
+    def update(self, rns: list, part=None) -> list:
+        """
+        Updates the analysis to a new version of the Roman Numerals.
+
+        Roman Numerals that are the same objects as before count as unchanged without a look at them
+        (so edit by replacing them, not in place); the rest are compared by chordKey.
+
+        :param rns: the new list of Roman Numerals (e.g. from parsing the edited file again)
+        :param part: the new stream.Part, if any (for writing in the score)
+        :return: the new allFFInPractice
+        """
+        oldRns, oldKeys = self.rns, self.chordKeys
+
+        def same(oldIndex, newIndex):
+            return rns[newIndex] is oldRns[oldIndex] or chordKey(rns[newIndex]) == oldKeys[oldIndex]
+
+        prefix, suffix = changedStretch(oldRns, rns, same)
+        return self.replace(prefix, len(oldRns) - suffix, rns[prefix:len(rns) - suffix], part, rns)
+
+    def replace(self,
+                start: int,
+                stop: int,
+                rns: list,
+                part=None,
+                allRns: list = None) -> list:
+        """
+        Updates the analysis for an edit that replaced the chords from start up to (not including) stop
+        with the Roman Numerals `rns` (any number), comparing nothing.
+
+        :param start: the first chord replaced
+        :param stop: the chord after the last one replaced
+        :param rns: the new Roman Numerals
+        :param part: the new stream.Part, if any (for writing in the score)
+        :param allRns: the whole new list of Roman Numerals, if already made
+        :return: the new allFFInPractice
+        """
+        if self.candidates is None:
+            self.findFormFunctions()
+        oldSize = len(self.chords)
+        newSize = oldSize - (stop - start) + len(rns)
+        shift = newSize - oldSize
+        prefix, suffix = start, oldSize - stop
+        oldFeatures, oldPedalPoints = self.features, self.pedalPoints
+        oldRuns = len(oldFeatures.runStarts)
+
+        self.rns = allRns if allRns is not None else self.rns[:start] + list(rns) + self.rns[stop:]
+        self.part = part if part is not None else self.part
+        self.chordKeys = self.chordKeys[:start] + [chordKey(rn) for rn in rns] + self.chordKeys[stop:]
+        if not rns and start == stop:  # No change (but perhaps new objects)
+            self.lastUpdate = {'prefix': prefix, 'suffix': suffix, 'runs': 0, 'moved': 0}
+            return self.allFFInPractice
+
+        with self.profile.stage('features'):
+            self.features = oldFeatures.splice(start, stop, rns, self.rns)
+        after = newSize - suffix
+        moved = bool(suffix) and (shift != 0 or self.features.offsets[after] != oldFeatures.offsets[stop])
+
+        # New records for the new chords, and for those after them if they moved
+        self.chords = self.chords[:prefix] + \
+            self.features.records(prefix, after) + \
+            (self.features.records(after, newSize) if moved else self.chords[stop:])
+
+        # The runs with windows that can reach the change
+        newRuns = len(self.features.runStarts)
+        runIndex = self.features.runIndex
+        firstRun = max(int(runIndex[max(prefix - 1, 0)]) - 3, 0) if newSize else 0
+        lastRun = int(runIndex[min(after, newSize - 1)]) if newSize else -1
+        oldLastRun = lastRun - (newRuns - oldRuns)
+
+        with self.profile.stage('pedal'):
+            self.pedalPoints = self.movePedalPoints(oldPedalPoints,
+                                                    oldFeatures.runStarts[firstRun:oldLastRun + 1].tolist(),
+                                                    stop,
+                                                    shift if moved else 0)
+            if newSize:
+                self.pedalPoints.update(bassToFormFunction.findAllPedalPoints(self.features,
+                                                                               firstRun=firstRun,
+                                                                               lastRun=lastRun))
+
+        laterCandidates = self.candidates[oldLastRun + 1:] if lastRun + 1 < newRuns else []
+        if moved:
+            laterCandidates = [[self.moveFormFunction(f, shift) for f in runCandidates]
+                               for runCandidates in laterCandidates]
+        runStarts = self.features.runStarts[firstRun:lastRun + 1].tolist()
+        self.candidates = self.candidates[:firstRun] + \
+            [self.formFunctionsFrom(x) for x in runStarts] + \
+            laterCandidates
+
+        self.lastUpdate = {'prefix': prefix, 'suffix': suffix, 'runs': lastRun - firstRun + 1,
+                           'moved': suffix if moved else 0}
+        return self.resolve()
+
+    @staticmethod
+    def movePedalPoints(pedalPoints: dict,
+                        removed: list,
+                        stop: int,
+                        shift: int) -> dict:
+        """
+        The pedal points kept from before an edit: all but those in the runs starting at `removed`,
+        with those from the chord `stop` on moved along by `shift` chords.
+        """
+        kept = dict(pedalPoints)
+        for start in removed:
+            kept.pop(start, None)
+        if not shift:
+            return kept
+        return {(x + shift if x >= stop else x): (y._replace(start=y.start + shift, end=y.end + shift,
+                                                             sixFour=y.sixFour + shift,
+                                                             fiveThree=y.fiveThree + shift)
+                                                  if x >= stop else y)
+                for x, y in kept.items()}
+
+    def moveFormFunction(self,
+                         f: bassToFormFunction.FormFunctionInPractice,
+                         shift: int) -> bassToFormFunction.FormFunctionInPractice:
+        """
+        A copy of a candidate from after an edit, moved along by `shift` chords onto the new chord records
+        (leaving the original as it was).
+        """
+        moved = copy.copy(f)
+        moved.index = f.index + shift
+        moved.chords = [self.chords[x.index + shift] for x in f.chords]
+        moved.uncondensedChords = moved.chords if f.uncondensedChords is f.chords else \
+            [self.chords[x.index + shift] for x in f.uncondensedChords]
+        return moved
+
+
+# ------------------------------------------------------------------------------
+
+class Test(unittest.TestCase):
+
+    def testUpdate(self):
+        """
+        After each kind of edit, the same results as analysing from scratch.
+        """
+        import random
+        from music21 import roman
+
+        from . import benchmark
+
+        figures = benchmark.syntheticFigures(80, patternDensity=0.8, repeatProbability=0.2, seed=1)
+        vocabulary = sorted(set(figures))
+        randomGenerator = random.Random(1)
+
+        def summary(fs):
+            return [(f.index, f.functionalLabel, [x.index for x in f.uncondensedChords]) for f in fs]
+
+        def chordSummary(fs):
+            return [[(x.index, x.offset) for x in f.uncondensedChords] for f in fs]
+
+        def makeRns():  # With offsets, one after another
+            rns = [roman.RomanNumeral(x) for x in figures]
+            offset = 0.0
+            for rn in rns:
+                rn.offset = offset
+                offset += rn.quarterLength
+            return rns
+
+        analysis = IncrementalAnalysis(makeRns())
+        found = analysis.findFormFunctions()
+        self.assertGreater(len(found), 20)
+        for edit in range(40):
+            before = found, summary(found), chordSummary(found), list(analysis.chords)
+            position = randomGenerator.randrange(len(figures))
+            kind = edit % 4
+            if kind == 0:
+                figures[position] = randomGenerator.choice(vocabulary)
+            elif kind == 1:
+                figures.insert(position, randomGenerator.choice(vocabulary))
+            elif kind == 2:
+                del figures[position]
+            else:
+                figures[position:position + 2] = [randomGenerator.choice(vocabulary) for _ in range(3)]
+            rns = makeRns()
+            found = analysis.update(rns)
+            expected = bassToFormFunction.Analysis(rns).findFormFunctions()
+            self.assertEqual(summary(found), summary(expected))
+            self.assertEqual(chordSummary(found), chordSummary(expected))
+            self.assertEqual(analysis.pedalPoints, bassToFormFunction.findAllPedalPoints(analysis.features))
+            self.assertLessEqual(analysis.lastUpdate['runs'], 8)  # Local
+
+            # The earlier results are as they were
+            self.assertEqual((summary(before[0]), chordSummary(before[0])), before[1:3])
+            # and the chords outside the change are the same records when they have not moved
+            prefix, suffix = analysis.lastUpdate['prefix'], analysis.lastUpdate['suffix']
+            self.assertTrue(all(x is y for x, y in zip(analysis.chords[:prefix], before[3])))
+            if kind == 0:
+                self.assertEqual(analysis.lastUpdate['moved'], 0)
+                self.assertTrue(all(x is y for x, y in zip(analysis.chords[len(figures) - suffix:],
+                                                            before[3][len(figures) - suffix:])))
+
+        self.assertEqual([x.index for x in analysis.chords], list(range(len(figures))))
+
+    def testReplace(self):
+        """
+        An edit at a known place compares (and so reads) no other chords.
+        """
+        import sys
+        from unittest import mock
+        from music21 import roman
+
+        figures = ['I', 'IV64', 'I', 'V43', 'I6', 'IV', 'V7', 'I'] * 10
+        analysis = IncrementalAnalysis([roman.RomanNumeral(x) for x in figures])
+        analysis.findFormFunctions()
+        figures[20:22] = ['ii6', 'V', 'vi']
+        newRns = [roman.RomanNumeral(x) for x in figures[20:23]]
+        with mock.patch.object(sys.modules[__name__], 'chordKey', wraps=chordKey) as keys:
+            found = analysis.replace(20, 22, newRns)
+        self.assertEqual(keys.call_count, 3)
+        expected = bassToFormFunction.Analysis([roman.RomanNumeral(x) for x in figures]).findFormFunctions()
+        self.assertEqual([(f.index, f.functionalLabel) for f in found],
+                         [(f.index, f.functionalLabel) for f in expected])
+        self.assertEqual(analysis.rns[20:23], newRns)
+
+    def testNoChange(self):
+        from music21 import roman
+        figures = ['I', 'IV64', 'I', 'V43', 'I6', 'IV', 'V7', 'I']
+        analysis = IncrementalAnalysis([roman.RomanNumeral(x) for x in figures])
+        found = list(analysis.findFormFunctions())
+        self.assertEqual(analysis.update([roman.RomanNumeral(x) for x in figures]), found)
+        self.assertEqual(analysis.lastUpdate['runs'], 0)
+        self.assertEqual(analysis.update([]), [])
+
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,204 @@
+"""
+===============================
+Pipeline (pipeline.py)
+===============================
+
+
+LICENCE:
+===============================
+
+Creative Commons Attribution-ShareAlike 4.0 International License
+https://creativecommons.org/licenses/by-sa/4.0/
+
+
+ABOUT:
+===============================
+
+The form function analysis as a pipeline of generators:
+
+chord records -> bass runs (condensation) -> matches (schemas and pedals) -> deduplication
+
+Each stage consumes the one before lazily and only holds on to the last few bass runs,
+so form functions are emitted as soon as they are final (i.e. once the last bass note ends)
+and memory use does not grow with the length of the input.
+This suits very long inputs like concatenated corpora, or live-generated harmonic analyses.
+
+The results are the same as those of bassToFormFunction.Analysis.findFormFunctions,
+but emitted in order of where they end, rather than where they start.
+
+"""
+
+# ------------------------------------------------------------------------------
+
+from collections import deque, namedtuple
+import unittest
+
+from . import bassToFormFunction
+from . import featureTable
+from . import schemaMatcher
+
+
+# ------------------------------------------------------------------------------
+
+class BassRun:
+    """
+    A run of successive chords that share a bass note (i.e. one entry in the condensed bass line).
+
+    `number` counts runs from the start of the input; `chords` are ChordRecords.
+    """
+
+    __slots__ = ('number', 'chords')
+
+    def __init__(self, number: int, chords: list):
+        self.number = number
+        self.chords = chords
+
+    @property
+    def start(self) -> int:
+        return self.chords[0].index
+
+    @property
+    def end(self) -> int:
+        return self.chords[-1].index
+
+    @property
+    def bassScaleDegree(self) -> int:
+        return self.chords[0].bassScaleDegree
+
+
+Event = namedtuple('Event', ['startRun', 'endRun', 'formFunctionInPractice'])
+
+
+def chordRecords(rns):
+    """
+    Streams ChordRecords from any iterable of Roman Numerals.
+    """
+    for index, rn in enumerate(rns):
+        yield featureTable.ChordRecord.fromRomanNumeral(rn, index)
+
+
+def condense(chords):
+    """
+    Groups a stream of chords into BassRuns, each yielded as soon as its bass changes.
+    """
+    number = 0
+    current = []
+    for chord in chords:
+        if current and chord.bassScaleDegree != current[-1].bassScaleDegree:
+            yield BassRun(number, current)
+            number += 1
+            current = []
+        current.append(chord)
+    if current:
+        yield BassRun(number, current)
+
+
+def matchRuns(runs,
+              automaton: schemaMatcher.SchemaAutomaton = None):
+    """
+    Finds the schemas (with the automaton, by default for the tables in use) and pedal points
+    in a stream of BassRuns, and yields an Event for each as soon as its last run is complete.
+    """
+    if automaton is None:
+        automaton = schemaMatcher.currentAutomaton()
+    recentRuns = deque(maxlen=automaton.maxLength)
+    recentMasks = deque(maxlen=automaton.maxLength)
+    state = 0
+    for run in runs:
+        recentRuns.append(run)
+        recentMasks.append(run.chords[0].figureMask)
+        state = automaton.step(state, run.bassScaleDegree)
+
+        for length, formFunctionInTheory in automaton.matches(state, recentMasks):
+            window = list(recentRuns)[-length:]
+            f = bassToFormFunction.FormFunctionInPractice([x.chords[0] for x in window])
+            f.index = window[0].start
+            f.uncondensedChords = [chord for x in window for chord in x.chords]
+            yield Event(window[0].number, run.number, f)
+
+        # As in bassToFormFunction.getPotentialPedalPoint
+        figureMasks = [x.figureMask for x in run.chords]
+        pedalEnd = bassToFormFunction.findEndPedalPoint(run.chords, figureMasks=figureMasks)
+        if pedalEnd != -1 and \
+                bassToFormFunction.getEssentialPedalPart(run.chords, figureMasks=figureMasks) != -1:
+            pedalChords = run.chords[:pedalEnd + 1]
+            f = bassToFormFunction.FormFunctionInPractice(pedalChords[:1])
+            f.functionalLabel = bassToFormFunction.pedalLabel(run.bassScaleDegree)
+            f.index = run.start
+            f.uncondensedChords = pedalChords
+            yield Event(run.number, run.number, f)
+
+
+def deduplicate(events,
+                maxLength: int = None):
+    """
+    Drops repeated form functions (same start and label) from a stream of Events
+    (as in Analysis.existsInFormFunctionList), and yields the FormFunctionInPractice objects.
+
+    Events arrive in order of their end run, and none spans more than maxLength runs,
+    so anything starting before that horizon is final and can be forgotten.
+    """
+    if maxLength is None:
+        maxLength = schemaMatcher.currentAutomaton().maxLength
+    seen = {}
+    for startRun, endRun, f in events:
+        horizon = endRun - maxLength + 1
+        if len(seen) > 4 * maxLength:
+            seen = {k: v for k, v in seen.items() if v >= horizon}
+        key = (f.index, f.functionalLabel)
+        if key in seen:
+            continue
+        seen[key] = startRun
+        yield f
+
+
+def formFunctionStream(chords,
+                       automaton: schemaMatcher.SchemaAutomaton = None):
+    """
+    The whole pipeline: from a stream of ChordRecords (see chordRecords)
+    to a stream of FormFunctionInPractice objects.
+    """
+    if automaton is None:
+        automaton = schemaMatcher.currentAutomaton()
+    return deduplicate(matchRuns(condense(chords), automaton), automaton.maxLength)
+
+
+# ------------------------------------------------------------------------------
+
+class Test(unittest.TestCase):
+
+    def testSameAsAnalysis(self):
+        from music21 import roman
+        figures = ['I', 'IV64', 'I', 'V43', 'I6', 'IV', 'V7', 'I', 'V', 'V7', 'I64', 'V7', 'I',
+                   'I6', 'ii6', 'V', 'vi', 'I', 'I6', 'IV', 'V', 'V', 'I']
+        rns = [roman.RomanNumeral(x) for x in figures]
+
+        analysis = bassToFormFunction.Analysis(rns)
+        expected = {(f.index, f.functionalLabel, len(f.uncondensedChords))
+                    for f in analysis.findFormFunctions()}
+        streamed = [(f.index, f.functionalLabel, len(f.uncondensedChords))
+                    for f in formFunctionStream(chordRecords(rns))]
+        self.assertEqual(len(streamed), len(set(streamed)))
+        self.assertEqual(set(streamed), expected)
+
+    def testStreaming(self):
+        """
+        Results come out before the input ends (here, it never does).
+        """
+        import itertools
+
+        def endless():
+            for index in itertools.count():
+                bass, figures = [(1, (5, 3)), (2, (6, 4, 3)), (3, (6, 3)),
+                                 (4, (5, 3)), (5, (7, 5, 3)), (1, (5, 3))][index % 6]
+                yield featureTable.ChordRecord(index, bass, featureTable.figuresToMask(figures), 1.0)
+
+        first = list(itertools.islice(formFunctionStream(endless()), 8))
+        self.assertEqual([f.index for f in first], [0, 2, 3, 5, 8, 9, 11, 14])
+        self.assertEqual(first[0].functionalLabel, 'Tonic Prolongation with Passing')
+
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    unittest.main()
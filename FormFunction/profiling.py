@@ -0,0 +1,304 @@
+"""
+===============================
+Profiling (profiling.py)
+===============================
+
+
+LICENCE:
+===============================
+
+Creative Commons Attribution-ShareAlike 4.0 International License
+https://creativecommons.org/licenses/by-sa/4.0/
+
+
+ABOUT:
+===============================
+
+Opt-in instrumentation for the form function analysis:
+time spent in each stage (parsing, feature extraction, window reduction, table matching, ...),
+counts of windows, matches and deduplication rejections,
+and, for each table entry, the windows with its bass pattern where it was:
+a 'hit' (selected),
+'shadowed' (its figures fit too, but a later entry on the same bass pattern fit and won),
+or a 'miss' (its figures did not fit).
+
+Pass a Profile to bassToFormFunction.Analysis (or use corpusRunner's --profile option),
+then export it as JSON or as a flat table (CSV).
+Entries that never fire show up in Profile.unusedEntries() (never even fitting)
+or Profile.shadowedEntries() (fitting, but always losing to a later entry).
+
+Without a Profile, the analysis uses nullProfile, which does nothing.
+
+"""
+
+# ------------------------------------------------------------------------------
+
+from collections import Counter, defaultdict
+import csv
+import json
+import time
+import unittest
+
+from . import formFunctionTables
+
+
+# ------------------------------------------------------------------------------
+
+entryPositions = {}
+entryPositionsVersion = None
+
+
+def updateEntryPositions():
+    """
+    (Re)makes entryPositions, the position of each table entry in use, if the tables have changed.
+    """
+    global entryPositions, entryPositionsVersion
+    if entryPositionsVersion != formFunctionTables.tablesVersion or not entryPositions:
+        entryPositions = {id(x): position
+                          for position, x in enumerate(formFunctionTables.global3 + formFunctionTables.global4)}
+        entryPositionsVersion = formFunctionTables.tablesVersion
+
+
+def entryName(formFunctionInTheory: formFunctionTables.FormFunctionInTheory) -> str:
+    """
+    A name for a table entry which tells apart entries with the same label,
+    e.g. '1: [1, 7, 1] (5, None, 5) Tonic Prolongation with Neighbor, Lower'
+    where the number is the position in formFunctionTables.global3 + global4 (if there).
+    """
+    name = f'{list(formFunctionInTheory.bassScaleDegrees)} ' \
+           f'{tuple(formFunctionInTheory.requiredFigures)} {formFunctionInTheory.functionalLabel}'
+    updateEntryPositions()
+    position = entryPositions.get(id(formFunctionInTheory))
+    if position is None:
+        return name
+    return f'{position}: {name}'
+
+
+class Profile:
+    """
+    Stage timers and counters for one or more analyses.
+    """
+
+    def __init__(self):
+        self.stageSeconds = defaultdict(float)
+        self.stageCalls = Counter()
+        self.counters = Counter()
+        self.entryHits = Counter()
+        self.entryShadowed = Counter()
+        self.entryMisses = Counter()
+
+    def stage(self, name: str):
+        """
+        A context manager that adds the time spent within it to the stage `name`:
+        >>> profile = Profile()
+        >>> with profile.stage('parse'):
+        ...     pass
+        >>> profile.stageCalls['parse']
+        1
+        """
+        return StageTimer(self, name)
+
+    def count(self, name: str, n: int = 1):
+        self.counters[name] += n
+
+    def recordCandidates(self,
+                         candidates: list,
+                         selected: formFunctionTables.FormFunctionInTheory = None,
+                         figureMasks: list = None):
+        """
+        Records a hit for the selected entry (if any)
+        and, for each of the other candidates (same bass pattern, not selected),
+        a shadowed hit if it fits the window's figureMasks too, otherwise a miss.
+        Without the figureMasks, every other candidate counts as a miss.
+        """
+        for candidate in candidates:
+            if candidate is selected:
+                self.entryHits[entryName(candidate)] += 1
+            elif figureMasks is not None and candidate.fitsMasks(figureMasks):
+                self.entryShadowed[entryName(candidate)] += 1
+            else:
+                self.entryMisses[entryName(candidate)] += 1
+
+    def merge(self, other):
+        """
+        Adds another Profile (or the dict from its toDict) to this one.
+        """
+        if isinstance(other, dict):
+            other = Profile.fromDict(other)
+        for stage, seconds in other.stageSeconds.items():
+            self.stageSeconds[stage] += seconds
+        self.stageCalls.update(other.stageCalls)
+        self.counters.update(other.counters)
+        self.entryHits.update(other.entryHits)
+        self.entryShadowed.update(other.entryShadowed)
+        self.entryMisses.update(other.entryMisses)
+        return self
+
+    def unusedEntries(self, tables: list = None) -> list:
+        """
+        The names of the table entries (by default, of global3 + global4) that never matched,
+        nor even fit (see shadowedEntries for those that fit but always lost).
+        """
+        return [x for x in self.entryNames(tables) if not self.entryHits[x] and not self.entryShadowed[x]]
+
+    def shadowedEntries(self, tables: list = None) -> list:
+        """
+        The names of the table entries (by default, of global3 + global4) that never matched
+        although they did fit: a later entry on the same bass pattern fit those windows too, and won.
+        """
+        return [x for x in self.entryNames(tables) if not self.entryHits[x] and self.entryShadowed[x]]
+
+    @staticmethod
+    def entryNames(tables: list = None) -> list:
+        if tables is None:
+            tables = [formFunctionTables.global3, formFunctionTables.global4]
+        return [entryName(entry) for table in tables for entry in table]
+
+    def toDict(self) -> dict:
+        return {'stageSeconds': dict(self.stageSeconds),
+                'stageCalls': dict(self.stageCalls),
+                'counters': dict(self.counters),
+                'entryHits': dict(self.entryHits),
+                'entryShadowed': dict(self.entryShadowed),
+                'entryMisses': dict(self.entryMisses)}
+
+    @classmethod
+    def fromDict(cls, data: dict):
+        profile = cls()
+        profile.stageSeconds.update(data.get('stageSeconds', {}))
+        profile.stageCalls.update(data.get('stageCalls', {}))
+        profile.counters.update(data.get('counters', {}))
+        profile.entryHits.update(data.get('entryHits', {}))
+        profile.entryShadowed.update(data.get('entryShadowed', {}))
+        profile.entryMisses.update(data.get('entryMisses', {}))
+        return profile
+
+    def toRows(self) -> list:
+        """
+        Everything as a flat table of (kind, name, value) rows.
+        """
+        rows = []
+        for stage, seconds in sorted(self.stageSeconds.items()):
+            rows.append(('seconds', stage, seconds))
+            rows.append(('calls', stage, self.stageCalls[stage]))
+        for name, value in sorted(self.counters.items()):
+            rows.append(('count', name, value))
+        entries = sorted(set(self.entryHits) | set(self.entryShadowed) | set(self.entryMisses) |
+                         set(self.entryNames()))
+        for name in entries:
+            rows.append(('entryHits', name, self.entryHits[name]))
+            rows.append(('entryShadowed', name, self.entryShadowed[name]))
+            rows.append(('entryMisses', name, self.entryMisses[name]))
+        return rows
+
+    def write(self, path: str):
+        """
+        Writes the profile to `path`: as JSON if that ends in .json, otherwise as a flat CSV table.
+        """
+        with open(path, 'w', newline='') as f:
+            if path.lower().endswith('.json'):
+                data = self.toDict()
+                data['unusedEntries'] = self.unusedEntries()
+                data['shadowedEntries'] = self.shadowedEntries()
+                json.dump(data, f, indent=1)
+            else:
+                writer = csv.writer(f)
+                writer.writerow(['kind', 'name', 'value'])
+                writer.writerows(self.toRows())
+
+
+class StageTimer:
+    __slots__ = ('profile', 'name', 'start')
+
+    def __init__(self, profile: Profile, name: str):
+        self.profile = profile
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profile.stageSeconds[self.name] += time.perf_counter() - self.start
+        self.profile.stageCalls[self.name] += 1
+        return False
+
+
+class NullProfile:
+    """
+    Takes the place of a Profile when profiling is off, doing nothing (as cheaply as possible).
+    """
+
+    def stage(self, name: str):
+        return nullStageTimer
+
+    def count(self, name: str, n: int = 1):
+        pass
+
+    def recordCandidates(self, candidates: list, selected=None, figureMasks=None):
+        pass
+
+
+class NullStageTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+nullStageTimer = NullStageTimer()
+nullProfile = NullProfile()
+
+
+# ------------------------------------------------------------------------------
+
+class Test(unittest.TestCase):
+
+    def testProfile(self):
+        import os
+        import tempfile
+
+        profile = Profile()
+        with profile.stage('match'):
+            profile.count('windows', 2)
+        cadences = formFunctionTables.lookupIndex[(4, 5, 1)]
+        profile.recordCandidates(cadences, cadences[0])
+        self.assertEqual(profile.stageCalls['match'], 1)
+        self.assertEqual(profile.entryHits[entryName(cadences[0])], 1)
+        self.assertEqual(profile.entryMisses[entryName(cadences[1])], 1)
+        self.assertIn(entryName(cadences[1]), profile.unusedEntries())
+        self.assertNotIn(entryName(cadences[0]), profile.unusedEntries())
+
+        # Fitting but losing (a V7 fits both cadences, and the later wins) is not the same as unused
+        seventh, triad = 1 << 7 | 1 << 5 | 1 << 3, 1 << 5 | 1 << 3
+        shadowed = Profile()
+        shadowed.recordCandidates(cadences, cadences[1], [triad, seventh, triad])
+        shadowed.recordCandidates(cadences, cadences[1], [triad, triad, triad])
+        self.assertEqual((shadowed.entryShadowed[entryName(cadences[0])],
+                          shadowed.entryMisses[entryName(cadences[0])]), (1, 1))
+        self.assertNotIn(entryName(cadences[0]), shadowed.unusedEntries())
+        self.assertEqual(shadowed.shadowedEntries(), [entryName(cadences[0])])
+        self.assertEqual(Profile().merge(shadowed.toDict()).entryShadowed, shadowed.entryShadowed)
+
+        merged = Profile().merge(profile.toDict()).merge(profile)
+        self.assertEqual(merged.counters['windows'], 4)
+
+        with tempfile.TemporaryDirectory() as tempDir:
+            for name in ['profile.json', 'profile.csv']:
+                profile.write(os.path.join(tempDir, name))
+            with open(os.path.join(tempDir, 'profile.json')) as f:
+                self.assertEqual(json.load(f)['counters'], {'windows': 2})
+
+    def testEntryNames(self):
+        names = [entryName(x) for x in formFunctionTables.global3 + formFunctionTables.global4]
+        self.assertEqual(len(names), len(set(names)))
+
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,216 @@
+"""
+===============================
+Schema Matcher (schemaMatcher.py)
+===============================
+
+
+LICENCE:
+===============================
+
+Creative Commons Attribution-ShareAlike 4.0 International License
+https://creativecommons.org/licenses/by-sa/4.0/
+
+
+ABOUT:
+===============================
+
+Matches every schema in the form function tables in one pass over a piece.
+
+The bass patterns of the tables are compiled into an Aho-Corasick automaton
+which then streams over the condensed bass scale-degree sequence of a piece
+(one entry per change of bass) and reports every match as it goes.
+The cost is linear in the length of the piece (plus the number of matches),
+rather than windows x patterns.
+
+"""
+
+# ------------------------------------------------------------------------------
+
+from collections import deque, namedtuple
+import numbers
+import unittest
+
+from . import featureTable
+from . import formFunctionTables
+
+
+# ------------------------------------------------------------------------------
+
+Match = namedtuple('Match', ['start', 'end', 'formFunctionInTheory'])
+Match.__doc__ = """
+A schema found in practice:
+start and end (inclusive) index the condensed bass sequence that was searched.
+"""
+
+
+class SchemaAutomaton:
+    """
+    An Aho-Corasick automaton compiled from one or more lists of FormFunctionInTheory objects
+    (by default, formFunctionTables.global3 and global4).
+
+    Each state is a dict of transitions (bass scale degree: state),
+    plus a failure link and the bass patterns that end there.
+    """
+
+    def __init__(self, *tables):
+        if not tables:
+            tables = (formFunctionTables.global3, formFunctionTables.global4)
+        self.lookupIndex = formFunctionTables.makeLookupIndex(*tables)
+        self.transitions = [{}]
+        self.failures = [0]
+        self.outputs = [[]]
+        self.maxLength = 0
+
+        for pattern in self.lookupIndex:
+            self.addPattern(pattern)
+        self.makeFailureLinks()
+
+    def addPattern(self, pattern: tuple):
+        """
+        Adds one bass pattern to the trie.
+        """
+        state = 0
+        for degree in pattern:
+            if degree not in self.transitions[state]:
+                self.transitions.append({})
+                self.failures.append(0)
+                self.outputs.append([])
+                self.transitions[state][degree] = len(self.transitions) - 1
+            state = self.transitions[state][degree]
+        self.outputs[state].append(pattern)
+        self.maxLength = max(self.maxLength, len(pattern))
+
+    def makeFailureLinks(self):
+        """
+        Sets the failure links breadth first and
+        merges the outputs of each state with those of its failure state
+        (so a state reports every pattern that is a suffix of the path to it).
+        """
+        queue = deque(self.transitions[0].values())
+        while queue:
+            state = queue.popleft()
+            for degree, nextState in self.transitions[state].items():
+                queue.append(nextState)
+                fallback = self.failures[state]
+                while fallback and degree not in self.transitions[fallback]:
+                    fallback = self.failures[fallback]
+                self.failures[nextState] = self.transitions[fallback].get(degree, 0)
+                self.outputs[nextState] = self.outputs[nextState] + self.outputs[self.failures[nextState]]
+
+    def step(self, state: int, degree: int) -> int:
+        """
+        Returns the state reached from `state` on reading a bass scale degree.
+        """
+        while state and degree not in self.transitions[state]:
+            state = self.failures[state]
+        return self.transitions[state].get(degree, 0)
+
+    def findAll(self, bassScaleDegrees, figures):
+        """
+        Streams over a condensed bass line once and
+        yields a Match for every schema found there,
+        in order of end index (longest first where two matches end together).
+
+        Only the last few figures are held at any one time,
+        so both arguments can be any iterables (e.g. generators over a long piece).
+
+        :param bassScaleDegrees: the condensed bass scale degrees of a piece.
+        :param figures: the corresponding figures, one per bass scale degree:
+            either a list of figure numbers or (quicker) the bitmask of them (see featureTable.figuresToMask),
+            as any integer type (e.g. straight from a FeatureTable's NumPy figureMasks).
+        :return: generator of Match objects
+        """
+        state = 0
+        recentMasks = deque(maxlen=self.maxLength)
+        for index, (degree, theseFigures) in enumerate(zip(bassScaleDegrees, figures)):
+            state = self.step(state, degree)
+            recentMasks.append(theseFigures if isinstance(theseFigures, numbers.Integral)
+                               else featureTable.figuresToMask(theseFigures))
+            for length, formFunctionInTheory in self.matches(state, recentMasks):
+                yield Match(index - length + 1, index, formFunctionInTheory)
+
+    def matches(self, state: int, recentMasks) -> list:
+        """
+        The schemas ending at the current position, given
+        the state reached there and the figure bitmasks of the most recent bass notes (last = current).
+
+        :return: list of (length, FormFunctionInTheory) tuples
+        """
+        out = []
+        for pattern in self.outputs[state]:
+            windowMasks = list(recentMasks)[-len(pattern):]
+            formFunctionInTheory = formFunctionTables.selectFormFunctionByMasks(
+                self.lookupIndex[pattern], windowMasks)
+            if formFunctionInTheory:
+                out.append((len(pattern), formFunctionInTheory))
+        return out
+
+
+defaultAutomaton = SchemaAutomaton()
+defaultAutomatonVersion = formFunctionTables.tablesVersion
+
+
+def currentAutomaton() -> SchemaAutomaton:
+    """
+    The automaton for the tables in use: defaultAutomaton, made again if the tables have changed since
+    (see formFunctionTables.setTables).
+    """
+    global defaultAutomaton, defaultAutomatonVersion
+    if defaultAutomatonVersion != formFunctionTables.tablesVersion:
+        defaultAutomaton = SchemaAutomaton()
+        defaultAutomatonVersion = formFunctionTables.tablesVersion
+    return defaultAutomaton
+
+
+# ------------------------------------------------------------------------------
+
+class Test(unittest.TestCase):
+
+    def testFindAll(self):
+        """
+        Overlapping 3- and 4-patterns in one pass.
+        """
+        bass = [1, 2, 3, 4, 5, 1]
+        figures = [(5, 3), (6, 4, 3), (6, 3), (5, 3), (7, 5, 3), (5, 3)]
+        matches = list(defaultAutomaton.findAll(bass, figures))
+        found = [(m.start, m.end, m.formFunctionInTheory.functionalLabel) for m in matches]
+        self.assertEqual(found,
+                         [(0, 2, 'Tonic Prolongation with Passing'),
+                          (2, 5, 'Complete Cadential Progression'),
+                          (3, 5, 'None Cadential Progression')]
+                         )
+
+    def testAgreesWithLookupIndex(self):
+        """
+        Every table pattern is found on its own (and with the same result as the index).
+        """
+        for pattern, candidates in formFunctionTables.lookupIndex.items():
+            figures = [tuple(range(1, 10))] * len(pattern)
+            matches = list(defaultAutomaton.findAll(pattern, figures))
+            self.assertIn(Match(0, len(pattern) - 1,
+                                formFunctionTables.selectFormFunction(candidates, figures)),
+                          matches)
+
+    def testMasks(self):
+        """
+        Figure bitmasks give the same matches as figures, including NumPy integers.
+        """
+        import numpy as np
+        bass = [1, 2, 3, 4, 5, 1]
+        figures = [(5, 3), (6, 4, 3), (6, 3), (5, 3), (7, 5, 3), (5, 3)]
+        masks = np.array([featureTable.figuresToMask(x) for x in figures], dtype=np.int64)
+        expected = list(defaultAutomaton.findAll(bass, figures))
+        self.assertEqual(list(defaultAutomaton.findAll(bass, masks)), expected)
+        self.assertEqual(list(defaultAutomaton.findAll(bass, masks.tolist())), expected)
+
+    def testFiguresRequired(self):
+        """
+        A bass pattern alone is not enough.
+        """
+        self.assertEqual(list(defaultAutomaton.findAll([1, 2, 3], [(5, 3), (5, 3), (5, 3)])), [])
+
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    unittest.main()
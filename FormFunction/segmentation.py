@@ -0,0 +1,265 @@
+"""
+===============================
+Segmentation (segmentation.py)
+===============================
+
+
+LICENCE:
+===============================
+
+Creative Commons Attribution-ShareAlike 4.0 International License
+https://creativecommons.org/licenses/by-sa/4.0/
+
+
+ABOUT:
+===============================
+
+Segments a whole piece into form functional units:
+the best cover of the condensed bass line (one entry per bass run)
+by non-overlapping schemas (table matches), pedal points and explicit 'Medial' gaps.
+
+Where bassToFormFunction.Analysis keeps every match of every window (so units overlap freely),
+this chooses one reading of the piece by dynamic programming (Viterbi style):
+each candidate unit has a score (by default, the number of bass notes it covers),
+each bass note left over is a Medial gap (scoring 0 by default),
+and the result is the cover with the highest total score
+(ties going to the one with fewer units, and then to the earliest found, so it is deterministic).
+
+The candidates come from one pass of the schema automaton (see schemaMatcher.py),
+and the dynamic programme is one more pass over the bass runs,
+so it is all O(n x patterns) for n bass runs.
+
+By default the units do not overlap at all.
+With shareBoundaries, a schema may also start on the bass note where the previous one ended
+(e.g. a tonic prolongation ending on I6, which starts the cadence).
+
+"""
+
+# ------------------------------------------------------------------------------
+
+from collections import namedtuple
+import unittest
+
+from . import bassToFormFunction
+from . import featureTable
+from . import schemaMatcher
+
+
+# ------------------------------------------------------------------------------
+
+Segment = namedtuple('Segment', ['startRun', 'endRun', 'start', 'end', 'functionalLabel', 'formFunctionInTheory'])
+Segment.__doc__ = """
+One unit of a segmentation:
+the first and last bass runs (inclusive), the first and last chord indices (inclusive),
+the label ('Medial' for a gap), and the table entry (None for pedal points and gaps).
+"""
+
+medialLabel = 'Medial'
+
+
+def matchScore(match: schemaMatcher.Match) -> float:
+    """
+    The default score for a schema: the number of bass notes it covers.
+    """
+    return match.end - match.start + 1
+
+
+def pedalPoints(features: featureTable.FeatureTable) -> dict:
+    """
+    The pedal points of a piece as a dict of {run: last chord index of the pedal}
+    (as in pipeline.matchRuns: at most one per run, from its first chord).
+    """
+    return {int(features.runIndex[start]): pedal.end
+            for start, pedal in bassToFormFunction.findAllPedalPoints(features).items()}
+
+
+def segment(features: featureTable.FeatureTable,
+            automaton: schemaMatcher.SchemaAutomaton = None,
+            scoreMatch=matchScore,
+            pedalScore: float = 1,
+            gapScore: float = 0,
+            shareBoundaries: bool = False) -> list:
+    """
+    Finds the best segmentation of a piece.
+
+    :param features: the FeatureTable of the piece
+    :param automaton: the SchemaAutomaton for the tables to use (by default, those in use)
+    :param scoreMatch: function from a schemaMatcher.Match to its score
+    :param pedalScore: the score for a pedal point
+    :param gapScore: the score for each bass note left as Medial
+        (including what is left of a bass note after a pedal point that stops short of its end)
+    :param shareBoundaries: whether a schema can start on the last bass note of the one before
+    :return: list of Segments in order, covering the whole piece (overlapping only with shareBoundaries)
+    """
+    if automaton is None:
+        automaton = schemaMatcher.currentAutomaton()
+    numberOfRuns = len(features.runStarts)
+    runStarts = features.runStarts.tolist()
+    runEnds = (features.runStarts + features.runLengths - 1).tolist()
+    runFigureMasks = features.figureMasks[features.runStarts].tolist()
+
+    matchesByEnd = [[] for _ in range(numberOfRuns)]
+    for match in automaton.findAll(features.runDegrees.tolist(), runFigureMasks):
+        matchesByEnd[match.end].append(match)
+    pedals = pedalPoints(features)
+
+    # best[p][k] is the best (score, -units) for a cover of runs [0, p),
+    # where k is 1 iff it ends with a schema (that the next schema can share a boundary with).
+    # back[p][k] is the (previous p, previous k, Segment or None for a gap) to retrace it.
+    worst = (float('-inf'), 0)
+    best = [[worst, worst] for _ in range(numberOfRuns + 1)]
+    back = [[None, None] for _ in range(numberOfRuns + 1)]
+    best[0][0] = (0, 0)
+
+    def consider(p, k, candidate, previous):
+        if candidate > best[p][k]:
+            best[p][k] = candidate
+            back[p][k] = previous
+
+    for p in range(numberOfRuns):
+        end = p + 1
+
+        # Gap
+        for k in (0, 1):
+            score, units = best[p][k]
+            consider(end, 0, (score + gapScore, units), (p, k, None))
+
+        # Pedal point (and the rest of its bass note, as Medial, if it stops short)
+        if p in pedals:
+            unit = Segment(p, p, runStarts[p], pedals[p],
+                           bassToFormFunction.pedalLabel(int(features.runDegrees[p])), None)
+            thisScore = pedalScore + (gapScore if pedals[p] < runEnds[p] else 0)
+            for k in (0, 1):
+                score, units = best[p][k]
+                consider(end, 0, (score + thisScore, units - 1), (p, k, unit))
+
+        # Schemas
+        for match in matchesByEnd[p]:
+            unit = Segment(match.start, match.end, runStarts[match.start], runEnds[match.end],
+                           match.formFunctionInTheory.functionalLabel, match.formFunctionInTheory)
+            thisScore = scoreMatch(match)
+            sources = [(match.start, 0), (match.start, 1)]
+            if shareBoundaries:
+                sources.append((match.start + 1, 1))
+            for previousP, k in sources:
+                score, units = best[previousP][k]
+                consider(end, 1, (score + thisScore, units - 1), (previousP, k, unit))
+
+    # Retrace
+    segments = []
+    p, k = numberOfRuns, 0 if best[numberOfRuns][0] >= best[numberOfRuns][1] else 1
+    while p > 0:
+        previousP, previousK, unit = back[p][k]
+        if unit is None:
+            unit = Segment(previousP, previousP, runStarts[previousP], runEnds[previousP], medialLabel, None)
+        segments.append(unit)
+        if unit.end < runEnds[unit.endRun]:  # A pedal point that does not reach the end of its run
+            segments.insert(-1, Segment(p - 1, p - 1, unit.end + 1, runEnds[p - 1], medialLabel, None))
+        p, k = previousP, previousK
+    segments.reverse()
+
+    # Merge consecutive gaps into one Medial segment
+    out = []
+    for unit in segments:
+        if out and unit.functionalLabel == medialLabel and out[-1].functionalLabel == medialLabel:
+            unit = Segment(out[-1].startRun, unit.endRun, out.pop().start, unit.end, medialLabel, None)
+        out.append(unit)
+    return out
+
+
+def formFunctionsFromSegments(segments: list,
+                              features: featureTable.FeatureTable,
+                              includeMedial: bool = True) -> list:
+    """
+    Turns Segments into FormFunctionInPractice objects,
+    e.g. to use in place of Analysis.allFFInPractice for writing in the score or exporting.
+
+    :param segments: list of Segments (from segment)
+    :param features: the FeatureTable of the piece
+    :param includeMedial: whether to include the Medial gaps (as units without a formFunctionInTheory)
+    :return: list of FormFunctionInPractice objects
+    """
+    chords = features.records()
+    out = []
+    for unit in segments:
+        if unit.functionalLabel == medialLabel and not includeMedial:
+            continue
+        condensed = [chords[x] for x in features.condensedIndices(unit.start, unit.end)]
+        if unit.formFunctionInTheory is None:
+            condensed = condensed[:1]
+        f = bassToFormFunction.FormFunctionInPractice(condensed)
+        f.formFunctionInTheory = unit.formFunctionInTheory
+        f.functionalLabel = unit.functionalLabel
+        f.index = unit.start
+        f.uncondensedChords = chords[unit.start:unit.end + 1]
+        out.append(f)
+    return out
+
+
+# ------------------------------------------------------------------------------
+
+class Test(unittest.TestCase):
+
+    def testSegment(self):
+        from music21 import roman
+
+        figures = ['I', 'IV64', 'I', 'V43', 'I6', 'IV', 'V7', 'I', 'vi', 'ii', 'iii']
+        features = featureTable.FeatureTable([roman.RomanNumeral(x) for x in figures])
+        segments = segment(features)
+        self.assertEqual([(x.start, x.end, x.functionalLabel) for x in segments],
+                         [(0, 4, 'Tonic Prolongation with Passing'),
+                          (5, 7, 'None Cadential Progression'),
+                          (8, 10, 'Medial')])
+
+        # Covers every chord exactly once, in order
+        covered = [i for x in segments for i in range(x.start, x.end + 1)]
+        self.assertEqual(covered, list(range(len(figures))))
+
+        # With shared boundaries: the longer cadence, starting on the last bass note of the prolongation
+        segments = segment(features, shareBoundaries=True)
+        self.assertEqual([(x.start, x.end, x.functionalLabel) for x in segments],
+                         [(0, 4, 'Tonic Prolongation with Passing'),
+                          (4, 7, 'Complete Cadential Progression'),
+                          (8, 10, 'Medial')])
+
+        # A higher score for cadences
+        def cadenceFirst(match):
+            return matchScore(match) * (3 if match.formFunctionInTheory.prolMedCadStream == 'Cadential' else 1)
+
+        segments = segment(features, scoreMatch=cadenceFirst, shareBoundaries=False)
+        self.assertEqual([(x.start, x.end, x.functionalLabel) for x in segments],
+                         [(0, 2, 'Tonic Prolongation with Pedal'),
+                          (3, 3, 'Medial'),
+                          (4, 7, 'Complete Cadential Progression'),
+                          (8, 10, 'Medial')])
+
+        # A pedal point that does not fill its run (the ii42 is over the same bass, but has no 5)
+        pedal = featureTable.FeatureTable([roman.RomanNumeral(x) for x in ['I', 'IV64', 'I', 'ii42', 'V']])
+        segments = segment(pedal)
+        self.assertEqual([(x.start, x.end, x.functionalLabel) for x in segments],
+                         [(0, 2, 'Tonic Prolongation with Pedal'), (3, 4, 'Medial')])
+        # ... the rest of which is scored as Medial: here 1 + 2 + 2 for the pedal reading, 2 + 2 without
+        self.assertEqual([(x.start, x.end) for x in segment(pedal, gapScore=2)], [(0, 2), (3, 4)])
+        self.assertEqual([(x.start, x.end) for x in segment(pedal, gapScore=2, pedalScore=-1)], [(0, 4)])
+
+        # Deterministic
+        self.assertEqual(segment(features), segment(features))
+
+        # As FormFunctionInPractice objects, e.g. for exporting
+        fs = formFunctionsFromSegments(segment(features), features)
+        self.assertEqual([(f.index, len(f.uncondensedChords)) for f in fs], [(0, 5), (5, 3), (8, 3)])
+        self.assertEqual(fs[0].bassScaleDegrees, [1, 2, 3])
+        self.assertEqual(len(formFunctionsFromSegments(segment(features), features, False)), 2)
+
+        annotations = bassToFormFunction.ScoreAnnotations.fromFormFunctions(fs, len(figures))
+        self.assertEqual(annotations.lyrics(8), ['', 'Medial'])
+        self.assertNotIn('*Medial?*', [x for i in range(len(figures)) for x in annotations.lyrics(i)])
+
+    def testEmpty(self):
+        self.assertEqual(segment(featureTable.FeatureTable()), [])
+
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+"""
+===============================
+Sequence Matcher (sequenceMatcher.py)
+===============================
+
+
+LICENCE:
+===============================
+
+Creative Commons Attribution-ShareAlike 4.0 International License
+https://creativecommons.org/licenses/by-sa/4.0/
+
+
+ABOUT:
+===============================
+
+Finds sequences (formFunctionTables.sequences):
+repeating cells of generic bass intervals and figures, of any length.
+
+Unlike the other schemas, sequences are not of a fixed number of bass notes
+and they may include repeated bass notes (e.g. 5-6 over each bass note),
+so this works over all the chords (not the condensed bass line)
+and does not use the 3/4-chord windows at all.
+
+The intervals come from the bass steps (letter names) of the chords,
+so sequences are found across modulations.
+Without octaves, intervals are compared modulo the octave:
+e.g. up a fourth (4) and down a fifth (-5) are the same.
+
+For each sequence and each alignment of its cell (phase),
+every chord is checked (one vectorised step over the precomputed interval array),
+and the maximal runs of chords that fit are the matches.
+So it is all linear in the length of the piece.
+
+"""
+
+# ------------------------------------------------------------------------------
+
+from collections import namedtuple
+import unittest
+
+import numpy as np
+
+from . import featureTable
+from . import formFunctionTables
+
+
+# ------------------------------------------------------------------------------
+
+SequenceMatch = namedtuple('SequenceMatch', ['start', 'end', 'formFunctionInTheory'])
+SequenceMatch.__doc__ = """
+A sequence found in a piece: the first and last chord indices (inclusive)
+and the formFunctionTables.Sequence.
+"""
+
+
+def intervalSteps(genericInterval: int) -> int:
+    """
+    A generic interval (1 for a unison, 2 for a second up, -2 for a second down, ...)
+    as a number of steps up, modulo the octave (0 to 6).
+
+    >>> intervalSteps(4), intervalSteps(-5)
+    (3, 3)
+    """
+    if genericInterval > 0:
+        return (genericInterval - 1) % 7
+    return -(-genericInterval - 1) % 7
+
+
+def bassIntervals(bassSteps) -> np.ndarray:
+    """
+    The interval from each chord's bass to the next, in steps up modulo the octave (0 to 6).
+    One fewer than the chords.
+    """
+    bassSteps = np.asarray(bassSteps, dtype=np.int64)
+    return np.diff(bassSteps) % 7
+
+
+def findSequences(features: featureTable.FeatureTable,
+                  sequences: list = None,
+                  minCells: int = 2) -> list:
+    """
+    Finds every sequence in a piece.
+
+    Where two sequences cover exactly the same chords, the later one in the table wins.
+
+    :param features: the FeatureTable of the piece
+    :param sequences: list of formFunctionTables.Sequence objects (by default, formFunctionTables.sequences)
+    :param minCells: the minimum number of chords, in cells (e.g. 2 for the model and one repetition)
+    :return: list of SequenceMatches, in order of start (longest first)
+    """
+    if sequences is None:
+        sequences = formFunctionTables.sequences
+    masks = np.asarray(features.figureMasks, dtype=np.int64)
+    size = len(masks)
+    if size < 2:
+        return []
+    intervals = bassIntervals(features.bassSteps)
+    positions = np.arange(size)
+
+    found = {}
+    for sequence in sequences:
+        cellLength = len(sequence.bassIntervals)
+        steps = np.array([intervalSteps(x) for x in sequence.bassIntervals])
+        requiredMasks = np.array(sequence.requiredMasks, dtype=np.int64)
+        for phase in range(cellLength):
+            cellPositions = (positions - phase) % cellLength
+            required = requiredMasks[cellPositions]
+            figuresFit = (masks & required) == required
+            # fits[i]: chord i has the figures and the interval to the next chord
+            fits = figuresFit[:-1] & (intervals == steps[cellPositions[:-1]])
+            starts, lengths, values = featureTable.runLengthEncode(fits)
+            for start, length in zip(starts[values].tolist(), lengths[values].tolist()):
+                end = start + length  # The chord after the last interval ...
+                if not figuresFit[end]:
+                    end -= 1  # ... unless that does not have the figures
+                if end - start + 1 >= minCells * cellLength:
+                    found[(start, end)] = SequenceMatch(start, end, sequence)
+
+    return sorted(found.values(), key=lambda x: (x.start, -x.end))
+
+
+# ------------------------------------------------------------------------------
+
+class Test(unittest.TestCase):
+
+    def testIntervals(self):
+        self.assertEqual([intervalSteps(x) for x in [1, 2, -2, 4, -5, -3, 5, -4]],
+                         [0, 1, 6, 3, 3, 5, 4, 4])
+        self.assertEqual(bassIntervals([0, 3, 6, 2]).tolist(), [3, 3, 3])
+
+    def testFindSequences(self):
+        from music21 import roman
+
+        def find(figures):
+            rns = [roman.RomanNumeral(x, 'C') for x in figures]
+            return [(x.start, x.end, x.formFunctionInTheory.functionalLabel)
+                    for x in findSequences(featureTable.FeatureTable(rns))]
+
+        # Circle of fifths: C, F, B, E, A, D, G, C
+        self.assertEqual(find(['I', 'IV', 'viio', 'iii', 'vi', 'ii', 'V', 'I']),
+                         [(0, 7, 'Descending circle of fifths Sequence')])
+
+        # 5-6 ascending: C, C, D, D, E, E, F (then not 6 on F)
+        self.assertEqual(find(['I', 'vi6', 'ii', 'viio6', 'iii', 'I6', 'IV', 'IV']),
+                         [(0, 6, '5-6- Alternation Ascending Sequence')])
+
+        # Not enough for two cells
+        self.assertEqual(find(['I', 'IV', 'viio']), [])
+
+        # Across a modulation (C major, then the same bass line labelled in G)
+        rns = [roman.RomanNumeral(x, 'C') for x in ['I', 'IV', 'viio']] + \
+              [roman.RomanNumeral(x, 'G') for x in ['vi', 'ii', 'V']]
+        matches = findSequences(featureTable.FeatureTable(rns))
+        self.assertEqual([(x.start, x.end) for x in matches], [(0, 5)])
+
+    def testLinear(self):
+        """
+        One long sequence is one match (not one per window).
+        """
+        features = featureTable.FeatureTable.fromArrays(
+            [1, 4, 7, 3, 6, 2, 5] * 100, [featureTable.figuresToMask((5, 3))] * 700, [1.0] * 700)
+        matches = findSequences(features)
+        self.assertEqual([(x.start, x.end) for x in matches], [(0, 699)])
+
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    unittest.main()
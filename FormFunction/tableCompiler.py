@@ -0,0 +1,549 @@
+"""
+===============================
+Table Compiler (tableCompiler.py)
+===============================
+
+
+LICENCE:
+===============================
+
+Creative Commons Attribution-ShareAlike 4.0 International License
+https://creativecommons.org/licenses/by-sa/4.0/
+
+
+ABOUT:
+===============================
+
+Compiles sets of form function tables (as in formFunctionTables.py, or house tables of our own)
+into a single checked JSON file (optionally gzipped),
+and swaps the tables in use at runtime without touching the code.
+
+Compiling checks every entry
+(the terms against the fixed vocabulary in formFunctionTables, as in its testFirstOrderNaming,
+bass degrees and figures in range, lengths consistent)
+and raises a ValueError listing every problem.
+It also warns of entries that can never be chosen
+(a later entry on the same bass pattern, or sequence on the same bass intervals,
+requires a subset of the same figures, so always wins).
+
+The compiled file holds the source entries, and also what is otherwise worked out from them:
+the labels, the figure bitmasks, and the lookup index.
+Its first line is a header with a checksum of the rest (the bytes as written),
+so that a damaged or hand-edited file is refused.
+NB: the point is a checked, portable set of tables, not speed:
+reading one takes longer than building the (small) built-in tables from formFunctionTables.py.
+
+Typical use:
+>>> tableSet = TableSet.compile({'global3': rows3, 'global4': rows4}, name='house')  # doctest: +SKIP
+>>> tableSet.write('house.json.gz')  # doctest: +SKIP
+>>> TableSet.read('house.json.gz').use()  # doctest: +SKIP
+
+Or from the command line, for the tables in formFunctionTables.py:
+python -m FormFunction.tableCompiler tables.json
+
+corpusRunner and analysisServer take a compiled file (-t / --tables) and load it in each worker on start.
+
+"""
+
+# ------------------------------------------------------------------------------
+
+import argparse
+import contextlib
+import gzip
+import hashlib
+import json
+import unittest
+
+if __package__ in (None, ''):  # Run as a script: import the rest of the package from the directory above
+    import os
+    import sys
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    __package__ = 'FormFunction'
+
+from . import formFunctionTables
+
+
+# ------------------------------------------------------------------------------
+
+formatName = 'formFunctionTables'
+formatVersion = 2  # 2: a header line with the checksum of the body line
+
+tableNames = ('global3', 'global4', 'sequences')
+figureRange = range(1, 14)  # Up to 13ths
+
+
+def builtInSources() -> dict:
+    """
+    The entries of the tables in formFunctionTables.py, as lists of rows (the source for compiling).
+    """
+    return {'global3': formFunctionTables.prolongation3 + formFunctionTables.pedalProlongation3 +
+            formFunctionTables.cadences3,
+            'global4': formFunctionTables.prolongation4 + formFunctionTables.cadences4,
+            'sequences': formFunctionTables.sequencePatternList}
+
+
+def validateEntry(entry: list,
+                  length: int) -> list:
+    """
+    Checks one row of a global3 / global4 table:
+    [bassScaleDegrees, requiredFigures, prolMedCadStream, whatFunctionProlonged, prolMedCadType].
+
+    :param entry: the row
+    :param length: the number of bass notes expected (3 or 4)
+    :return: list of problems (empty if none)
+    """
+    if not isinstance(entry, (list, tuple)) or len(entry) != 5:
+        return ['must have 5 fields: bassScaleDegrees, requiredFigures, prolMedCadStream, '
+                'whatFunctionProlonged, prolMedCadType']
+    bass, figures, stream, prolonged, prolMedCadType = entry
+    problems = []
+    if len(bass) != length:
+        problems.append(f'{len(bass)} bass scale degrees (not {length})')
+    if not all(isinstance(x, int) and 1 <= x <= 7 for x in bass):
+        problems.append(f'bass scale degrees must be 1-7: {bass}')
+    problems.extend(validateFigures(figures, len(bass)))
+    if stream not in ('Prolongation', 'Cadential'):
+        problems.append(f'prolMedCadStream must be Prolongation or Cadential: {stream!r}')
+    if prolonged not in formFunctionTables.functionsProlonged:
+        problems.append(f'unknown whatFunctionProlonged: {prolonged!r}')
+    if stream == 'Prolongation':
+        if prolonged is None:
+            problems.append('prolongations need a whatFunctionProlonged')
+        if prolMedCadType not in formFunctionTables.prolongationTypes or prolMedCadType is None:
+            problems.append(f'unknown prolongation type: {prolMedCadType!r}')
+    elif stream == 'Cadential' and prolMedCadType not in formFunctionTables.cadentialTypes:
+        problems.append(f'unknown cadential type: {prolMedCadType!r}')
+    return problems
+
+
+def validateSequence(entry: list) -> list:
+    """
+    Checks one row of the sequences table: [bassIntervals, requiredFigures, prolMedCadType].
+
+    :return: list of problems (empty if none)
+    """
+    if not isinstance(entry, (list, tuple)) or len(entry) != 3:
+        return ['must have 3 fields: bassIntervals, requiredFigures, prolMedCadType']
+    intervals, figures, prolMedCadType = entry
+    problems = []
+    if not intervals or not all(isinstance(x, int) and (x == 1 or 2 <= abs(x) <= 8) for x in intervals):
+        problems.append(f'bass intervals must be generic intervals (1, 2 to 8, or -2 to -8): {intervals}')
+    problems.extend(validateFigures(figures, len(intervals)))
+    if not isinstance(prolMedCadType, str) or not prolMedCadType:
+        problems.append(f'sequences need a name (prolMedCadType): {prolMedCadType!r}')
+    return problems
+
+
+def validateFigures(figures,
+                    length: int) -> list:
+    problems = []
+    if len(figures) != length:
+        problems.append(f'{len(figures)} required figures for {length} positions')
+    if not all(x is None or (isinstance(x, int) and x in figureRange) for x in figures):
+        problems.append(f'required figures must be None or {figureRange.start}-{figureRange.stop - 1}: {figures}')
+    return problems
+
+
+def shadowedEntries(lookupIndex: dict,
+                    sequences: list = ()) -> list:
+    """
+    The entries that can never be chosen:
+    those with a later entry on the same bass pattern requiring only figures that they require too.
+    Likewise for sequences on the same bass intervals (the later one wins: see sequenceMatcher.findSequences).
+
+    :return: list of (entry, the later entry that always wins) tuples
+    """
+    sequencesByIntervals = {}
+    for sequence in sequences:
+        sequencesByIntervals.setdefault(tuple(sequence.bassIntervals), []).append(sequence)
+    out = []
+    for candidates in list(lookupIndex.values()) + list(sequencesByIntervals.values()):
+        for i, entry in enumerate(candidates):
+            for later in candidates[i + 1:]:
+                if all(x & y == y for x, y in zip(entry.requiredMasks, later.requiredMasks)):
+                    out.append((entry, later))
+                    break
+    return out
+
+
+def entryDescription(entry) -> str:
+    pattern = entry.bassIntervals if isinstance(entry, formFunctionTables.Sequence) else entry.bassScaleDegrees
+    return f'{list(pattern)} {tuple(entry.requiredFigures)} {entry.functionalLabel}'
+
+
+def checksum(body: bytes) -> str:
+    """
+    A hash of the body of a compiled table set, exactly as written.
+    """
+    return hashlib.sha256(body).hexdigest()
+
+
+def fromSource(cls, source: list, derived: dict):
+    """
+    Makes a FormFunctionInTheory (or Sequence) from its source row and already derived attributes,
+    without working anything out again.
+    """
+    entry = cls.__new__(cls)
+    if cls is formFunctionTables.Sequence:
+        entry.bassIntervals = tuple(source[0])
+        entry.bassScaleDegrees = ()
+        entry.whatFunctionProlonged = None
+        entry.prolMedCadStream = 'Sequence'
+        entry.prolMedCadType = source[2]
+    else:
+        entry.bassScaleDegrees = list(source[0])
+        entry.prolMedCadStream, entry.whatFunctionProlonged, entry.prolMedCadType = source[2:5]
+    entry.requiredFigures = tuple(source[1])
+    entry.requiredMasks = tuple(derived['requiredMasks'])
+    entry.functionalLabel = derived['functionalLabel']
+    entry.shortLabel = derived['shortLabel']
+    return entry
+
+
+class TableSet:
+    """
+    A complete, checked set of tables: global3, global4, sequences and their lookupIndex.
+    Make one with compile (from rows of entries) or read (from a compiled file).
+    """
+
+    def __init__(self,
+                 name: str,
+                 sources: dict,
+                 global3: list,
+                 global4: list,
+                 sequences: list,
+                 lookupIndex: dict,
+                 warnings: list = ()):
+        self.name = name
+        self.sources = sources
+        self.global3 = global3
+        self.global4 = global4
+        self.sequences = sequences
+        self.lookupIndex = lookupIndex
+        self.warnings = list(warnings)
+
+    @classmethod
+    def compile(cls,
+                sources: dict,
+                name: str = ''):
+        """
+        Checks and compiles tables.
+
+        :param sources: dict of rows for any of 'global3', 'global4' (as in formFunctionTables.prolongation3 etc.)
+            and 'sequences' (as in formFunctionTables.sequencePatternList)
+        :param name: a name for the set
+        :return: TableSet
+        """
+        unknown = set(sources) - set(tableNames)
+        if unknown:
+            raise ValueError(f'Unknown tables: {sorted(unknown)} (expected some of {list(tableNames)}).')
+        sources = {x: [list(entry) for entry in sources.get(x, [])] for x in tableNames}
+
+        problems = []
+        for tableName, length in (('global3', 3), ('global4', 4)):
+            for position, entry in enumerate(sources[tableName]):
+                problems.extend(f'{tableName}[{position}] {entry}: {x}' for x in validateEntry(entry, length))
+        for position, entry in enumerate(sources['sequences']):
+            problems.extend(f'sequences[{position}] {entry}: {x}' for x in validateSequence(entry))
+        if problems:
+            raise ValueError('Invalid table entries:\n' + '\n'.join(problems))
+
+        # As in formFunctionTables: bass scale degrees in a list, figures and bass intervals in tuples
+        global3 = formFunctionTables.makeListOfFormFunctionObjects(
+            [[list(x[0]), tuple(x[1])] + x[2:] for x in sources['global3']])
+        global4 = formFunctionTables.makeListOfFormFunctionObjects(
+            [[list(x[0]), tuple(x[1])] + x[2:] for x in sources['global4']])
+        sequences = formFunctionTables.makeListOfSequenceObjects(
+            [[tuple(x[0]), tuple(x[1])] + x[2:] for x in sources['sequences']])
+        lookupIndex = formFunctionTables.makeLookupIndex(global3, global4)
+        warnings = [f'Never chosen: {entryDescription(x)} (always beaten by {entryDescription(y)})'
+                    for x, y in shadowedEntries(lookupIndex, sequences)]
+        return cls(name, sources, global3, global4, sequences, lookupIndex, warnings)
+
+    @classmethod
+    def inUse(cls,
+              name: str = 'built-in'):
+        """
+        The tables of formFunctionTables.py, compiled.
+        """
+        return cls.compile(builtInSources(), name)
+
+    def toDict(self) -> dict:
+        entries = self.global3 + self.global4
+        positions = {id(x): i for i, x in enumerate(entries)}
+        data = {
+            'format': formatName,
+            'formatVersion': formatVersion,
+            'name': self.name,
+            'sources': self.sources,
+            'derived': {tableName: [{'functionalLabel': x.functionalLabel,
+                                     'shortLabel': x.shortLabel,
+                                     'requiredMasks': list(x.requiredMasks)} for x in table]
+                        for tableName, table in zip(tableNames, (self.global3, self.global4, self.sequences))},
+            'lookupIndex': [[list(pattern), [positions[id(x)] for x in candidates]]
+                            for pattern, candidates in self.lookupIndex.items()],
+            'warnings': self.warnings,
+        }
+        return data
+
+    @classmethod
+    def fromDict(cls, data: dict):
+        """
+        Loads a compiled table set (from toDict), checking its format
+        but without checking or working out the entries again.
+        """
+        checkFormat(data)
+        sources, derived = data['sources'], data['derived']
+        tables = {}
+        for tableName in tableNames:
+            thisClass = formFunctionTables.Sequence if tableName == 'sequences' \
+                else formFunctionTables.FormFunctionInTheory
+            tables[tableName] = [fromSource(thisClass, x, y)
+                                 for x, y in zip(sources[tableName], derived[tableName])]
+        entries = tables['global3'] + tables['global4']
+        lookupIndex = {tuple(pattern): [entries[x] for x in candidates]
+                       for pattern, candidates in data['lookupIndex']}
+        return cls(data['name'], sources, tables['global3'], tables['global4'], tables['sequences'],
+                   lookupIndex, data['warnings'])
+
+    def toBytes(self) -> bytes:
+        """
+        The compiled file: a header line (with the checksum of the body), then the body line (toDict).
+        """
+        body = json.dumps(self.toDict(), separators=(',', ':')).encode('utf-8')
+        header = json.dumps({'format': formatName, 'formatVersion': formatVersion, 'name': self.name,
+                             'checksum': checksum(body)}, separators=(',', ':')).encode('utf-8')
+        return header + b'\n' + body
+
+    @classmethod
+    def fromBytes(cls, raw: bytes):
+        """
+        Loads a compiled file (from toBytes), checking the checksum on the body as it is,
+        before parsing it.
+        """
+        header, _, body = raw.partition(b'\n')
+        try:
+            header = json.loads(header)
+        except ValueError:
+            header = None
+        checkFormat(header)
+        if header.get('checksum') != checksum(body):
+            raise ValueError('The checksum does not match: the file is damaged or has been edited. '
+                             'Compile it again from the source entries.')
+        return cls.fromDict(json.loads(body))
+
+    def write(self, path: str):
+        """
+        Writes the compiled table set to a .json file (or .json.gz, compressed).
+        """
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'wb') as f:
+            f.write(self.toBytes())
+
+    @classmethod
+    def read(cls, path: str):
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rb') as f:
+            return cls.fromBytes(f.read())
+
+    def use(self):
+        """
+        Makes these the tables in use (in this process), in place of those in formFunctionTables.
+        """
+        formFunctionTables.setTables(self.global3, self.global4, self.sequences, self.lookupIndex)
+
+
+def checkFormat(data):
+    """
+    Raises a ValueError unless data (a header or toDict) is of this format and version.
+    """
+    if not isinstance(data, dict) or data.get('format') != formatName or \
+            data.get('formatVersion') != formatVersion:
+        found = (data.get('format'), data.get('formatVersion')) if isinstance(data, dict) else data
+        raise ValueError(f'Not a compiled table set of format version {formatVersion}: {found!r}')
+
+
+def loadTables(path: str = None):
+    """
+    Reads a compiled table set and puts it in use; nothing if path is None.
+    For use as (or in) the initializer of a worker process.
+    """
+    if path:
+        TableSet.read(path).use()
+
+
+@contextlib.contextmanager
+def tablesInUse(tableSet: TableSet):
+    """
+    Puts a table set in use for the duration of a `with` block, then puts back those before.
+    """
+    before = (formFunctionTables.global3, formFunctionTables.global4,
+              formFunctionTables.sequences, formFunctionTables.lookupIndex)
+    tableSet.use()
+    try:
+        yield tableSet
+    finally:
+        formFunctionTables.setTables(*before)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Compile form function tables into one checked file, for use with -t / --tables.')
+    parser.add_argument('outPath',
+                        help='the compiled file to write (.json or .json.gz)')
+    parser.add_argument('-i', '--source', default=None,
+                        help='a JSON file of rows for global3, global4 and/or sequences '
+                             '(default: the tables in formFunctionTables.py)')
+    parser.add_argument('-n', '--name', default=None,
+                        help='a name for the table set')
+    parsed = parser.parse_args(args)
+
+    if parsed.source:
+        with open(parsed.source, encoding='utf-8') as f:
+            tableSet = TableSet.compile(json.load(f), parsed.name or parsed.source)
+    else:
+        tableSet = TableSet.inUse(parsed.name or 'built-in')
+    tableSet.write(parsed.outPath)
+    for warning in tableSet.warnings:
+        print(f'Warning: {warning}')
+    print(f'{len(tableSet.global3)} + {len(tableSet.global4)} entries and {len(tableSet.sequences)} sequences '
+          f'written to {parsed.outPath}')
+    return tableSet
+
+
+# ------------------------------------------------------------------------------
+
+class Test(unittest.TestCase):
+
+    def summary(self, tableSet):
+        return [(type(x), x.__dict__) for x in tableSet.global3 + tableSet.global4 + tableSet.sequences]
+
+    def testRoundTrip(self):
+        """
+        Compiled, written and read: the same entries as formFunctionTables makes (and in the same index).
+        """
+        import os
+        import tempfile
+        tableSet = TableSet.inUse()
+        self.assertEqual(self.summary(tableSet),
+                         [(type(x), x.__dict__) for x in formFunctionTables.global3 + formFunctionTables.global4 +
+                          formFunctionTables.sequences])
+
+        with tempfile.TemporaryDirectory() as tempDir:
+            for name in ['tables.json', 'tables.json.gz']:
+                path = os.path.join(tempDir, name)
+                tableSet.write(path)
+                loaded = TableSet.read(path)
+                self.assertEqual(self.summary(loaded), self.summary(tableSet))
+                self.assertEqual({k: [x.__dict__ for x in v] for k, v in loaded.lookupIndex.items()},
+                                 {k: [x.__dict__ for x in v] for k, v in formFunctionTables.lookupIndex.items()})
+                self.assertTrue(all(y in loaded.global3 + loaded.global4
+                                    for x in loaded.lookupIndex.values() for y in x))  # The same objects
+
+            # Damaged or edited
+            raw = tableSet.toBytes()
+            for damaged in [raw.replace(b'Passing', b'Passed', 1), raw[:-1], raw.split(b'\n')[1], b'']:
+                self.assertRaises(ValueError, TableSet.fromBytes, damaged)
+            data = tableSet.toDict()
+            data['formatVersion'] = 1
+            self.assertRaises(ValueError, TableSet.fromDict, data)
+
+        # The shipped tables have two identical Cambiata entries, so the first never wins
+        self.assertEqual(len(tableSet.warnings), 1)
+        self.assertIn('Cambiata', tableSet.warnings[0])
+
+        # A later entry requiring less
+        rows = [[[4, 5, 1], (None, 7, 5), 'Cadential', None, 'Authentic'],
+                [[4, 5, 1], (None, None, 5), 'Cadential', None, None]]
+        self.assertEqual(len(TableSet.compile({'global3': rows}).warnings), 1)
+        self.assertEqual(TableSet.compile({'global3': rows[::-1]}).warnings, [])
+
+        # Sequences too (as the 6-6 rows once copied the 5-6 cells)
+        rows = [[(1, 2), (5, 6), '6-6- Ascending'], [(1, 2), (5, 6), '5-6- Alternation Ascending'],
+                [(1, 2), (5, None), 'Other'], [(2, 2), (5, 6), 'Steps']]
+        warnings = TableSet.compile({'sequences': rows}).warnings
+        self.assertEqual(len(warnings), 2)
+        self.assertIn('6-6-', warnings[0])
+        self.assertIn('Other', warnings[1])
+
+    def testValidation(self):
+        good = [[1, 2, 3], (5, None, 6), 'Prolongation', 'Tonic', 'Passing']
+        TableSet.compile({'global3': [good]})
+        for bad, message in [
+            ([[1, 2], (5, None), 'Prolongation', 'Tonic', 'Passing'], '2 bass scale degrees'),
+            ([[1, 2, 8], (5, None, 6), 'Prolongation', 'Tonic', 'Passing'], 'must be 1-7'),
+            ([[1, 2, 3], (5, None), 'Prolongation', 'Tonic', 'Passing'], '2 required figures'),
+            ([[1, 2, 3], (5, None, 'six'), 'Prolongation', 'Tonic', 'Passing'], 'must be None or'),
+            ([[1, 2, 3], (5, None, 6), 'Prolonged', 'Tonic', 'Passing'], 'prolMedCadStream'),
+            ([[1, 2, 3], (5, None, 6), 'Prolongation', 'Tonic', 'Passed'], 'prolongation type'),
+            ([[1, 2, 3], (5, None, 6), 'Prolongation', None, 'Passing'], 'need a whatFunctionProlonged'),
+            ([[4, 5, 1], (None, 7, 5), 'Cadential', None, 'Perfect'], 'cadential type'),
+        ]:
+            with self.assertRaises(ValueError) as context:
+                TableSet.compile({'global3': [good, bad]})
+            self.assertIn('global3[1]', str(context.exception))
+            self.assertIn(message, str(context.exception))
+        with self.assertRaises(ValueError) as context:
+            TableSet.compile({'sequences': [[(0, 2), (5, 6), 'Odd'], [(1, 2), (5,), '']]})
+        self.assertEqual(str(context.exception).count('sequences['), 3)
+        self.assertRaises(ValueError, TableSet.compile, {'global5': []})
+
+    def testMain(self):
+        """
+        From the command line: the built-in tables, or rows from a JSON file.
+        """
+        import contextlib
+        import io
+        import os
+        import tempfile
+        with tempfile.TemporaryDirectory() as tempDir:
+            outPath = os.path.join(tempDir, 'tables.json.gz')
+            with contextlib.redirect_stdout(io.StringIO()) as out:
+                main([outPath])
+            self.assertIn('Cambiata', out.getvalue())
+            self.assertEqual(self.summary(TableSet.read(outPath)), self.summary(TableSet.inUse()))
+
+            sourcePath = os.path.join(tempDir, 'house.json')
+            with open(sourcePath, 'w', encoding='utf-8') as f:
+                json.dump({'global3': [[[4, 5, 1], [None, 7, 5], 'Cadential', None, 'Authentic']]}, f)
+            with contextlib.redirect_stdout(io.StringIO()):
+                tableSet = main([outPath, '-i', sourcePath, '-n', 'house'])
+            loaded = TableSet.read(outPath)
+            self.assertEqual(loaded.name, 'house')
+            self.assertEqual(self.summary(loaded), self.summary(tableSet))
+            self.assertEqual(len(loaded.global3), 1)
+
+    def testUse(self):
+        """
+        Swapping in another table set at runtime (for everything that uses the tables).
+        """
+        from . import bassToFormFunction
+        from . import featureTable
+        from . import schemaMatcher
+        mask = featureTable.figuresToMask((5, 3))
+        seventh = featureTable.figuresToMask((7, 5, 3))
+        features = featureTable.FeatureTable.fromArrays([4, 5, 1, 6, 4, 5, 1],
+                                                        [mask, seventh, mask, mask, mask, seventh, mask],
+                                                        [1.0] * 7)
+
+        def labels():
+            return [f.functionalLabel for f in bassToFormFunction.Analysis(features=features).findFormFunctions()]
+
+        builtIn = labels()
+        house = TableSet.compile(
+            {'global3': [[[4, 5, 1], (None, 7, 5), 'Cadential', None, 'Authentic'],
+                         [[1, 6, 4], (5, None, None), 'Prolongation', 'Tonic', 'Substitute']]},
+            'house')
+        with tablesInUse(house):
+            self.assertEqual(labels(), ['Authentic Cadential Progression', 'Tonic Prolongation with Substitute',
+                                        'Authentic Cadential Progression'])
+            self.assertEqual(len(list(schemaMatcher.currentAutomaton().findAll([1, 6, 4], [mask] * 3))), 1)
+        self.assertEqual(labels(), builtIn)
+        self.assertIs(schemaMatcher.currentAutomaton().lookupIndex[(4, 5, 1)][-1],
+                      formFunctionTables.lookupIndex[(4, 5, 1)][-1])
+
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    main()